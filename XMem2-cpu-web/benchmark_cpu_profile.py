@@ -0,0 +1,78 @@
+"""
+FPS and correctness of the CPU execution profiles (config['cpu_profile'], see inference/cpu_profile.py) on a fixed clip
+
+Every profile runs over the same clip, the first one given is the reference (float32 by default).
+Reports the throughput and, for the other profiles, the mean IoU of the masks and the largest difference
+of the probabilities w.r.t. the reference. Exits with an error if any mean IoU is below --min_iou, e.g.:
+
+python benchmark_cpu_profile.py imgs_dir masks_dir --profiles None channels_last bf16 --threads 8
+"""
+
+import sys
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+import torch
+
+from inference.run_on_video import iter_video_masks
+
+
+def mean_iou(masks, reference_masks):
+    # per frame IoU of the foreground (all objects), averaged over frames
+    ious = []
+    for mask, reference in zip(masks, reference_masks):
+        union = np.logical_or(mask > 0, reference > 0).sum()
+        ious.append(np.logical_and(mask == reference, reference > 0).sum() / union if union > 0 else 1.0)
+    return float(np.mean(ious))
+
+
+def run_profile(args, profile):
+    config = {'cpu_profile': profile, 'size': args.size}
+    if args.model is not None:
+        config['model'] = args.model
+
+    masks, probs = [], []
+    start = perf_counter()
+    for frame in iter_video_masks(args.imgs, args.masks, frames_with_masks=args.frames_with_masks, return_probabilities=True,
+                                  print_progress=False, overwrite_config=config):
+        masks.append(frame.mask)
+        probs.append(frame.prob)
+    elapsed = perf_counter() - start
+    return masks, probs, len(masks) / elapsed
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('imgs', help='Directory of the clip frames')
+    parser.add_argument('masks', help='Directory of the clip masks, for --frames_with_masks')
+    parser.add_argument('--profiles', nargs='+', default=['None', 'channels_last', 'bf16'],
+                        help='Profiles to compare, the first one is the reference')
+    parser.add_argument('--frames_with_masks', nargs='+', type=int, default=[0])
+    parser.add_argument('--model', default=None, help='Weights to load, default: config["model"]')
+    parser.add_argument('--size', type=int, default=480)
+    parser.add_argument('--min_iou', type=float, default=0.95)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    reference = None
+    failed = False
+    for name in args.profiles:
+        profile = None if name == 'None' else name
+        masks, probs, fps = run_profile(args, profile)
+        stats = f'{name}: fps={fps:.2f}'
+        if reference is None:
+            reference = (masks, probs, fps)
+        else:
+            iou = mean_iou(masks, reference[0])
+            max_prob_diff = max((p - q).abs().max().item() for p, q in zip(probs, reference[1]))
+            stats += f', speedup={fps / reference[2]:.2f}x, mean_iou={iou:.4f}, max_prob_diff={max_prob_diff:.4f}'
+            failed = failed or iou < args.min_iou
+        print(stats)
+
+    if failed:
+        print(f'mean IoU below {args.min_iou} w.r.t. {args.profiles[0]}')
+        sys.exit(1)
@@ -0,0 +1,80 @@
+"""
+Parity and per-stage speed of the exported XMem graphs (export_model.py) w.r.t. the eager network
+
+Every stage (key_encoder, value_encoder, decoder) is run on random inputs, at a different size and number of objects
+than the ones used for the export, so that the dynamic axes are checked as well. Reports the largest absolute
+difference of the outputs to eager mode and the time per call of every runtime.
+Exits with an error if a difference is above --tolerance, e.g.:
+
+python benchmark_export.py --model saves/XMem.pth --formats onnx torchscript --threads 8
+"""
+
+import sys
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import torch
+
+from inference.exported_network import ExportedXMem
+from model.export import GRAPHS, example_inputs, export_network
+from model.network import XMem
+from util.configuration import VIDEO_INFERENCE_CONFIG
+
+
+RUNTIMES = {'onnx': 'onnxruntime', 'torchscript': 'torchscript'}
+
+
+def time_it(func, repeats):
+    func()  # warmup
+    start = perf_counter()
+    for _ in range(repeats):
+        func()
+    return (perf_counter() - start) / repeats
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--model', default=VIDEO_INFERENCE_CONFIG['model'])
+    parser.add_argument('--formats', nargs='+', choices=list(RUNTIMES), default=list(RUNTIMES))
+    parser.add_argument('--export_dir', default=None, help='Already exported graphs (of --model), exported to a temporary directory if not given')
+    parser.add_argument('--h', type=int, default=480)
+    parser.add_argument('--w', type=int, default=848, help='854p padded to a multiple of 16, not the size used for the export')
+    parser.add_argument('--num_objects', type=int, default=3)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--tolerance', type=float, default=1e-3)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    torch.autograd.set_grad_enabled(False)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    network = XMem(VIDEO_INFERENCE_CONFIG.copy(), args.model, pretrained_key_encoder=False, pretrained_value_encoder=False).eval()
+    with TemporaryDirectory() as tmp_dir:
+        export_dir = args.export_dir or tmp_dir
+        exported = {}
+        for format in args.formats:
+            if args.export_dir is None:
+                export_network(network, export_dir, format=format)
+            exported[format] = ExportedXMem(export_dir, runtime=RUNTIMES[format])
+
+        failed = False
+        for name, (graph, _, output_names) in GRAPHS.items():
+            eager = graph(network).eval()
+            inputs = example_inputs(network, name, args.h, args.w, args.num_objects)
+            reference = eager(*inputs)
+            eager_time = time_it(lambda: eager(*inputs), args.repeats)
+            print(f'{name}: eager={eager_time*1000:.1f}ms')
+
+            for format, exported_network in exported.items():
+                outputs = exported_network.run_graph(name, *inputs)
+                diffs = {n: (o - r).abs().max().item() for n, o, r in zip(output_names, outputs, reference)}
+                exported_time = time_it(lambda: exported_network.run_graph(name, *inputs), args.repeats)
+                diffs_str = ', '.join(f'{n}={d:.2e}' for n, d in diffs.items())
+                print(f'  {format}: {exported_time*1000:.1f}ms, speedup={eager_time/exported_time:.2f}x, max_abs_diff: {diffs_str}')
+                failed = failed or max(diffs.values()) > args.tolerance
+
+    if failed:
+        print(f'Outputs differ from eager mode by more than {args.tolerance}')
+        sys.exit(1)
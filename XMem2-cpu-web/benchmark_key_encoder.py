@@ -0,0 +1,46 @@
+"""
+Key encoder throughput for different batch sizes
+
+The key path (KeyEncoder + KeyProjection) does not depend on the memory, so the propagation loop can
+encode several upcoming frames at once (config['key_lookahead'], see run_on_video). This measures
+the per-frame cost of XMem.encode_key for each batch size, e.g.:
+
+python benchmark_key_encoder.py --batch_sizes 1 2 4 8 --threads 8
+"""
+
+from argparse import ArgumentParser
+from time import perf_counter
+
+import torch
+
+from model.network import XMem
+from util.configuration import VIDEO_INFERENCE_CONFIG
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 2, 4, 8])
+    parser.add_argument('--h', type=int, default=480)
+    parser.add_argument('--w', type=int, default=864, help='854p padded to a multiple of 16')
+    parser.add_argument('--model', default=None, help='Weights to load, random weights are fine for timing')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    torch.autograd.set_grad_enabled(False)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    config = VIDEO_INFERENCE_CONFIG.copy()
+    network = XMem(config, args.model, pretrained_key_encoder=False, pretrained_value_encoder=False).eval()
+
+    for batch_size in args.batch_sizes:
+        frames = torch.randn(batch_size, 3, args.h, args.w)
+        network.encode_key(frames)  # warmup
+
+        start = perf_counter()
+        for _ in range(args.repeats):
+            network.encode_key(frames)
+        per_frame = (perf_counter() - start) / (args.repeats * batch_size)
+
+        print(f'batch_size={batch_size}: {per_frame*1000:.1f} ms/frame, {1/per_frame:.2f} frames/s')
@@ -0,0 +1,262 @@
+"""
+Memory readout benchmark on synthetic memory banks
+
+Fills a MemoryManager with random keys/values (no network or video needed)
+and measures the per-frame cost of MemoryManager.match_memory for different bank sizes.
+Config entries can be overridden to compare readout modes, e.g.:
+
+python benchmark_memory.py --bank_frames 10 50 100 --set sparse_readout=False --set sparse_readout=True
+
+Multiple overrides for one setting are separated by commas, e.g.:
+
+python benchmark_memory.py --set ann_readout=False --set ann_readout=True,ann_num_probes=4 --set ann_readout=True,ann_num_probes=16
+python benchmark_memory.py --set readout_top_frames=None --set readout_top_frames=8 --set readout_top_frames=16
+
+All bank frames are permanent memory frames, one per video frame, and the query is at the middle of the bank (see --query_ti),
+so heavily annotated videos can be simulated with the selection of the nearest permanent frames, e.g.:
+
+python benchmark_memory.py --bank_frames 50 200 --set permanent_top_frames=None --set permanent_top_frames=8 --set permanent_top_frames=8,permanent_frame_selection=feature
+
+Reduced-precision memory storage also reports the readout error w.r.t. float32 storage, both on the permanent bank
+and on a bank of the same frames consolidated into long-term memory (if bank_frames > max_mid_term_frames).
+With --clip, every setting is additionally run on a real video, reporting the mean IoU
+and its difference to the first setting (this needs the model weights and ground truth masks for all frames):
+
+python benchmark_memory.py --set memory_value_dtype=None --set memory_value_dtype=bfloat16 --set memory_value_dtype=int8 --clip imgs_dir masks_dir
+python benchmark_memory.py --set permanent_top_frames=None --set permanent_top_frames=4 --clip imgs_dir masks_dir --clip_annotate_every 10
+
+With --stress_frames, a long video is simulated instead (readout every frame, a memory frame every mem_every frames,
+a second object group entering at a quarter of the video), reporting throughput and memory size per window of frames.
+Both should stay flat once the long-term memory is full, e.g.:
+
+python benchmark_memory.py --stress_frames 5000 --set max_long_term_elements=2000
+"""
+
+import ast
+import os
+from argparse import ArgumentParser
+from time import perf_counter
+
+import torch
+
+from inference.memory_manager import MemoryManager
+from model.memory_util import get_similarity, get_similarity_from_terms, get_similarity_query_terms
+from util.configuration import VIDEO_INFERENCE_CONFIG
+
+
+def parse_overrides(overrides):
+    # ['a=1', 'b=None'] -> {'a': 1, 'b': None}
+    config = {}
+    for item in overrides:
+        key, value = item.split('=', 1)
+        try:
+            config[key] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            config[key] = value
+    return config
+
+
+def random_frame(args, num_objects):
+    # frames are noisy versions of the same scene, so that the keys are clustered like in a real video
+    global scene_key
+    if scene_key is None:
+        scene_key = torch.randn(1, args.key_dim, args.h, args.w)
+    key = scene_key + args.frame_noise * torch.randn(1, args.key_dim, args.h, args.w)
+    shrinkage = torch.rand(1, 1, args.h, args.w) + 1
+    selection = torch.rand(1, args.key_dim, args.h, args.w)
+    value = torch.randn(1, num_objects, args.value_dim, args.h, args.w)
+    return key, shrinkage, selection, value
+
+
+scene_key = None
+
+
+def build_memory(args, config, bank_frames):
+    # all frames go into the permanent memory, so that the bank size is exactly `bank_frames`
+    # reseeded, so that different configs get the same memory contents
+    global scene_key
+    torch.manual_seed(bank_frames)
+    scene_key = None
+    memory = MemoryManager(config=config)
+    objects = list(range(1, args.num_objects+1))
+    for ti in range(bank_frames):
+        key, shrinkage, selection, value = random_frame(args, args.num_objects)
+        memory.add_memory(key, shrinkage, value, objects, selection=selection, permanent=True, ti=ti)
+    return memory
+
+
+def build_consolidated_memory(args, config, bank_frames):
+    # the first frame is permanent, the others go through the temporary memory (with a readout before each, for the usage)
+    # so that they are consolidated into long-term prototypes once there are more than max_mid_term_frames
+    global scene_key
+    torch.manual_seed(bank_frames)
+    scene_key = None
+    memory = MemoryManager(config=config)
+    objects = list(range(1, args.num_objects+1))
+    for ti in range(bank_frames):
+        key, shrinkage, selection, value = random_frame(args, args.num_objects)
+        if ti > 0:
+            memory.match_memory(key, selection)
+        memory.add_memory(key, shrinkage, value, objects, selection=selection, permanent=ti == 0, ti=ti)
+    return memory
+
+
+def readout_error(args, build, config, bank_frames, query_key, query_selection):
+    # relative readout error (in %) of `config` w.r.t. float32 storage, on the same memory contents
+    memory = build(args, config, bank_frames)
+    reference = build(args, dict(config, memory_value_dtype=None), bank_frames)
+    readout = memory.match_memory(query_key, query_selection, disable_usage_updates=True)
+    reference_readout = reference.match_memory(query_key, query_selection, disable_usage_updates=True)
+    return 100 * ((readout - reference_readout).norm() / reference_readout.norm()).item()
+
+
+def time_it(func, repeats):
+    func()  # warmup
+    start = perf_counter()
+    for _ in range(repeats):
+        func()
+    return (perf_counter() - start) / repeats
+
+
+def benchmark_readout(args, config, bank_frames):
+    memory = build_memory(args, config, bank_frames)
+    query_key, _, query_selection, _ = random_frame(args, args.num_objects)
+    query_ti = args.query_ti if args.query_ti is not None else bank_frames // 2
+
+    per_frame = time_it(lambda: memory.match_memory(query_key, query_selection, disable_usage_updates=True, ti=query_ti), args.repeats)
+
+    # similarity alone, from raw keys/shrinkage vs. from the terms cached by the memory stores
+    # only on a subset of the query positions, the full N x HW matrices do not fit in memory for large banks
+    memory_key = memory.permanent_work_mem.key
+    shrinkage = memory.permanent_work_mem.shrinkage
+    memory_terms = memory.permanent_work_mem.similarity_terms
+    qk = query_key.flatten(start_dim=2)[:, :, :args.check_queries]
+    qe = query_selection.flatten(start_dim=2)[:, :, :args.check_queries]
+    sim_uncached = time_it(lambda: get_similarity(memory_key, shrinkage, qk, qe), args.repeats)
+    sim_cached = time_it(lambda: get_similarity_from_terms(memory_terms, qk, qe), args.repeats)
+
+    stats = {
+        'readout_ms': per_frame * 1000,
+        'readout_fps': 1 / per_frame,
+        'similarity_ms': sim_uncached * 1000,
+        'similarity_cached_terms_ms': sim_cached * 1000,
+        'memory_mb': memory.memory_nbytes() / 1024**2,
+        'memory_ram_mb': memory.memory_ram_nbytes() / 1024**2,
+    }
+
+    if config.get('memory_value_dtype') is not None:
+        # relative readout error w.r.t. float32 storage, on the permanent bank
+        stats['readout_error_pct'] = readout_error(args, build_memory, config, bank_frames, query_key, query_selection)
+        if config['enable_long_term'] and bank_frames > config['max_mid_term_frames']:
+            # and on a bank of the same frames that went through long-term consolidation
+            stats['consolidated_readout_error_pct'] = readout_error(args, build_consolidated_memory, config, bank_frames,
+                                                                    query_key, query_selection)
+
+    # frame pruning takes precedence over the ANN search, as in match_memory
+    frame_pruning = memory.readout_top_frames is not None or memory.permanent_top_frames is not None
+    candidates = memory._select_memory_frames(qk, qe, query_ti) if frame_pruning else None
+    if candidates is not None or memory.ann_readout:
+        # recall of the approximate top-k w.r.t. the exact top-k
+        memory_terms, _ = memory._get_readout_view()
+        # and the fraction of the exact top-k softmax weight that is covered
+        exact_values, exact = torch.topk(memory_terms.transpose(1, 2) @ get_similarity_query_terms(qk, qe), k=memory.top_k, dim=1)
+        if candidates is not None:
+            _, approx = memory._search_topk_in(qk, qe, *candidates)
+        else:
+            _, approx = memory._search_topk(qk, qe)
+        found = (exact.unsqueeze(2) == approx.unsqueeze(1)).any(dim=2)
+        stats['topk_recall'] = found.float().mean().item()
+        stats['topk_weight_recall'] = (torch.softmax(exact_values, dim=1) * found).sum(dim=1).mean().item()
+
+    return stats
+
+
+def stress_long_video(args, config):
+    # the first frame goes into the permanent memory, like an annotated frame
+    memory = MemoryManager(config=config)
+    key, shrinkage, selection, value = random_frame(args, 1)
+    memory.add_memory(key, shrinkage, value, [1], selection=selection, permanent=True, ti=0)
+
+    second_group_start = args.stress_frames // 4
+    window_start = perf_counter()
+    window_memory = []
+    for ti in range(1, args.stress_frames):
+        objects = [1] if ti < second_group_start else [1, 2]
+        key, shrinkage, selection, value = random_frame(args, len(objects))
+        memory.match_memory(key, selection)
+        if ti % config['mem_every'] == 0:
+            memory.add_memory(key, shrinkage, value, objects, selection=selection)
+        window_memory.append(memory.memory_nbytes())
+
+        if ti % args.stress_window == 0 or ti == args.stress_frames-1:
+            elapsed = perf_counter() - window_start
+            long_elements = memory.long_mem.size if memory.enable_long_term else 0
+            print(f'frames {ti-len(window_memory)+1}-{ti}: fps={len(window_memory)/elapsed:.2f}, '
+                  f'memory_mb={max(window_memory)/1024**2:.2f}, long_term_elements={long_elements}, '
+                  f'working_elements={memory.temporary_work_mem.size}, groups={memory.temporary_work_mem.num_groups}')
+            window_start = perf_counter()
+            window_memory = []
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--bank_frames', nargs='+', type=int, default=[10, 50, 100],
+                        help='Number of frames in the memory bank')
+    parser.add_argument('--h', type=int, default=30, help='Feature map height (480p / 16)')
+    parser.add_argument('--w', type=int, default=54, help='Feature map width (854p / 16)')
+    parser.add_argument('--key_dim', type=int, default=64)
+    parser.add_argument('--value_dim', type=int, default=512)
+    parser.add_argument('--num_objects', type=int, default=1)
+    parser.add_argument('--frame_noise', type=float, default=0.5, help='Std. of the per-frame key noise around the scene')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--check_queries', type=int, default=256,
+                        help='Number of query positions for the similarity timings and the recall check')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--set', action='append', default=[], dest='overrides',
+                        help='Config override as key=value, repeat to compare several settings')
+    parser.add_argument('--clip', nargs=2, default=None, metavar=('IMGS', 'MASKS'),
+                        help='Reference video (frames and ground truth masks) to report the IoU of every setting on')
+    parser.add_argument('--clip_output', default='output/benchmark_memory')
+    parser.add_argument('--clip_annotate_every', type=int, default=None,
+                        help='Give the ground truth of every n-th frame of the clip to the model, instead of only the first frame')
+    parser.add_argument('--query_ti', type=int, default=None,
+                        help='Video frame index of the query (the bank frames are 0..bank_frames-1), default: the middle of the bank')
+    parser.add_argument('--stress_frames', type=int, default=None,
+                        help='Simulate a long video with this many frames instead of benchmarking fixed memory banks')
+    parser.add_argument('--stress_window', type=int, default=100, help='Number of frames per reported window')
+    args = parser.parse_args()
+
+    torch.autograd.set_grad_enabled(False)
+    torch.manual_seed(0)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    # each override is benchmarked as a separate setting; no overrides = default config
+    settings = [o.split(',') for o in args.overrides] if args.overrides else [[]]
+    reference_iou = None
+    for overrides in settings:
+        config = VIDEO_INFERENCE_CONFIG.copy()
+        config.update(key_dim=args.key_dim, value_dim=args.value_dim)
+        config.update(parse_overrides(overrides))
+        name = ', '.join(overrides) if overrides else 'default'
+
+        print(f'--- {name} ---')
+        if args.stress_frames is not None:
+            stress_long_video(args, config)
+            continue
+        for bank_frames in args.bank_frames:
+            stats = benchmark_readout(args, config, bank_frames)
+            stats_str = ', '.join(f'{k}={v:.2f}' for k, v in stats.items())
+            print(f'bank_frames={bank_frames} (N={bank_frames*args.h*args.w}): {stats_str}')
+
+        if args.clip is not None:
+            from inference.run_on_video import run_on_video
+
+            num_clip_frames = len(os.listdir(args.clip[0]))
+            frames_with_masks = range(0, num_clip_frames, args.clip_annotate_every) if args.clip_annotate_every else [0]
+            clip_stats = run_on_video(args.clip[0], args.clip[1], args.clip_output, frames_with_masks=list(frames_with_masks),
+                                      compute_iou=True, print_progress=False, overwrite_config=parse_overrides(overrides))
+            # frames whose mask was given to the model have iou == -1
+            iou = clip_stats['iou'][clip_stats['iou'] >= 0].mean()
+            reference_iou = iou if reference_iou is None else reference_iou
+            print(f'clip: iou={iou:.4f}, iou_delta={iou - reference_iou:+.4f}')
@@ -0,0 +1,135 @@
+"""
+J&F and speed deltas of quantized XMem/S2M checkpoints (see quantize_model.py) w.r.t. the float32 ones on a sample video
+
+Every XMem checkpoint (--models, the first one is the reference) propagates the masks over the same video
+(by default the bundled flask-app-utils/uploads/videos/video.mp4, which is extracted at --size).
+The video has no annotations bundled, --masks gives those to start from, named after the frames (frame_000000.png, ...).
+J&F is computed against the ground truth in --gt if given (same names), and otherwise against the masks of the reference.
+With --s2m_models, the S2M checkpoints are compared the same way on scribbles generated from the masks, e.g.:
+
+python benchmark_quantization.py --masks sample_masks --models saves/XMem.pth saves/XMem_int8.pth \\
+    --s2m_models saves/s2m.pth saves/s2m_int8.pth
+"""
+
+import os
+from argparse import ArgumentParser
+from time import perf_counter
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from inference.data.mask_mapper import MaskMapper
+from inference.data.video_reader import VideoReader
+from inference.interact.s2m.s2m_network import deeplabv3plus_resnet50 as S2M
+from inference.interact.s2m_controller import S2MController
+from inference.quantization import is_quantized_checkpoint, load_quantized_s2m
+from inference.run_on_video import iter_video_masks
+from model.aggregate import aggregate
+from quantize_model import iter_scribble_interactions, load_frame
+from util.metrics import batched_f_measure, batched_jaccard
+
+SAMPLE_VIDEO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-app-utils', 'uploads', 'videos', 'video.mp4')
+
+
+def j_and_f(masks, reference_masks):
+    # (J, F, J&F) over all frames, objects from the reference
+    y_true = np.stack(reference_masks)
+    y_pred = np.stack(masks)
+    j = float(batched_jaccard(y_true, y_pred).mean())
+    f = float(batched_f_measure(y_true, y_pred).mean())
+    return j, f, (j + f) / 2
+
+
+def load_gt(gt_dir, frames, shape):
+    # index masks of the ground truth for `frames`, at the size of the predictions
+    masks = []
+    for frame in frames:
+        mask = np.array(Image.open(os.path.join(gt_dir, frame[:-4] + '.png')).convert('P'))
+        if mask.shape != shape:
+            mask = cv2.resize(mask, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+        masks.append(mask)
+    return masks
+
+
+def run_xmem(args, model):
+    config = {'model': model, 'size': args.size}
+    frames, masks = [], []
+    start = perf_counter()
+    for frame in iter_video_masks(args.video, args.masks, frames_with_masks=args.frames_with_masks,
+                                  print_progress=False, overwrite_config=config):
+        frames.append(frame.frame)
+        masks.append(frame.mask)
+    elapsed = perf_counter() - start
+    return frames, masks, len(masks) / elapsed
+
+
+def run_s2m(model, interactions, num_objects):
+    weights = torch.load(model, map_location='cpu')
+    if is_quantized_checkpoint(weights):
+        s2m_model = load_quantized_s2m(weights)
+    else:
+        s2m_model = S2M().eval()
+        s2m_model.load_state_dict(weights)
+    controller = S2MController(s2m_model, num_objects, ignore_class=255, device='cpu')
+
+    masks = []
+    start = perf_counter()
+    for image, prev_mask, scribbles in interactions:
+        prob = aggregate(controller.interact(image, prev_mask, scribbles), dim=0)
+        masks.append(prob.argmax(0).numpy().astype(np.uint8))
+    elapsed = perf_counter() - start
+    return masks, elapsed / len(masks)
+
+
+def report(name, scores, reference_scores, speed, reference_speed, unit):
+    stats = f'{name}: {unit}={speed:.3f}, J={scores[0]:.4f}, F={scores[1]:.4f}, J&F={scores[2]:.4f}'
+    if reference_scores is not None:
+        stats += f', speedup={speed / reference_speed if unit == "fps" else reference_speed / speed:.2f}x, ' \
+                 f'delta_J&F={scores[2] - reference_scores[2]:+.4f}'
+    print(stats)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--video', default=SAMPLE_VIDEO, help='Video file or directory of frames')
+    parser.add_argument('--masks', required=True, help='Directory of the masks to start from (and to generate scribbles from)')
+    parser.add_argument('--gt', default=None, help='Directory of the ground truth masks, default: the reference predictions')
+    parser.add_argument('--models', nargs='+', required=True, help='XMem checkpoints, the first one is the reference')
+    parser.add_argument('--s2m_models', nargs='+', default=[], help='S2M checkpoints, the first one is the reference')
+    parser.add_argument('--frames_with_masks', nargs='+', type=int, default=[0])
+    parser.add_argument('--size', type=int, default=480)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.set_grad_enabled(False)
+
+    reference = None
+    for model in args.models:
+        frames, masks, fps = run_xmem(args, model)
+        if reference is None:
+            gt = load_gt(args.gt, frames, masks[0].shape) if args.gt is not None else masks
+            reference = (j_and_f(masks, gt), fps)
+            report(model, reference[0], None, fps, None, 'fps')
+        else:
+            report(model, j_and_f(masks, gt), reference[0], fps, reference[1], 'fps')
+
+    if len(args.s2m_models) > 0:
+        # the interactions are at the processing size, as in the GUI
+        vid_reader = VideoReader('', args.video, args.masks, size=args.size, use_all_masks=True)
+        mapper = MaskMapper()
+        scribble_frames = [load_frame(vid_reader, mapper, ti) for ti in sorted(args.frames_with_masks)]
+        interactions = list(iter_scribble_interactions(scribble_frames))
+        num_objects = len(mapper.labels)
+        reference = None
+        for model in args.s2m_models:
+            masks, seconds = run_s2m(model, interactions, num_objects)
+            if reference is None:
+                gt = masks
+                reference = (j_and_f(masks, gt), seconds)
+                report(model, reference[0], None, seconds, None, 's_per_interaction')
+            else:
+                report(model, j_and_f(masks, gt), reference[0], seconds, reference[1], 's_per_interaction')
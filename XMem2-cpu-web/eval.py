@@ -12,7 +12,7 @@ from PIL import Image
 from inference.data.test_datasets import LongTestDataset, DAVISTestDataset, YouTubeVOSTestDataset
 from inference.data.mask_mapper import MaskMapper
 from model.network import XMem
-from inference.inference_core import InferenceCore
+from inference.inference_core import InferenceCore, prepare_network
 
 from progressbar import progressbar
 
@@ -140,6 +140,8 @@ if args.model is not None:
     network.load_weights(model_weights, init_as_zero_if_needed=True)
 else:
     print('No model loaded.')
+# shared by the processors of all videos, see PreparedNetwork
+prepared = prepare_network(network, config)
 
 total_process_time = 0
 total_frames = 0
@@ -160,7 +162,7 @@ for vid_reader in progressbar(meta_loader, max_value=len(meta_dataset), redirect
     )
 
     mapper = MaskMapper()
-    processor = InferenceCore(network, config=config)
+    processor = InferenceCore(network, config=config, prepared=prepared)
     first_mask_loaded = False
 
     for ti, data in enumerate(loader):
@@ -0,0 +1,31 @@
+"""
+Exports the XMem stages (key encoder, value encoder, decoder) as TorchScript or ONNX graphs, see model/export.py
+
+The ONNX graphs can be run through ONNX Runtime with config['network_backend'] = 'onnxruntime'
+and config['exported_model_dir'] = the output directory (TorchScript: 'torchscript'), e.g.:
+
+python export_model.py --model saves/XMem.pth --format onnx --output saves/XMem_onnx
+"""
+
+import argparse
+
+import torch
+
+from model.export import export_network
+from model.network import XMem
+from util.configuration import VIDEO_INFERENCE_CONFIG
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default=VIDEO_INFERENCE_CONFIG['model'], help='Weights to export')
+    parser.add_argument('--format', choices=['onnx', 'torchscript'], default='onnx')
+    parser.add_argument('--output', required=True, help='Directory for the graphs')
+    parser.add_argument('--opset_version', type=int, default=14)
+    args = parser.parse_args()
+
+    config = VIDEO_INFERENCE_CONFIG.copy()
+    network = XMem(config, args.model, pretrained_key_encoder=False, pretrained_value_encoder=False).eval()
+    paths = export_network(network, args.output, format=args.format, opset_version=args.opset_version)
+    for name, path in paths.items():
+        print(f'{name}: {path}')
@@ -0,0 +1,82 @@
+from contextlib import nullcontext
+from warnings import warn
+
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+# None: the network as is (float32, NCHW)
+# 'channels_last': convolutions fused with their batch norms, weights and activations in channels_last (NHWC)
+# 'bf16': 'channels_last' and bfloat16 autocast, the outputs of the network are still float32
+CPU_PROFILES = (None, 'channels_last', 'bf16')
+
+
+def bf16_supported():
+    # oneDNN bfloat16 kernels need avx512_bf16/amx (or at least avx512 with emulation)
+    if not torch.backends.mkldnn.is_available():
+        return False
+    is_supported = getattr(torch.ops.mkldnn, '_is_mkldnn_bf16_supported', None)
+    return is_supported is None or bool(is_supported())
+
+
+def fuse_conv_bn(network: nn.Module):
+    # folds every batch norm into the convolution right before it (convN -> bnN in the ResNet blocks and encoders,
+    # and the downsampling Sequential(conv, bn)), so that oneDNN runs a single convolution
+    # only valid in eval mode; returns the number of fused pairs
+    fused = 0
+    for module in list(network.modules()):
+        if isinstance(module, nn.Sequential):
+            pairs = [(str(i), str(i+1)) for i in range(len(module)-1)]
+        else:
+            pairs = [(name, 'bn' + name[len('conv'):]) for name, _ in module.named_children() if name.startswith('conv')]
+        for conv_name, bn_name in pairs:
+            conv = getattr(module, conv_name, None)
+            bn = getattr(module, bn_name, None)
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                setattr(module, conv_name, fuse_conv_bn_eval(conv, bn))
+                setattr(module, bn_name, nn.Identity())
+                fused += 1
+    return fused
+
+
+def apply_cpu_profile(network: nn.Module, profile):
+    # converts `network` (in place, in eval mode) for `profile`, see CPU_PROFILES
+    # returns the profile that is actually used, 'bf16' falls back to 'channels_last' where it is not supported
+    if profile not in CPU_PROFILES:
+        raise ValueError(f'Unknown cpu_profile: {profile}, expected one of {CPU_PROFILES}')
+    if profile is None:
+        return None
+    if profile == 'bf16' and not bf16_supported():
+        warn('bfloat16 is not supported on this CPU, using the channels_last profile instead')
+        profile = 'channels_last'
+
+    network.eval()
+    fuse_conv_bn(network)
+    network.to(memory_format=torch.channels_last)
+    return profile
+
+
+def cpu_autocast(profile):
+    # context for running the network with `profile`
+    if profile == 'bf16':
+        return torch.autocast('cpu', dtype=torch.bfloat16)
+    return nullcontext()
+
+
+def to_input(x, profile):
+    # 4D network inputs are passed as channels_last, so that the first convolution does not convert them
+    if isinstance(x, (tuple, list)):
+        return type(x)(to_input(t, profile) for t in x)
+    if profile is not None and isinstance(x, torch.Tensor) and x.dim() == 4:
+        return x.contiguous(memory_format=torch.channels_last)
+    return x
+
+
+def to_output(x, profile):
+    # back to contiguous float32 tensors, as the memory and the post-processing expect
+    if profile is None or x is None:
+        return x
+    if isinstance(x, (tuple, list)):
+        return type(x)(to_output(t, profile) for t in x)
+    return x.float().contiguous()
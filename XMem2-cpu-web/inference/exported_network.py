@@ -0,0 +1,65 @@
+import hashlib
+import os
+
+import torch
+
+from model.export import GRAPHS, graph_path
+from model.network import XMem
+
+
+class ExportedXMem:
+    """
+    The inference interface of XMem (encode_key, encode_value, segment) over the graphs from model/export.py
+
+    runtime 'onnxruntime' runs the .onnx graphs with ONNX Runtime's CPU execution provider,
+    'torchscript' the .pt graphs with torch.jit. The memory is managed by InferenceCore as with the eager network.
+    """
+
+    def __init__(self, directory, runtime='onnxruntime', num_threads=None):
+        if runtime not in ('onnxruntime', 'torchscript'):
+            raise ValueError(f'Unknown runtime: {runtime}')
+        self.runtime = runtime
+        self.paths = {name: graph_path(directory, name, 'onnx' if runtime == 'onnxruntime' else 'torchscript') for name in GRAPHS}
+        missing = [path for path in self.paths.values() if not os.path.exists(path)]
+        if len(missing) > 0:
+            raise FileNotFoundError(f'Missing exported graphs: {missing}, see export_model.py')
+
+        if runtime == 'onnxruntime':
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = num_threads or torch.get_num_threads()
+            self.graphs = {name: onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+                           for name, path in self.paths.items()}
+        else:
+            self.graphs = {name: torch.jit.load(path, map_location='cpu').eval() for name, path in self.paths.items()}
+
+    def run_graph(self, name, *inputs):
+        # runs one of the exported graphs (see model/export.py) on torch tensors, returns a tuple of its outputs
+        if self.runtime == 'torchscript':
+            return self.graphs[name](*inputs)
+        input_names = GRAPHS[name][1]
+        outputs = self.graphs[name].run(None, {n: x.detach().cpu().float().contiguous().numpy() for n, x in zip(input_names, inputs)})
+        return tuple(torch.from_numpy(output) for output in outputs)
+
+    def encode_key(self, frame, need_sk=True, need_ek=True):
+        # frame: B*3*H*W
+        key, shrinkage, selection, f16, f8, f4 = self.run_graph('key_encoder', frame)
+        return key, shrinkage if need_sk else None, selection if need_ek else None, f16, f8, f4
+
+    def encode_value(self, frame, image_feat_f16, h16, masks, is_deep_update=True):
+        g16, new_h16 = self.run_graph('value_encoder', frame, image_feat_f16, h16, masks, XMem.get_other_masks(masks))
+        return g16, new_h16 if is_deep_update else h16
+
+    def segment(self, multi_scale_features, memory_readout, hidden_state, selector=None, h_out=True, strip_bg=True):
+        new_hidden_state, logits = self.run_graph('decoder', *multi_scale_features, hidden_state, memory_readout)
+        logits, prob = XMem.get_probabilities(logits, selector, strip_bg)
+        return new_hidden_state if h_out else None, logits, prob
+
+    def state_dict(self):
+        # hashes of the graph files, e.g., for the model checksum of the feature cache
+        state = {}
+        for name, path in self.paths.items():
+            with open(path, 'rb') as f:
+                state[name] = hashlib.sha1(f.read()).hexdigest()
+        return state
@@ -0,0 +1,158 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+
+def model_checksum(network: torch.nn.Module):
+    # hash of all weights and buffers, so that cached features of other weights are never reused
+    checksum = hashlib.sha1()
+    for name, value in sorted(network.state_dict().items()):
+        checksum.update(name.encode())
+        _update_checksum(checksum, value)
+    return checksum.hexdigest()
+
+
+def _update_checksum(checksum, value):
+    if isinstance(value, torch.Tensor):
+        checksum.update(str(value.dtype).encode())
+        if value.is_quantized:
+            # int8 weights of quantized networks (see inference/quantization.py), with their scales
+            value = value.dequantize()
+        checksum.update(value.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy())
+    elif isinstance(value, (tuple, list)):
+        # e.g., the packed (weight, bias) of quantized linear layers
+        for item in value:
+            _update_checksum(checksum, item)
+    else:
+        checksum.update(repr(value).encode())
+
+
+def frame_hash(image: torch.Tensor):
+    # hash of the network input of a frame (3*H*W), i.e., of the video frame at the processing resolution
+    frame = hashlib.sha1(str((tuple(image.shape), image.dtype)).encode())
+    frame.update(image.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy())
+    return frame.hexdigest()
+
+
+class FeatureCache:
+    """
+    Persistent on-disk cache of the key path outputs of XMem.encode_key (key, shrinkage, selection, f16, f8, f4)
+
+    The key path only depends on the frame and the weights, so its outputs can be reused across runs over the same video,
+    e.g., between extract_keys for candidate selection and the propagation, or between annotation rounds.
+    Entries are content-addressed: by the hash of the network input of a frame (which covers the video, the frame and the resolution),
+    in a subdirectory per model checksum. Every output is stored as an .npy file, which is memory-mapped when read.
+    At 480p, this takes ~47MB of disk per frame, most of it for f8 and f4.
+    With `max_bytes`, the least recently used frames (of any model checksum, so the ones of old weights go first)
+    are removed once the whole cache directory grows past it
+    """
+    names = ('key', 'shrinkage', 'selection', 'f16', 'f8', 'f4')
+    # fraction of max_bytes left after an eviction, so that not every save has to scan the directory
+    evict_to = 0.9
+
+    def __init__(self, directory: str, network: torch.nn.Module, checksum: str = None, max_bytes: int = None):
+        # checksum: model_checksum(network) if already known
+        self.root = directory
+        self.directory = os.path.join(directory, checksum if checksum is not None else model_checksum(network))
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        # size of the whole cache directory, as of the last scan plus what this process saved since
+        # (other processes sharing the directory are accounted for on the next scan)
+        self.nbytes = self._total_bytes(self._scan()) if max_bytes is not None else None
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, frame: str, name: str):
+        return os.path.join(self.directory, frame[:2], f'{frame}.{name}.npy')
+
+    def load(self, frame: str):
+        # the outputs for one frame (each with a batch dimension of 1), or None if not cached
+        # 'key' is written last, so the other files are complete if it exists
+        if not os.path.exists(self._path(frame, 'key')):
+            return None
+        try:
+            # copy-on-write mapping, the tensors are writable without touching the files
+            features = tuple(torch.from_numpy(np.load(self._path(frame, name), mmap_mode='c')) for name in self.names)
+            if self.max_bytes is not None:
+                # the modification time of 'key' is the last use of the frame, for the eviction
+                os.utime(self._path(frame, 'key'))
+            return features
+        except (OSError, ValueError):
+            return None  # incomplete (or just evicted) entry, will be overwritten
+
+    def save(self, frame: str, features):
+        os.makedirs(os.path.dirname(self._path(frame, 'key')), exist_ok=True)
+        for name, feature in sorted(zip(self.names, features), key=lambda nf: nf[0] == 'key'):
+            # written to a temporary file first, so that concurrent readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self._path(frame, name)), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, feature.detach().cpu().numpy())
+            if self.max_bytes is not None:
+                self.nbytes += os.path.getsize(tmp_path)
+            os.replace(tmp_path, self._path(frame, name))
+        if self.max_bytes is not None and self.nbytes > self.max_bytes:
+            self.evict()
+
+    def _scan(self):
+        # (frame directory, frame) -> [(path, size, mtime)] of the cached files in the whole cache directory
+        entries = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                parts = filename.split('.')
+                if len(parts) != 3 or parts[1] not in self.names or parts[2] != 'npy':
+                    continue  # e.g., the temporary file of a save in progress
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue  # removed in the meantime
+                entries.setdefault((dirpath, parts[0]), []).append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    @staticmethod
+    def _total_bytes(entries):
+        return sum(size for files in entries.values() for _, size, _ in files)
+
+    def evict(self):
+        # removes the least recently used frames until the cache directory is below evict_to * max_bytes
+        entries = self._scan()
+        self.nbytes = self._total_bytes(entries)
+        target = self.evict_to * self.max_bytes
+        for (dirpath, frame), files in sorted(entries.items(), key=lambda entry: max(mtime for _, _, mtime in entry[1])):
+            if self.nbytes <= target:
+                break
+            # 'key' first, so that readers see the entry as missing rather than incomplete
+            for path, size, _ in sorted(files, key=lambda f: not f[0].endswith('.key.npy')):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                self.nbytes -= size
+            for directory in (dirpath, os.path.dirname(dirpath)):
+                if directory != self.root:
+                    try:
+                        os.rmdir(directory)  # only if empty, e.g., the directory of old weights
+                    except OSError:
+                        pass
+
+    def get_or_encode(self, images: torch.Tensor, encode):
+        # images: B*3*H*W, encode(images) -> the outputs of XMem.encode_key for them (with need_ek=need_sk=True)
+        # only the frames that are not cached yet are encoded, in one batch
+        frames = [frame_hash(image) for image in images]
+        features = [self.load(frame) for frame in frames]
+        missing = [i for i, f in enumerate(features) if f is None]
+        self.hits += len(frames) - len(missing)
+        self.misses += len(missing)
+
+        if len(missing) > 0:
+            encoded = encode(images[missing])
+            for j, i in enumerate(missing):
+                features[i] = tuple(f[j:j+1] for f in encoded)
+                self.save(frames[i], features[i])
+
+        if len(features) == 1:
+            return tuple(f.to(images.device) for f in features[0])
+        return tuple(torch.cat(f, 0).to(images.device) for f in zip(*features))
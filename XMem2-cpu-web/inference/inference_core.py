@@ -1,6 +1,12 @@
+import os
+from dataclasses import dataclass
 from time import perf_counter
+from typing import Optional, Union
 
 import torch
+from inference.cpu_profile import apply_cpu_profile, cpu_autocast, to_input, to_output
+from inference.exported_network import ExportedXMem
+from inference.feature_cache import FeatureCache, model_checksum
 from inference.memory_manager import MemoryManager
 from model.network import XMem
 from model.aggregate import aggregate
@@ -8,8 +14,32 @@ from model.aggregate import aggregate
 from util.tensor_util import pad_divide_by, unpad
 
 
+@dataclass
+class PreparedNetwork:
+    """What runs a network for InferenceCore, shared by all processors of the network (see ModelRegistry)"""
+    backend: Union[XMem, ExportedXMem]
+    cpu_profile: Optional[str] = None
+    checksum: Optional[str] = None  # model_checksum of the backend, computed with the first feature cache
+    warmed_up: bool = False
+
+
+def prepare_network(network: XMem, config: dict):
+    # what runs the network: 'torch' for `network` itself, or 'onnxruntime'/'torchscript' for the graphs
+    # exported to config['exported_model_dir'] with export_model.py, see ExportedXMem
+    network_backend = config.get('network_backend', 'torch')
+    if network_backend == 'torch':
+        # CPU execution profile of the network (see inference/cpu_profile.py), converts the network in place
+        # before the feature cache, as the cache is per model checksum
+        if getattr(network, 'quantization', None) is not None and config.get('cpu_profile', None) is not None:
+            raise ValueError('cpu_profile does not apply to quantized networks (see inference/quantization.py)')
+        return PreparedNetwork(network, apply_cpu_profile(network, config.get('cpu_profile', None)))
+    if config.get('cpu_profile', None) is not None:
+        raise ValueError('cpu_profile only applies to the torch network_backend')
+    return PreparedNetwork(ExportedXMem(config.get('exported_model_dir', None), runtime=network_backend))
+
+
 class InferenceCore:
-    def __init__(self, network:XMem, config):
+    def __init__(self, network:XMem, config, prepared: Optional[PreparedNetwork] = None):
         self.config = config
         self.network = network
         self.mem_every = config['mem_every']
@@ -22,8 +52,24 @@ class InferenceCore:
         self.clear_memory()
         self.all_labels = None
 
-        # warmup
-        self.network.encode_key(torch.zeros((1, 3, 480, 854), device='cpu'))
+        # the backend, feature cache checksum and warmup are shared by the processors of one network, see ModelRegistry
+        self.prepared = prepared if prepared is not None else prepare_network(network, config)
+        self.backend = self.prepared.backend
+        self.cpu_profile = self.prepared.cpu_profile
+
+        # persistent cache of the key path outputs, see FeatureCache
+        feature_cache_dir = config.get('feature_cache_dir', None)
+        if feature_cache_dir is not None:
+            if self.prepared.checksum is None:
+                self.prepared.checksum = model_checksum(self.backend)
+            self.feature_cache = FeatureCache(feature_cache_dir, self.backend, checksum=self.prepared.checksum,
+                                              max_bytes=config.get('feature_cache_max_bytes', None))
+        else:
+            self.feature_cache = None
+
+        if not self.prepared.warmed_up:
+            self._run_network(self.backend.encode_key, torch.zeros((1, 3, 480, 854), device='cpu'))
+            self.prepared.warmed_up = True
 
     def clear_memory(self, keep_permanent=False):
         self.curr_ti = -1
@@ -46,20 +92,83 @@ class InferenceCore:
         self.deep_update_sync = (self.deep_update_every < 0)
         self.memory.update_config(config)
 
+    def state_dict(self):
+        # the full inference state: memory, hidden state and frame counters
+        state = {
+            'memory': self.memory.state_dict(),
+            'curr_ti': self.curr_ti,
+            'last_mem_ti': self.last_mem_ti,
+            'all_labels': list(self.all_labels) if self.all_labels is not None else None,
+        }
+        if not self.deep_update_sync:
+            state['last_deep_update_ti'] = self.last_deep_update_ti
+        return state
+
+    def load_state_dict(self, state, keep_permanent_memory=False):
+        # keep_permanent_memory: continues from `state` with the current permanent memory and labels,
+        # e.g., after the annotations were edited and preloaded again
+        self.memory.load_state_dict(state['memory'], keep_permanent=keep_permanent_memory)
+        self.curr_ti = state['curr_ti']
+        self.last_mem_ti = state['last_mem_ti']
+        if not keep_permanent_memory:
+            self.all_labels = state['all_labels']
+        elif self.memory.get_hidden() is not None:
+            # objects that were added with the edit start with an empty hidden state
+            self.memory.create_hidden_state(len(self.all_labels), self.memory.get_hidden())
+        if not self.deep_update_sync:
+            self.last_deep_update_ti = state.get('last_deep_update_ti', self.curr_ti)
+
+    def save_checkpoint(self, path, **extra):
+        # extra: anything else to save along, returned by load_checkpoint
+        # written to a temporary file first, so that a crash while saving keeps the previous checkpoint
+        tmp_path = f'{path}.tmp'
+        torch.save({'inference': self.state_dict(), **extra}, tmp_path)
+        os.replace(tmp_path, path)
+
+    def load_checkpoint(self, path):
+        # resumes right after the last frame processed before save_checkpoint, returns the extras
+        checkpoint = torch.load(path, map_location='cpu')
+        self.load_state_dict(checkpoint.pop('inference'))
+        return checkpoint
+
     def set_all_labels(self, all_labels):
         # self.all_labels = [l.item() for l in all_labels]
         self.all_labels = all_labels
 
+    def _encode_key(self, images, need_ek=True):
+        # the key path of the network for B*3*H*W (padded) images, through the feature cache if enabled
+        if self.feature_cache is not None:
+            # the cache always keeps all outputs
+            return self.feature_cache.get_or_encode(images, lambda x: self._run_network(self.backend.encode_key, x, need_ek=True, need_sk=True))
+        return self._run_network(self.backend.encode_key, images, need_ek=need_ek, need_sk=True)
+
+    def _run_network(self, func, *args, **kwargs):
+        # calls a part of the network with the CPU profile, the outputs are float32 in any case
+        if self.cpu_profile is None:
+            return func(*args, **kwargs)
+        with cpu_autocast(self.cpu_profile):
+            return to_output(func(*to_input(args, self.cpu_profile), **kwargs), self.cpu_profile)
+
     def encode_frame_key(self, image):
         image, self.pad = pad_divide_by(image, 16)
         image = image.unsqueeze(0)  # add the batch dimension
 
-        key, shrinkage, selection, f16, f8, f4 = self.network.encode_key(image,
-                                                                         need_ek=True,
-                                                                         need_sk=True)
+        key, shrinkage, selection, f16, f8, f4 = self._encode_key(image)
 
         return key, shrinkage, selection
-    def step(self, image, mask=None, valid_labels=None, end=False, manually_curated_masks=False, disable_memory_updates=False, do_not_add_mask_to_memory=False, return_key_and_stuff=False):
+
+    def encode_frame_keys(self, images):
+        # batched key encoding of upcoming frames (a list of 3*H*W images of the same size)
+        # the key path does not depend on the memory, so it can run ahead of step()
+        # returns a (key, shrinkage, selection, f16, f8, f4) tuple per frame, to be passed to step() as `key_features`
+        images = torch.stack([pad_divide_by(image, 16)[0] for image in images], 0)
+        key, shrinkage, selection, f16, f8, f4 = self._encode_key(images)
+        return [
+            (key[i:i+1], shrinkage[i:i+1], selection[i:i+1], f16[i:i+1], f8[i:i+1], f4[i:i+1])
+            for i in range(images.shape[0])
+        ]
+
+    def step(self, image, mask=None, valid_labels=None, end=False, manually_curated_masks=False, disable_memory_updates=False, do_not_add_mask_to_memory=False, return_key_and_stuff=False, key_features=None, ti=None):
         # For feedback:
         #   1. We run the model as usual
         #   2. We get feedback: 2 lists, one with good prediction indices, one with bad
@@ -68,6 +177,7 @@ class InferenceCore:
         #   5. Rerun with these settings 
         # image: 3*H*W
         # mask: num_objects*H*W or None
+        # ti: video frame index of the image, for the temporal selection of permanent frames (see MemoryManager)
         self.curr_ti += 1
             
         image, self.pad = pad_divide_by(image, 16)
@@ -86,9 +196,12 @@ class InferenceCore:
         ) and (not end)
         is_normal_update = (not self.deep_update_sync or not is_deep_update) and (not end)
 
-        key, shrinkage, selection, f16, f8, f4 = self.network.encode_key(image, 
-                                                    need_ek=(self.enable_long_term or need_segment), 
-                                                    need_sk=True)
+        if key_features is not None:
+            # precomputed with encode_frame_keys
+            key, shrinkage, selection, f16, f8, f4 = key_features
+        else:
+            key, shrinkage, selection, f16, f8, f4 = self._encode_key(image, 
+                                                        need_ek=(self.enable_long_term or need_segment))
         multi_scale_features = (f16, f8, f4)
 
         if disable_memory_updates:
@@ -99,8 +212,8 @@ class InferenceCore:
 
         # segment the current frame is needed
         if need_segment:
-            memory_readout = self.memory.match_memory(key, selection, disable_usage_updates=disable_memory_updates).unsqueeze(0)
-            hidden, _, pred_prob_with_bg = self.network.segment(multi_scale_features, memory_readout, 
+            memory_readout = self.memory.match_memory(key, selection, disable_usage_updates=disable_memory_updates, ti=ti).unsqueeze(0)
+            hidden, _, pred_prob_with_bg = self._run_network(self.backend.segment, multi_scale_features, memory_readout, 
                                     self.memory.get_hidden(), h_out=is_normal_update, strip_bg=False)
             # remove batch dim
             pred_prob_with_bg = pred_prob_with_bg[0]
@@ -133,7 +246,7 @@ class InferenceCore:
 
         # save as memory if needed
         if is_mem_frame:
-            value, hidden = self.network.encode_value(image, f16, self.memory.get_hidden(), 
+            value, hidden = self._run_network(self.backend.encode_value, image, f16, self.memory.get_hidden(), 
                                     pred_prob_with_bg[1:].unsqueeze(0), is_deep_update=is_deep_update)
             self.memory.add_memory(key, shrinkage, value, self.all_labels, 
                                     selection=selection if self.enable_long_term else None, ignore=is_ignore)
@@ -154,16 +267,14 @@ class InferenceCore:
     def put_to_permanent_memory(self, image, mask, ti=None):
         image, self.pad = pad_divide_by(image, 16)
         image = image.unsqueeze(0) # add the batch dimension
-        key, shrinkage, selection, f16, f8, f4 = self.network.encode_key(image, 
-                                            need_ek=True, 
-                                            need_sk=True)
+        key, shrinkage, selection, f16, f8, f4 = self._encode_key(image)
 
         mask, _ = pad_divide_by(mask, 16)
 
         pred_prob_with_bg = aggregate(mask, dim=0)
         self.memory.create_hidden_state(len(self.all_labels), key)
 
-        value, hidden = self.network.encode_value(image, f16, self.memory.get_hidden(), 
+        value, hidden = self._run_network(self.backend.encode_value, image, f16, self.memory.get_hidden(), 
                                     pred_prob_with_bg[1:].unsqueeze(0), is_deep_update=False)
         
         is_update = self.memory.frame_already_saved(ti)
@@ -177,7 +288,41 @@ class InferenceCore:
         # print(self.memory.permanent_work_mem.key.shape)
 
         return is_update
-    
+
+    def put_to_permanent_memory_batch(self, images, masks, batch_size=None, times=None):
+        # put_to_permanent_memory for a list of new 3*H*W images of the same size and their num_objects*H*W masks,
+        # all with the current labels. Encoded in batches of `batch_size` (all at once if None),
+        # and added to the permanent memory in one write
+        # times: the video frame index of each image, if known
+        padded = [pad_divide_by(image, 16) for image in images]
+        self.pad = padded[-1][1]
+        images = torch.stack([image for image, _ in padded], 0)
+        masks = torch.stack([pad_divide_by(mask, 16)[0] for mask in masks], 0)
+        batch_size = batch_size or len(images)
+
+        keys, shrinkages, selections, values = [], [], [], []
+        for start in range(0, len(images), batch_size):
+            image = images[start:start+batch_size]
+            key, shrinkage, selection, f16, f8, f4 = self._encode_key(image)
+
+            pred_prob_with_bg = aggregate(masks[start:start+batch_size], dim=1)
+            self.memory.create_hidden_state(len(self.all_labels), key)
+            hidden = self.memory.get_hidden().expand(len(image), -1, -1, -1, -1)
+
+            value, _ = self._run_network(self.backend.encode_value, image, f16, hidden, pred_prob_with_bg[:, 1:], is_deep_update=False)
+            keys.append(key)
+            shrinkages.append(shrinkage)
+            selections.append(selection)
+            values.append(value)
+
+        # B*C*H*W -> 1*C*B*H*W, B*num_objects*C*H*W -> 1*num_objects*C*B*H*W
+        key = torch.cat(keys, 0).transpose(0, 1).unsqueeze(0)
+        shrinkage = torch.cat(shrinkages, 0).transpose(0, 1).unsqueeze(0)
+        selection = torch.cat(selections, 0).transpose(0, 1).unsqueeze(0)
+        value = torch.cat(values, 0).permute(1, 2, 0, 3, 4).unsqueeze(0)
+        self.memory.add_memory(key, shrinkage, value, self.all_labels,
+                               selection=selection if self.enable_long_term else None, permanent=True, num_frames=len(images), times=times)
+
     def remove_from_permanent_memory(self, frame_idx):
         self.memory.remove_from_permanent_memory(frame_idx)
     
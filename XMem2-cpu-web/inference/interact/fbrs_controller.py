@@ -1,11 +1,28 @@
+import os
+
 import torch
 from .fbrs.controller import InteractiveController
 from .fbrs.inference import utils
+from util.shared_weights import load_shared
+
+
+def load_shared_is_model(checkpoint_path, device, shared_weights_dir):
+    # the RITM model with its weights in a file mapping shared by all processes on the node, see util/shared_weights.py
+    # only the first process reads the checkpoint, the others build the model from the (shared) state itself
+    stat = os.stat(checkpoint_path)
+    key = (os.path.abspath(checkpoint_path), stat.st_size, stat.st_mtime_ns)
+    load = lambda: (utils.load_is_model(checkpoint_path, device, cpu_dist_maps=True, norm_radius=260), {})
+    build = lambda state, _: utils.load_is_model(state, device, cpu_dist_maps=True, norm_radius=260)
+    model, _ = load_shared(shared_weights_dir, 'fbrs', key, load, build)
+    return model
 
 
 class FBRSController:
-    def __init__(self, checkpoint_path, device='cpu', max_size=800):
-        model = utils.load_is_model(checkpoint_path, device, cpu_dist_maps=True, norm_radius=260)
+    def __init__(self, checkpoint_path, device='cpu', max_size=800, shared_weights_dir=None):
+        if shared_weights_dir is None:
+            model = utils.load_is_model(checkpoint_path, device, cpu_dist_maps=True, norm_radius=260)
+        else:
+            model = load_shared_is_model(checkpoint_path, device, shared_weights_dir)
 
         # Predictor params
         zoomin_params = {
@@ -37,7 +37,7 @@ from PyQt5.QtCore import Qt, QTimer, QThreadPool, QRegExp
 
 from model.network import XMem
 
-from inference.inference_core import InferenceCore
+from inference.inference_core import InferenceCore, PreparedNetwork
 from .s2m_controller import S2MController
 from .fbrs_controller import FBRSController
 
@@ -51,7 +51,8 @@ class App(QWidget):
     def __init__(self, net: XMem, 
                 resource_manager: ResourceManager, 
                 s2m_ctrl:S2MController, 
-                fbrs_ctrl:FBRSController, config):
+                fbrs_ctrl:FBRSController, config,
+                prepared: PreparedNetwork = None):
         super().__init__()
 
         self.initialized = False
@@ -59,7 +60,8 @@ class App(QWidget):
         self.s2m_controller = s2m_ctrl
         self.fbrs_controller = fbrs_ctrl
         self.config = config
-        self.processor = InferenceCore(net, config)
+        # prepared: the PreparedNetwork of net if it is already prepared, e.g., from MODEL_REGISTRY.get
+        self.processor = InferenceCore(net, config, prepared=prepared)
         self.processor.set_all_labels(list(range(1, self.num_objects+1)))
         self.res_man = resource_manager
         self.threadpool = QThreadPool()
@@ -756,7 +758,7 @@ class App(QWidget):
         self.console_push_text('Propagation started.')
         is_mask = self.cursur in self.reference_ids
         msk = self.current_prob[1:] if self.cursur in self.reference_ids else None
-        current_prob, key, shrinkage, selection = self.processor.step(self.current_image_torch, msk, return_key_and_stuff=True)
+        current_prob, key, shrinkage, selection = self.processor.step(self.current_image_torch, msk, return_key_and_stuff=True, ti=self.cursur)
         if not is_mask:
             self.current_prob = current_prob
         self.res_man.add_key_and_stuff_with_mask(self.cursur, key, shrinkage, selection, self.current_prob[1:])
@@ -776,7 +778,7 @@ class App(QWidget):
             self.load_current_torch_image_mask(no_mask=True)
             is_mask = self.cursur in self.reference_ids
             msk = self.current_prob[1:] if self.cursur in self.reference_ids else None
-            current_prob, key, shrinkage, selection = self.processor.step(self.current_image_torch, msk, return_key_and_stuff=True)
+            current_prob, key, shrinkage, selection = self.processor.step(self.current_image_torch, msk, return_key_and_stuff=True, ti=self.cursur)
             self.res_man.add_key_and_stuff_with_mask(self.cursur, key, shrinkage, selection, self.current_prob[1:])
 
             if not is_mask:
@@ -1,5 +1,230 @@
+import math
+import os
+import tempfile
 import torch
-from typing import List
+from typing import List, Optional
+
+from model.memory_util import get_similarity_terms
+
+
+class MappedAllocator:
+    """
+    Allocates tensors backed by memory-mapped files in `directory`
+    The files are unlinked right away: the mapping keeps them alive until the tensor is freed,
+    and nothing is left behind if the process dies. Their pages can be written back and evicted
+    by the OS under memory pressure instead of counting towards the anonymous memory of the process
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory if directory is not None else tempfile.gettempdir()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __call__(self, shape, dtype: torch.dtype):
+        fd, path = tempfile.mkstemp(dir=self.directory, prefix='xmem_memory_', suffix='.bin')
+        os.close(fd)
+        try:
+            tensor = torch.from_file(path, shared=True, size=max(math.prod(shape), 1), dtype=dtype)
+        finally:
+            os.unlink(path)
+        return tensor[:math.prod(shape)].view(shape)
+
+
+class GrowingBuffer:
+    """
+    Preallocated tensor storage that grows along the last dimension
+    Only the first `size` elements are valid; `data` returns a view of them
+    Capacity is doubled when full, so appending is amortized O(new elements)
+    instead of re-copying everything with torch.cat
+    The storage comes from `allocator(shape, dtype)` if given (e.g., MappedAllocator), else from regular memory
+    """
+
+    def __init__(self, init: torch.Tensor, min_capacity: int = 16, allocator=None):
+        self.allocator = allocator
+        self.size = init.shape[-1]
+        capacity = max(self.size, min_capacity)
+        self.buffer = self._allocate((*init.shape[:-1], capacity), init)
+        self.buffer[..., :self.size] = init
+
+    def _allocate(self, shape, like: torch.Tensor):
+        if self.allocator is None:
+            return like.new_empty(shape)
+        return self.allocator(shape, like.dtype)
+
+    @property
+    def capacity(self):
+        return self.buffer.shape[-1]
+
+    @property
+    def stored(self):
+        # the valid elements as they are stored
+        return self.buffer[..., :self.size]
+
+    @property
+    def data(self):
+        return self.stored
+
+    @property
+    def stored_scale(self):
+        # per-element scales of int8 storage, see QuantizedBuffer
+        return None
+
+    @property
+    def nbytes(self):
+        return self.buffer.numel() * self.buffer.element_size()
+
+    def _reserve(self, new_size: int):
+        if new_size <= self.capacity:
+            return
+        capacity = max(new_size, 2 * self.capacity)
+        new_buffer = self._allocate((*self.buffer.shape[:-1], capacity), self.buffer)
+        new_buffer[..., :self.size] = self.stored
+        self.buffer = new_buffer
+
+    def move_to(self, allocator):
+        # re-allocates the storage with `allocator`, which is also used for any further growth
+        self.allocator = allocator
+        new_buffer = self._allocate(self.buffer.shape, self.buffer)
+        new_buffer[..., :self.size] = self.stored
+        self.buffer = new_buffer
+
+    def append(self, x: torch.Tensor):
+        n = x.shape[-1]
+        self._reserve(self.size + n)
+        self.buffer[..., self.size:self.size+n] = x
+        self.size += n
+
+    def keep_outside(self, start: int, end: int):
+        # keep only a[:start] and a[end:], shifting the tail down in-place
+        # start/end follow python slicing rules (negative values count from the end)
+        start, end, _ = slice(start, end).indices(self.size)
+        if end <= start:
+            return
+        tail = self.size - end
+        if tail > 0:
+            # clone as source and destination may overlap
+            self.buffer[..., start:start+tail] = self.buffer[..., end:self.size].clone()
+        self.size = start + tail
+
+    def write(self, start: int, end: int, x: torch.Tensor):
+        # overwrite the elements in [start, end)
+        self.stored[..., start:end] = x
+
+    def truncate(self, size: int):
+        self.size = min(self.size, size)
+
+    def keep_mask(self, mask: torch.Tensor):
+        kept = self.stored[..., mask]
+        self.size = kept.shape[-1]
+        self.buffer[..., :self.size] = kept
+
+    def state_dict(self):
+        # only the valid elements (cloned, as saving a view would save the whole buffer), see load_buffer
+        return {'data': self.stored.clone()}
+
+
+class QuantizedBuffer(GrowingBuffer):
+    """
+    GrowingBuffer that keeps its elements in reduced precision
+    float16/bfloat16 are plain casts. int8 is symmetric with one float32 scale per element
+    (i.e., per memory element and leading index, over the channel dimension -2), so that
+    appended elements never require re-quantizing the existing ones
+    `data` dequantizes to the input dtype; readout can instead use `stored`/`stored_scale` directly
+    """
+
+    def __init__(self, init: torch.Tensor, dtype: torch.dtype, min_capacity: int = 16, allocator=None):
+        self.dtype = dtype
+        self.out_dtype = init.dtype
+        stored, scale = self._quantize(init)
+        super().__init__(stored, min_capacity, allocator)
+        self.scale = GrowingBuffer(scale, min_capacity, allocator) if scale is not None else None
+
+    @classmethod
+    def from_stored(cls, stored: torch.Tensor, scale: Optional[torch.Tensor], out_dtype: torch.dtype, allocator=None):
+        # from already quantized elements, see state_dict
+        buffer = cls.__new__(cls)
+        buffer.dtype = stored.dtype
+        buffer.out_dtype = out_dtype
+        GrowingBuffer.__init__(buffer, stored, allocator=allocator)
+        buffer.scale = GrowingBuffer(scale, allocator=allocator) if scale is not None else None
+        return buffer
+
+    def _quantize(self, x):
+        if self.dtype != torch.int8:
+            return x.to(self.dtype), None
+        scale = x.abs().amax(dim=-2, keepdim=True).clamp(min=1e-12) / 127
+        return torch.round(x / scale).to(torch.int8), scale
+
+    @property
+    def data(self):
+        # a dequantized copy, not a view
+        if self.scale is None:
+            return self.stored.to(self.out_dtype)
+        return self.stored.to(self.out_dtype) * self.scale.stored
+
+    @property
+    def stored_scale(self):
+        return self.scale.stored if self.scale is not None else None
+
+    @property
+    def nbytes(self):
+        return super().nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    def append(self, x: torch.Tensor):
+        stored, scale = self._quantize(x)
+        super().append(stored)
+        if self.scale is not None:
+            self.scale.append(scale)
+
+    def move_to(self, allocator):
+        super().move_to(allocator)
+        if self.scale is not None:
+            self.scale.move_to(allocator)
+
+    def write(self, start: int, end: int, x: torch.Tensor):
+        stored, scale = self._quantize(x)
+        super().write(start, end, stored)
+        if self.scale is not None:
+            self.scale.write(start, end, scale)
+
+    def keep_outside(self, start: int, end: int):
+        super().keep_outside(start, end)
+        if self.scale is not None:
+            self.scale.keep_outside(start, end)
+
+    def truncate(self, size: int):
+        super().truncate(size)
+        if self.scale is not None:
+            self.scale.truncate(size)
+
+    def keep_mask(self, mask: torch.Tensor):
+        super().keep_mask(mask)
+        if self.scale is not None:
+            self.scale.keep_mask(mask)
+
+    def state_dict(self):
+        # the quantized elements, not the dequantized ones
+        return {
+            'data': self.stored.clone(),
+            'scale': self.stored_scale.clone() if self.scale is not None else None,
+            'out_dtype': str(self.out_dtype).replace('torch.', ''),
+        }
+
+
+def make_buffer(init: torch.Tensor, dtype: Optional[torch.dtype] = None, allocator=None):
+    # GrowingBuffer, or QuantizedBuffer if a storage dtype other than the input's is requested
+    if dtype is None or dtype == init.dtype:
+        return GrowingBuffer(init, allocator=allocator)
+    return QuantizedBuffer(init, dtype, allocator=allocator)
+
+
+def load_buffer(state: Optional[dict], allocator=None):
+    # inverse of GrowingBuffer/QuantizedBuffer.state_dict
+    if state is None:
+        return None
+    if 'out_dtype' in state:
+        return QuantizedBuffer.from_stored(state['data'], state['scale'], getattr(torch, state['out_dtype']), allocator)
+    return GrowingBuffer(state['data'], allocator=allocator)
+
 
 class KeyValueMemoryStore:
     """
@@ -15,45 +240,88 @@ class KeyValueMemoryStore:
     For YouTubeVOS, there can be multiple object groups
     """
 
-    def __init__(self, count_usage: bool):
+    def __init__(self, count_usage: bool, value_dtype: Optional[torch.dtype] = None):
         self.count_usage = count_usage
-
-        # keys are stored in a single tensor and are shared between groups/objects
-        # values are stored as a list indexed by object groups
+        # storage precision of the values, None to keep the input's
+        # keys and selection always stay in full precision, as consolidation builds the long-term prototypes from them
+        self.value_dtype = value_dtype
+        # allocator of all buffers once the store is spilled to disk, see spill()
+        self.allocator = None
+
+        # keys are stored in a single buffer and are shared between groups/objects
+        # values are stored as a list of buffers indexed by object groups
+        # all buffers are preallocated and grow geometrically, see GrowingBuffer
         self.k = None
+        # memory-side similarity terms (see get_similarity_terms), kept in sync with keys/shrinkage
+        # so that readout does not re-derive the squared keys over the whole bank for every query
+        self.sim_terms = None
+        # every add() is a memory "frame" (a video frame, or a batch of long-term prototypes)
+        # fid holds the frame index of every element and f_terms the similarity terms of each frame's pooled key,
+        # used to pick the relevant frames before the full readout
+        # f_time holds the video frame index of each frame, -1 if not given (e.g., long-term prototypes)
+        self.fid = None
+        self.f_terms = None
+        self.f_time = None
+        self.num_frames = 0
         self.v = []
         self.obj_groups = []
         # for debugging only
         self.all_objects = []
 
-        # shrinkage and selection are also single tensors
+        # shrinkage and selection are also single buffers
         self.s = self.e = None
 
         # usage
         if self.count_usage:
             self.use_count = self.life_count = None
 
-    def add(self, key, value, shrinkage, selection, objects: List[int]):
+        # bumped whenever keys/values change, used by readers to invalidate cached views
+        # usage updates do not count as they do not change the readout
+        self.version = 0
+        # bumped by every change other than appending, i.e., when existing elements move or change
+        self.rewrite_version = 0
+
+    def add(self, key, value, shrinkage, selection, objects: List[int], num_frames: int = 1, times: Optional[List[int]] = None):
+        # num_frames: number of frames (of equal size) concatenated in key/value, each gets its own frame id
+        # times: the video frame index of each of them, if known
         new_count = torch.zeros((key.shape[0], 1, key.shape[2]), device=key.device, dtype=torch.float32)
         new_life = torch.zeros((key.shape[0], 1, key.shape[2]), device=key.device, dtype=torch.float32) + 1e-7
 
+        self.version += 1
+
+        frame_size = key.shape[2] // num_frames
+        new_fid = (self.num_frames + torch.arange(num_frames, device=key.device)).repeat_interleave(frame_size)
+        new_fid = new_fid.expand(key.shape[0], 1, key.shape[2]).clone()
+        new_f_terms = self._get_pooled_terms(key, shrinkage, num_frames)
+        new_f_time = torch.tensor(times if times is not None else [-1] * num_frames, device=key.device, dtype=torch.long)
+        new_f_time = new_f_time.expand(key.shape[0], 1, num_frames).clone()
+        self.num_frames += num_frames
+
         # add the key
         if self.k is None:
-            self.k = key
-            self.s = shrinkage
-            self.e = selection
+            self.k = make_buffer(key, allocator=self.allocator)
+            self.sim_terms = make_buffer(get_similarity_terms(key, shrinkage), allocator=self.allocator)
+            self.fid = make_buffer(new_fid, allocator=self.allocator)
+            self.f_terms = make_buffer(new_f_terms, allocator=self.allocator)
+            self.f_time = make_buffer(new_f_time, allocator=self.allocator)
+            self.s = make_buffer(shrinkage, allocator=self.allocator) if shrinkage is not None else None
+            self.e = make_buffer(selection, allocator=self.allocator) if selection is not None else None
             if self.count_usage:
-                self.use_count = new_count
-                self.life_count = new_life
+                self.use_count = make_buffer(new_count, allocator=self.allocator)
+                self.life_count = make_buffer(new_life, allocator=self.allocator)
         else:
-            self.k = torch.cat([self.k, key], -1)
+            self.k.append(key)
+            self.sim_terms.append(get_similarity_terms(key, shrinkage))
+            self.fid.append(new_fid)
+            self.f_terms.append(new_f_terms)
+            self.f_time.append(new_f_time)
             if shrinkage is not None:
-                self.s = torch.cat([self.s, shrinkage], -1)
+                self.s.append(shrinkage)
             if selection is not None:
-                self.e = torch.cat([self.e, selection], -1)
+                self.e.append(selection)
             if self.count_usage:
-                self.use_count = torch.cat([self.use_count, new_count], -1)
-                self.life_count = torch.cat([self.life_count, new_life], -1)
+                self.use_count.append(new_count)
+                self.life_count.append(new_life)
 
         # add the value
         if objects is not None:
@@ -67,12 +335,12 @@ class KeyValueMemoryStore:
                 for obj in group:
                     # should properly raise an error if there are overlaps in obj_groups
                     remaining_objects.remove(obj)
-                self.v[gi] = torch.cat([self.v[gi], value[group]], -1)
+                self.v[gi].append(value[group])
 
             # If there are remaining objects, add them as a new group
             if len(remaining_objects) > 0:
                 new_group = list(remaining_objects)
-                self.v.append(value[new_group])
+                self.v.append(make_buffer(value[new_group], self.value_dtype, self.allocator))
                 self.obj_groups.append(new_group)
                 self.all_objects.extend(new_group)
                 
@@ -85,37 +353,55 @@ class KeyValueMemoryStore:
                 if gv is None:
                     continue
                 if gi < self.num_groups:
-                    self.v[gi] = torch.cat([self.v[gi], gv], -1)
+                    self.v[gi].append(gv)
                 else:
-                    self.v.append(gv)
+                    self.v.append(make_buffer(gv, self.value_dtype, self.allocator))
 
-        pos = int((self.k.shape[-1] + 1e-9) // (key.shape[-1] + 1e-9)) - 1  # index of newly added frame
+        pos = int((self.size + 1e-9) // (frame_size + 1e-9)) - 1  # index of (the last) newly added frame
 
         return pos
 
+    def _get_pooled_terms(self, key, shrinkage, num_frames: int = 1):
+        # similarity terms of the average key (and shrinkage) of each frame
+        if key.shape[-1] == 0:
+            key = key.new_zeros((*key.shape[:-1], 1))
+            shrinkage = None
+        else:
+            key = key.reshape(*key.shape[:-1], num_frames, -1).mean(-1)
+            shrinkage = shrinkage.reshape(*shrinkage.shape[:-1], num_frames, -1).mean(-1) if shrinkage is not None else None
+        return get_similarity_terms(key, shrinkage)
+
     def update_usage(self, usage):
         # increase all life count by 1
         # increase use of indexed elements
         if not self.count_usage:
             return
         
-        self.use_count += usage.view_as(self.use_count)
-        self.life_count += 1
+        use_count = self.use_count.data
+        use_count += usage.view_as(use_count)
+        self.life_count.data.add_(1)
 
     def replace_at(self, start_pos: int, key, value, shrinkage=None, selection=None):
         start = start_pos * key.shape[-1]
         end = (start_pos + 1) * key.shape[-1]
+        self.version += 1
+        self.rewrite_version += 1
 
-        self.k[:,:,start:end] = key
+        self.k.write(start, end, key)
 
         for gi in range(self.num_groups):
-            self.v[gi][:, :, start:end] = value[gi]
+            self.v[gi].write(start, end, value[gi])
 
         if self.s is not None and shrinkage is not None:
-            self.s[:, :, start:end] = shrinkage
+            self.s.write(start, end, shrinkage)
         
         if self.e is not None and selection is not None:
-            self.e[:, :, start:end] = selection
+            self.e.write(start, end, selection)
+
+        shrinkage = self.s.data[:, :, start:end] if self.s is not None else None
+        self.sim_terms.write(start, end, get_similarity_terms(key, shrinkage))
+        frame = self.fid.data[0, 0, start].item()
+        self.f_terms.write(frame, frame+1, self._get_pooled_terms(key, shrinkage))
 
     def remove_at(self, start: int, elem_size: int):
         end = start + elem_size
@@ -127,65 +413,78 @@ class KeyValueMemoryStore:
         # i.e., concat (a[:start], a[end:])
         # min_size is only used for values, we do not sieve values under this size
         # (because they are not consolidated)
+        # the kept tail is shifted down inside the buffers, so this costs O(tail) instead of O(bank)
+        self.version += 1
+        self.rewrite_version += 1
 
         if end == 0:
             # just sieves till the `start`
             # negative 0 would not work as the end index!
-            self.k = self.k[:,:,:start]
+            self.k.truncate(start)
+            self.sim_terms.truncate(start)
+            self.fid.truncate(start)
             if self.count_usage:
-                self.use_count = self.use_count[:,:,:start]
-                self.life_count = self.life_count[:,:,:start]
+                self.use_count.truncate(start)
+                self.life_count.truncate(start)
             if self.s is not None:
-                self.s = self.s[:,:,:start]
+                self.s.truncate(start)
             if self.e is not None:
-                self.e = self.e[:,:,:start]
+                self.e.truncate(start)
             
             for gi in range(self.num_groups):
-                if self.v[gi].shape[-1] >= min_size:
-                    self.v[gi] = self.v[gi][:,:,:start]
+                if self.v[gi].size >= min_size:
+                    self.v[gi].truncate(start)
         else:
-            self.k = torch.cat([self.k[:,:,:start], self.k[:,:,end:]], -1)
+            self.k.keep_outside(start, end)
+            self.sim_terms.keep_outside(start, end)
+            self.fid.keep_outside(start, end)
             if self.count_usage:
-                self.use_count = torch.cat([self.use_count[:,:,:start], self.use_count[:,:,end:]], -1)
-                self.life_count = torch.cat([self.life_count[:,:,:start], self.life_count[:,:,end:]], -1)
+                self.use_count.keep_outside(start, end)
+                self.life_count.keep_outside(start, end)
             if self.s is not None:
-                self.s = torch.cat([self.s[:,:,:start], self.s[:,:,end:]], -1)
+                self.s.keep_outside(start, end)
             if self.e is not None:
-                self.e = torch.cat([self.e[:,:,:start], self.e[:,:,end:]], -1)
+                self.e.keep_outside(start, end)
             
             for gi in range(self.num_groups):
-                if self.v[gi].shape[-1] >= min_size:
-                    self.v[gi] = torch.cat([self.v[gi][:,:,:start], self.v[gi][:,:,end:]], -1)
+                if self.v[gi].size >= min_size:
+                    self.v[gi].keep_outside(start, end)
 
     def remove_obsolete_features(self, max_size: int):
+        if self.size <= max_size:
+            return
+
         # normalize with life duration
         usage = self.get_usage().flatten()
 
         values, _ = torch.topk(usage, k=(self.size-max_size), largest=False, sorted=True)
         survived = (usage > values[-1])
+        self.version += 1
+        self.rewrite_version += 1
 
-        self.k = self.k[:, :, survived]
-        self.s = self.s[:, :, survived] if self.s is not None else None
-        # Long-term memory does not store ek so this should not be needed
-        self.e = self.e[:, :, survived] if self.e is not None else None
-        if self.num_groups > 1:
-            raise NotImplementedError("""The current data structure does not support feature removal with 
-            multiple object groups (e.g., some objects start to appear later in the video)
-            The indices for "survived" is based on keys but not all values are present for every key
-            Basically we need to remap the indices for keys to values
-            """)
+        # later object groups only have values for the last get_v_size(gi) keys
+        # (they entered the video later), so the key mask is remapped by aligning it with the end
+        # done before the keys are masked, as it needs the old size
         for gi in range(self.num_groups):
-            self.v[gi] = self.v[gi][:, :, survived]
+            self.v[gi].keep_mask(survived[self.size-self.v[gi].size:])
 
-        self.use_count = self.use_count[:, :, survived]
-        self.life_count = self.life_count[:, :, survived]
+        self.k.keep_mask(survived)
+        self.sim_terms.keep_mask(survived)
+        self.fid.keep_mask(survived)
+        if self.s is not None:
+            self.s.keep_mask(survived)
+        # Long-term memory does not store ek so this should not be needed
+        if self.e is not None:
+            self.e.keep_mask(survived)
+        self.use_count.keep_mask(survived)
+        self.life_count.keep_mask(survived)
 
     def get_usage(self):
         # return normalized usage
         if not self.count_usage:
             raise RuntimeError('I did not count usage!')
         else:
-            usage = self.use_count / self.life_count
+            usage = self.use_count.data / self.life_count.data
             return usage
 
     def get_all_sliced(self, start: int, end: int):
@@ -193,20 +492,66 @@ class KeyValueMemoryStore:
 
         if end == 0:
             # negative 0 would not work as the end index!
-            k = self.k[:,:,start:]
-            sk = self.s[:,:,start:] if self.s is not None else None
-            ek = self.e[:,:,start:] if self.e is not None else None
+            k = self.key[:,:,start:]
+            sk = self.shrinkage[:,:,start:] if self.s is not None else None
+            ek = self.selection[:,:,start:] if self.e is not None else None
             usage = self.get_usage()[:,:,start:]
         else:
-            k = self.k[:,:,start:end]
-            sk = self.s[:,:,start:end] if self.s is not None else None
-            ek = self.e[:,:,start:end] if self.e is not None else None
+            k = self.key[:,:,start:end]
+            sk = self.shrinkage[:,:,start:end] if self.s is not None else None
+            ek = self.selection[:,:,start:end] if self.e is not None else None
             usage = self.get_usage()[:,:,start:end]
 
         return k, sk, ek, usage
 
+    # all buffers other than the values, by attribute name
+    buffer_names = ('k', 'sim_terms', 'fid', 'f_terms', 'f_time', 's', 'e', 'use_count', 'life_count')
+
+    def state_dict(self):
+        # compact snapshot: only the valid elements, in their storage precision
+        return {
+            'buffers': {name: getattr(self, name).state_dict() if getattr(self, name, None) is not None else None
+                        for name in self.buffer_names},
+            'v': [gv.state_dict() for gv in self.v],
+            'obj_groups': [list(group) for group in self.obj_groups],
+            'all_objects': list(self.all_objects),
+            'num_frames': self.num_frames,
+        }
+
+    def load_state_dict(self, state: dict):
+        for name, buffer_state in state['buffers'].items():
+            if name in ('use_count', 'life_count') and not self.count_usage:
+                continue
+            setattr(self, name, load_buffer(buffer_state, self.allocator))
+        self.v = [load_buffer(gv, self.allocator) for gv in state['v']]
+        self.obj_groups = [list(group) for group in state['obj_groups']]
+        self.all_objects = list(state['all_objects'])
+        self.num_frames = state['num_frames']
+        if self.k is not None and 'f_time' not in state['buffers']:
+            # saved before frame times were kept
+            self.f_time = make_buffer(torch.full((1, 1, self.num_frames), -1, dtype=torch.long), allocator=self.allocator)
+
+        self.version += 1
+        self.rewrite_version += 1
+
+    def spill(self, allocator):
+        # moves all buffers (and any future ones) to `allocator`, e.g., a MappedAllocator
+        self.allocator = allocator
+        for buffer in self._buffers():
+            buffer.move_to(allocator)
+
+    @property
+    def spilled(self):
+        return self.allocator is not None
+
+    def _buffers(self):
+        buffers = [self.k, self.sim_terms, self.fid, self.f_terms, self.f_time, self.s, self.e, *self.v]
+        if self.count_usage:
+            buffers += [self.use_count, self.life_count]
+        return [b for b in buffers if b is not None]
+
     def get_v_size(self, ni: int):
-        return self.v[ni].shape[2]
+        return self.v[ni].size
 
     def engaged(self):
         return self.k is not None
@@ -216,25 +561,57 @@ class KeyValueMemoryStore:
         if self.k is None:
             return 0
         else:
-            return self.k.shape[-1]
+            return self.k.size
 
     @property
     def num_groups(self):
         return len(self.v)
 
+    # the properties below hand out views into the preallocated buffers
+    # they are invalidated by the next add/sieve, so do not hold on to them
+
     @property
     def key(self):
-        return self.k
+        return self.k.data if self.k is not None else None
+
+    @property
+    def similarity_terms(self):
+        return self.sim_terms.data if self.sim_terms is not None else None
+
+    @property
+    def frame_ids(self):
+        # frame index of every element, 1 x 1 x N
+        return self.fid.data if self.fid is not None else None
+
+    @property
+    def frame_terms(self):
+        # pooled similarity terms of every frame ever added (indexed by frame_ids), 1 x D x num_frames
+        return self.f_terms.data if self.f_terms is not None else None
+
+    @property
+    def frame_times(self):
+        # video frame index of every frame ever added (indexed by frame_ids, -1 if unknown), 1 x 1 x num_frames
+        return self.f_time.data if self.f_time is not None else None
 
     @property
     def value(self):
-        return self.v
+        # dequantized copies if the values are stored in reduced precision
+        return [gv.data for gv in self.v]
+
+    @property
+    def stored_value(self):
+        # (values as stored, int8 scales or None) for every group, see QuantizedBuffer
+        return [(gv.stored, gv.stored_scale) for gv in self.v]
+
+    @property
+    def nbytes(self):
+        # allocated bytes of all buffers
+        return sum(b.nbytes for b in self._buffers())
 
     @property
     def shrinkage(self):
-        return self.s
+        return self.s.data if self.s is not None else None
 
     @property
     def selection(self):
-        return self.e
-
+        return self.e.data if self.e is not None else None
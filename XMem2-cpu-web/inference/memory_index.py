@@ -0,0 +1,139 @@
+import torch
+
+from inference.kv_memory_store import KeyValueMemoryStore
+from model.memory_util import get_similarity_terms
+
+
+class IVFMemoryIndex:
+    """
+    Inverted-file index for approximate top-k memory readout
+
+    The XMem similarity is a (selection-weighted, shrinkage-scaled) negative L2 distance between keys,
+    so the memory keys of a KeyValueMemoryStore are clustered with k-means in the key space.
+    A query is scored against the centroid keys with the same similarity, and then only against
+    the elements of the `num_probes` most similar lists, using the store's similarity terms
+    (see get_similarity_terms).
+
+    The index follows the store incrementally: appended elements are assigned to the existing lists
+    and the centroids are updated as running means. Any other change (sieving, eviction, replacement)
+    re-assigns everything, warm-started from the previous centroids.
+    """
+
+    def __init__(self, num_lists: int, num_probes: int, kmeans_iters: int = 5):
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        self.kmeans_iters = kmeans_iters
+
+        # C x CK centroid keys, their similarity terms (D x C), and the number of elements assigned to each
+        self.centroids = None
+        self.centroid_terms = None
+        self.list_sizes = None
+        # N, the list index of every memory element
+        self.assignment = None
+        # memory elements sorted by their list, so that every list is a contiguous block
+        # sorted_terms: N x D, order: N (index into the store), offsets: C+1
+        self.sorted_terms = None
+        self.order = None
+        self.offsets = None
+
+        # state of the store when the index was last updated
+        self.store = None
+        self.version = None
+        self.rewrite_version = None
+        self.size = 0
+
+    def update(self, store: KeyValueMemoryStore):
+        if self.store is store and self.version == store.version:
+            return
+
+        keys = store.key[0].t()  # N x CK
+        if self.store is store and self.rewrite_version == store.rewrite_version and self.centroids is not None:
+            # only appended since the last update
+            self._add(keys[self.size:])
+        else:
+            self._rebuild(keys)
+
+        self.store = store
+        self.version = store.version
+        self.rewrite_version = store.rewrite_version
+        self.size = keys.shape[0]
+        self.centroid_terms = get_similarity_terms(self.centroids.t().unsqueeze(0), None)[0]
+        self._sort(store.similarity_terms[0].t())
+
+    def _assign(self, keys):
+        # nearest centroid by L2 distance: argmax(x.c - |c|^2/2)
+        scores = keys @ self.centroids.t() - 0.5 * self.centroids.pow(2).sum(1)
+        return scores.argmax(dim=1)
+
+    def _rebuild(self, keys):
+        num_lists = min(self.num_lists, keys.shape[0])
+        if self.centroids is None or self.centroids.shape[0] != num_lists:
+            # deterministic initialization with evenly spaced elements
+            init_idx = torch.linspace(0, keys.shape[0]-1, num_lists, device=keys.device).long()
+            self.centroids = keys[init_idx].clone()
+
+        for _ in range(self.kmeans_iters):
+            self.assignment = self._assign(keys)
+            self._update_centroids(keys)
+
+        self.assignment = self._assign(keys)
+        self.list_sizes = torch.bincount(self.assignment, minlength=self.centroids.shape[0])
+
+    def _update_centroids(self, keys):
+        sums = torch.zeros_like(self.centroids).index_add_(0, self.assignment, keys)
+        counts = torch.bincount(self.assignment, minlength=self.centroids.shape[0])
+        non_empty = counts > 0
+        # empty lists keep their old centroid
+        self.centroids[non_empty] = sums[non_empty] / counts[non_empty].unsqueeze(1).type_as(sums)
+
+    def _add(self, new_keys):
+        if new_keys.shape[0] == 0:
+            return
+        new_assignment = self._assign(new_keys)
+        new_sizes = torch.bincount(new_assignment, minlength=self.centroids.shape[0])
+        new_sums = torch.zeros_like(self.centroids).index_add_(0, new_assignment, new_keys)
+
+        # running mean of the centroids
+        total = (self.list_sizes + new_sizes).clamp(min=1).unsqueeze(1).type_as(new_sums)
+        has_new = new_sizes > 0
+        self.centroids[has_new] = ((self.centroids * self.list_sizes.unsqueeze(1).type_as(new_sums) + new_sums) / total)[has_new]
+
+        self.assignment = torch.cat([self.assignment, new_assignment], 0)
+        self.list_sizes = self.list_sizes + new_sizes
+
+    def _sort(self, terms):
+        self.order = torch.argsort(self.assignment, stable=True)
+        self.sorted_terms = terms[self.order]
+        self.offsets = torch.zeros(self.centroids.shape[0]+1, dtype=torch.long, device=terms.device)
+        self.offsets[1:] = torch.cumsum(self.list_sizes, 0)
+
+    def search(self, query_terms, top_k: int):
+        # query_terms: 1 x D x [HW/P], see get_similarity_query_terms
+        # returns the top-k similarities and their indices into the store, both 1 x top_k x [HW/P]
+        # queries with fewer than top_k candidates are padded with -inf similarities
+        q = query_terms[0]
+        num_queries = q.shape[1]
+
+        coarse = self.centroid_terms.t() @ q  # C x [HW/P]
+        coarse[self.list_sizes == 0] = -float('inf')
+        num_probes = min(self.num_probes, int((self.list_sizes > 0).sum()))
+        probes = torch.topk(coarse, k=num_probes, dim=0).indices  # num_probes x [HW/P]
+
+        values = torch.full((num_queries, num_probes, top_k), -float('inf'), device=q.device, dtype=q.dtype)
+        indices = torch.zeros((num_queries, num_probes, top_k), device=q.device, dtype=torch.long)
+        offsets = self.offsets.tolist()
+        for li in torch.unique(probes).tolist():
+            # all queries that probe this list, and at which rank
+            rank, qi = (probes == li).nonzero(as_tuple=True)
+            start, end = offsets[li], offsets[li+1]
+
+            similarity = self.sorted_terms[start:end] @ q[:, qi]  # list size x queries
+            list_k = min(top_k, end-start)
+            list_values, list_indices = torch.topk(similarity, k=list_k, dim=0)
+            values[qi, rank, :list_k] = list_values.t()
+            indices[qi, rank, :list_k] = self.order[start + list_indices].t()
+
+        values, best = torch.topk(values.flatten(start_dim=1), k=top_k, dim=1)
+        indices = torch.gather(indices.flatten(start_dim=1), 1, best)
+
+        return values.t().unsqueeze(0), indices.t().unsqueeze(0)
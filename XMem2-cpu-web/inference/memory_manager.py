@@ -1,7 +1,8 @@
 import torch
 import warnings
 
-from inference.kv_memory_store import KeyValueMemoryStore
+from inference.kv_memory_store import KeyValueMemoryStore, MappedAllocator
+from inference.memory_index import IVFMemoryIndex
 from model.memory_util import *
 
 
@@ -14,6 +15,9 @@ class MemoryManager:
         self.config = config
         self.hidden_dim = config['hidden_dim']
         self.top_k = config['top_k']
+        # IVF indexes for approximate top-k readout, by store name
+        self.ann_indexes = {}
+        self.set_readout_config(config)
 
         self.enable_long_term = config['enable_long_term']
         self.enable_long_term_usage = config['enable_long_term_count_usage']
@@ -31,18 +35,98 @@ class MemoryManager:
         # B x num_objects x CH x H x W
         self.hidden = None
 
-        self.temporary_work_mem = KeyValueMemoryStore(count_usage=self.enable_long_term)
-        self.permanent_work_mem = KeyValueMemoryStore(count_usage=False)
+        # storage precision of the memory values, e.g., 'bfloat16' or 'int8'; None keeps float32
+        value_dtype = self._get_storage_dtype(config.get('memory_value_dtype', None))
+        self.temporary_work_mem = KeyValueMemoryStore(count_usage=self.enable_long_term, value_dtype=value_dtype)
+        self.permanent_work_mem = KeyValueMemoryStore(count_usage=False, value_dtype=value_dtype)
         self.frame_id_to_permanent_mem_idx = dict()
         if self.enable_long_term:
-            self.long_mem = KeyValueMemoryStore(count_usage=self.enable_long_term_usage)
+            self.long_mem = KeyValueMemoryStore(count_usage=self.enable_long_term_usage, value_dtype=value_dtype)
+
+        # byte budget of the memory stores (and the readout view) in regular memory, None for no limit
+        # past it, the stores are spilled to memory-mapped files in memory_spill_dir (default: the temp directory),
+        # long-term memory first, then permanent and temporary memory
+        self.memory_budget_bytes = config.get('memory_budget_bytes', None)
+        self.spill_allocator = MappedAllocator(config.get('memory_spill_dir', None)) if self.memory_budget_bytes is not None else None
+
+        # concatenated (long-term, temporary, permanent) keys/shrinkage/values used for readout
+        # rebuilt only when one of the stores changes, i.e., on memory frames
+        # it is a second copy of the stores: with a memory budget, it is memory-mapped as soon as
+        # it does not fit next to the stores, before any store is spilled
+        self.readout_view = None
+        self.readout_view_version = None
+        self.readout_view_mapped = False
+        # pooled per-frame descriptors of all stores, for the coarse stage of the readout
+        self.frame_table = None
+        self.frame_table_version = None
 
         self.reset_config = True
 
+    @staticmethod
+    def _get_storage_dtype(name):
+        if name is None:
+            return None
+        dtype = getattr(torch, name, None)
+        if dtype not in (torch.float32, torch.float16, torch.bfloat16, torch.int8):
+            raise ValueError(f'Unsupported memory storage dtype: {name}')
+        return dtype
+
+    def _get_all_stores(self):
+        # in the order they are spilled to disk
+        stores = [self.long_mem] if self.enable_long_term else []
+        return stores + [self.permanent_work_mem, self.temporary_work_mem]
+
+    def memory_nbytes(self):
+        # allocated bytes of all memory stores (excluding the cached readout view)
+        return sum(store.nbytes for store in self._get_all_stores())
+
+    def memory_ram_nbytes(self):
+        # like memory_nbytes, but only what is in regular memory, i.e., not spilled to disk,
+        # including the cached readout view unless it is memory-mapped
+        nbytes = self._stores_ram_nbytes()
+        if self.readout_view is not None and not self.readout_view_mapped:
+            memory_terms, all_memory_value = self.readout_view
+            nbytes += memory_terms.nbytes
+            nbytes += sum(v.nbytes + (scale.nbytes if scale is not None else 0) for v, scale in all_memory_value)
+        return nbytes
+
+    def _stores_ram_nbytes(self):
+        return sum(store.nbytes for store in self._get_all_stores() if not store.spilled)
+
+    def _readout_view_nbytes(self, stores):
+        # size of the readout view concatenated from stores
+        nbytes = 0
+        for store in stores:
+            nbytes += store.similarity_terms.nbytes
+            nbytes += sum(v.nbytes + (scale.nbytes if scale is not None else 0) for v, scale in store.stored_value)
+        return nbytes
+
+    def _enforce_memory_budget(self):
+        # the readout view is not counted here: it is memory-mapped instead when it does not fit, see _get_readout_view
+        if self.memory_budget_bytes is None:
+            return
+        for store in self._get_all_stores():
+            if self._stores_ram_nbytes() <= self.memory_budget_bytes:
+                break
+            if not store.spilled and store.engaged():
+                store.spill(self.spill_allocator)
+                # the readout view has to follow
+                self.readout_view = None
+
+    @staticmethod
+    def _cat(tensors, dim, allocator=None):
+        # torch.cat for the readout view, into storage from allocator (e.g., memory-mapped) if given
+        if allocator is None:
+            return torch.cat(tensors, dim)
+        shape = list(tensors[0].shape)
+        shape[dim] = sum(t.shape[dim] for t in tensors)
+        return torch.cat(tensors, dim, out=allocator(shape, tensors[0].dtype))
+
     def update_config(self, config):
         self.reset_config = True
         self.hidden_dim = config['hidden_dim']
         self.top_k = config['top_k']
+        self.set_readout_config(config)
 
         assert self.enable_long_term == config['enable_long_term'], 'cannot update this'
         assert self.enable_long_term_usage == config['enable_long_term_count_usage'], 'cannot update this'
@@ -54,35 +138,189 @@ class MemoryManager:
             self.num_prototypes = config['num_prototypes']
             self.max_long_elements = config['max_long_term_elements']
 
-    def _readout(self, affinity, v):
+    def set_readout_config(self, config):
+        # approximate top-k readout with IVF indexes over the long-term/permanent memory
+        # ann_num_probes out of ann_num_lists lists are searched per query -- the accuracy/speed knob
+        self.ann_readout = config.get('ann_readout', False)
+        self.ann_num_lists = config.get('ann_num_lists', 128)
+        self.ann_num_probes = config.get('ann_num_probes', 8)
+        # keep only top-k weights and indices instead of a dense N x HW affinity
+        # approximate readout always produces such sparse affinities
+        self.sparse_readout = config.get('sparse_readout', False) or self.ann_readout
+        # approximate budget for the similarity matrix, None to read out all query positions at once
+        self.readout_chunk_bytes = config.get('readout_chunk_bytes', None)
+        # coarse-to-fine readout: only the elements of the M memory frames whose pooled keys are
+        # the most similar to the pooled query key are read out; None to read out all frames
+        self.readout_top_frames = config.get('readout_top_frames', None)
+        # readout from only the K annotated frames nearest to the query (with their augmentations) out of the permanent memory,
+        # 'temporal': nearest in the video, 'feature': with the most similar pooled key; None to read out all of them
+        # the other permanent frames stay in memory for later queries
+        self.permanent_top_frames = config.get('permanent_top_frames', None)
+        self.permanent_frame_selection = config.get('permanent_frame_selection', 'temporal')
+        if self.permanent_frame_selection not in ('temporal', 'feature'):
+            raise ValueError(f'Unknown permanent_frame_selection: {self.permanent_frame_selection}')
+
+        for index in self.ann_indexes.values():
+            index.num_probes = self.ann_num_probes
+
+    def _softmax(self, similarity, inplace=False, return_usage=False):
+        # top-k softmax for memory readout, sparse or dense depending on the config
+        if self.sparse_readout:
+            return do_softmax_topk(similarity, top_k=self.top_k, return_usage=return_usage)
+        return do_softmax(similarity, top_k=self.top_k, inplace=inplace, return_usage=return_usage)
+
+    def _readout(self, affinity, v, scale=None):
         # this function is for a single object group
-        return v @ affinity
+        # v (and its int8 scale) are in the storage precision of the memory stores
+        if isinstance(affinity, tuple):
+            # sparse (weights, indices) affinity from do_softmax_topk
+            return readout_topk(*affinity, v, scale)
+        if scale is None and v.dtype == affinity.dtype:
+            return v @ affinity
+        return readout_dense(affinity, v, scale)
+
+    def _get_readout_stores(self):
+        # (name, store) in the order they are concatenated for readout
+        stores = []
+        if self.enable_long_term and self.long_mem.engaged():
+            stores.append(('long', self.long_mem))
+        stores.append(('temporary', self.temporary_work_mem))
+        stores.append(('permanent', self.permanent_work_mem))
+        return stores
+
+    def _get_readout_view(self):
+        # returns (memory_terms, all_memory_value) concatenated over all stores
+        # memory_terms are the memory-side similarity terms, see get_similarity_terms
+        # all_memory_value holds a (value, int8 scale or None) pair per group, in the stores' storage precision
+        # cached and keyed by the stores' versions, so non-memory frames do not pay for the concatenation
+        stores = [store for _, store in self._get_readout_stores()]
+        version = tuple((store, store.version) for store in stores)
+
+        if self.readout_view is not None and self.readout_view_version == version:
+            return self.readout_view
+        # free the outdated view before building the new one
+        self.readout_view = None
+
+        # the view stays in regular memory if it fits in the budget next to the stores
+        allocator = None
+        if self.memory_budget_bytes is not None:
+            if self._stores_ram_nbytes() + self._readout_view_nbytes(stores) > self.memory_budget_bytes:
+                allocator = self.spill_allocator
 
-    def match_memory(self, query_key, selection, disable_usage_updates=False):
+        num_groups = max(self.temporary_work_mem.num_groups, self.permanent_work_mem.num_groups)
+        memory_terms = self._cat([store.similarity_terms for store in stores], -1, allocator)
+
+        all_memory_value = []
+        for gi in range(num_groups):
+            # merge the working and lt values before readout
+            # some groups are not (yet) present in the long-term memory
+            group_stored = [store.stored_value[gi] for store in stores if gi < store.num_groups]
+            if self.sparse_readout:
+                # keep the values token-major (N x CV) so that readout_topk gathers contiguous rows
+                group_v = self._cat([v.transpose(1, 2) for v, _ in group_stored], 1, allocator).transpose(1, 2)
+            else:
+                group_v = self._cat([v for v, _ in group_stored], -1, allocator)
+            # all stores share the same storage precision
+            group_scale = torch.cat([scale for _, scale in group_stored], -1) if group_stored[0][1] is not None else None
+            all_memory_value.append((group_v, group_scale))
+
+        self.readout_view = (memory_terms, all_memory_value)
+        self.readout_view_version = version
+        self.readout_view_mapped = allocator is not None
+        return self.readout_view
+
+    def match_memory(self, query_key, selection, disable_usage_updates=False, ti=None):
         # query_key: B x C^k x H x W
         # selection:  B x C^k x H x W
+        # ti: video frame index of the query, for the temporal selection of permanent frames
         # 1x64x30x54
-
-        # = permanent_work_mem.num_groups, since it's always >= temporary_work_mem.num_groups
-        num_groups = max(self.temporary_work_mem.num_groups, self.permanent_work_mem.num_groups)
         h, w = query_key.shape[-2:]
 
         query_key = query_key.flatten(start_dim=2)
         selection = selection.flatten(start_dim=2) if selection is not None else None
 
+        # = permanent_work_mem.num_groups, since it's always >= temporary_work_mem.num_groups
+        num_groups = max(self.temporary_work_mem.num_groups, self.permanent_work_mem.num_groups)
+        if (self.readout_top_frames is not None or self.permanent_top_frames is not None) and num_groups == 1:
+            # later object groups only see a subset of the keys, which the frame selection does not support
+            candidates = self._select_memory_frames(query_key, selection, ti)
+        else:
+            candidates = None
+
         """
         Memory readout using keys
+        Done in chunks of query positions if readout_chunk_bytes is set, to bound the size of the similarity matrix
+        Every query position is normalized independently, so chunking does not change the result
         """
+        num_queries = query_key.shape[-1]
+        chunk_size = self._get_readout_chunk_size(num_queries, query_key.element_size())
+
+        all_readout_mem = []
+        work_usage = long_usage = None
+        for start in range(0, num_queries, chunk_size):
+            end = start + chunk_size
+            readout_mem, chunk_work_usage, chunk_long_usage = self._match_memory_chunk(
+                query_key[:, :, start:end], selection[:, :, start:end] if selection is not None else None, candidates)
+            all_readout_mem.append(readout_mem)
+
+            if chunk_work_usage is not None:
+                work_usage = chunk_work_usage if work_usage is None else work_usage + chunk_work_usage
+            if chunk_long_usage is not None:
+                long_usage = chunk_long_usage if long_usage is None else long_usage + chunk_long_usage
+        all_readout_mem = torch.cat(all_readout_mem, -1) if len(all_readout_mem) > 1 else all_readout_mem[0]
+
+        """
+        Record memory usage for working and long-term memory
+        """
+        if not disable_usage_updates:
+            if work_usage is not None:
+                self.temporary_work_mem.update_usage(work_usage.flatten())
+            if long_usage is not None:
+                self.long_mem.update_usage(long_usage.flatten())
+
+        return all_readout_mem.view(all_readout_mem.shape[0], self.CV, h, w)
+
+    def _get_readout_chunk_size(self, num_queries, element_size):
+        if self.readout_chunk_bytes is None:
+            return num_queries
+
+        memory_size = self.temporary_work_mem.size + self.permanent_work_mem.size
+        if self.enable_long_term and self.long_mem.engaged():
+            memory_size += self.long_mem.size
+
+        if self.readout_top_frames is not None:
+            # an upper bound, not all frames are necessarily the same size
+            memory_size = min(memory_size, self.readout_top_frames * self.HW)
+
+        # each query position needs a column in the similarity matrix
+        # and another one in the affinity (or the per-group similarity)
+        bytes_per_query = 2 * memory_size * element_size
+        return max(1, min(num_queries, self.readout_chunk_bytes // max(bytes_per_query, 1)))
+
+    def _match_memory_chunk(self, query_key, selection, candidates=None):
+        # query_key: B x C^k x [HW/P]
+        # selection:  B x C^k x [HW/P]
+        # candidates: optional (indices, similarity terms) of the memory elements to read out from, see _select_memory_frames
+        # returns the readout (num_objects x C^v x [HW/P]) and the usage of working/long-term memory (or None)
+
+        # = permanent_work_mem.num_groups, since it's always >= temporary_work_mem.num_groups
+        num_groups = max(self.temporary_work_mem.num_groups, self.permanent_work_mem.num_groups)
+        work_usage = long_usage = None
+
+        if candidates is not None:
+            return self._readout_topk(*self._search_topk_in(query_key, selection, *candidates))
+        if self.ann_readout and num_groups == 1:
+            # later object groups only see a subset of the keys, which the indexes do not support
+            return self._readout_topk(*self._search_topk(query_key, selection))
 
         temp_work_mem_size = self.temporary_work_mem.size
         if self.enable_long_term and self.long_mem.engaged():
             # Use long-term memory
             long_mem_size = self.long_mem.size
 
-            memory_key = torch.cat([self.long_mem.key, self.temporary_work_mem.key, self.permanent_work_mem.key], -1)
-            shrinkage = torch.cat([self.long_mem.shrinkage, self.temporary_work_mem.shrinkage, self.permanent_work_mem.shrinkage], -1)
+            memory_terms, all_memory_value = self._get_readout_view()
 
-            similarity = get_similarity(memory_key, shrinkage, query_key, selection)
+            similarity = get_similarity_from_terms(memory_terms, query_key, selection)
 
             long_mem_similarity = similarity[:, :long_mem_size]
             temp_work_mem_similarity = similarity[:, long_mem_size:long_mem_size+temp_work_mem_size]
@@ -90,9 +328,9 @@ class MemoryManager:
 
             # get the usage with the first group
             # the first group always have all the keys valid
-            affinity, usage = do_softmax(
+            affinity, usage = self._softmax(
                 torch.cat([long_mem_similarity[:, -self.long_mem.get_v_size(0):], temp_work_mem_similarity, perm_work_mem_similarity], 1),
-                top_k=self.top_k, inplace=True, return_usage=True)
+                inplace=True, return_usage=True)
             affinity = [affinity]
 
             # compute affinity group by group as later groups only have a subset of keys
@@ -104,58 +342,40 @@ class MemoryManager:
 
                 if gi < self.long_mem.num_groups:
                     # merge working and lt similarities before softmax
-                    affinity_one_group = do_softmax(
+                    affinity_one_group = self._softmax(
                         torch.cat([long_mem_similarity[:, -self.long_mem.get_v_size(gi):],
                                    temp_work_mem_similarity[:, temp_sim_size-temp_group_v_size:],
                                    perm_work_mem_similarity[:, perm_sim_size-perm_group_v_size:]],
                                 dim=1),
-                        top_k=self.top_k, inplace=True)
+                        inplace=True)
                 else:
                     # no long-term memory for this group
-                    affinity_one_group = do_softmax(torch.cat([
+                    affinity_one_group = self._softmax(torch.cat([
                             temp_work_mem_similarity[:, temp_sim_size-temp_group_v_size:], 
                             perm_work_mem_similarity[:, perm_sim_size-perm_group_v_size:]],
                             1),
-                        top_k=self.top_k, inplace=(gi == num_groups-1))
+                        inplace=(gi == num_groups-1))
                 affinity.append(affinity_one_group)
 
-            all_memory_value = []
-            for gi in range(num_groups):
-                # merge the working and lt values before readout
-                if gi < self.long_mem.num_groups:
-                    all_memory_value.append(torch.cat([self.long_mem.value[gi], self.temporary_work_mem.value[gi], self.permanent_work_mem.value[gi]], -1))
-                else:
-                    all_memory_value.append(torch.cat([self.temporary_work_mem.value[gi], self.permanent_work_mem.value[gi]], -1))
-
-            """
-            Record memory usage for working and long-term memory
-            """
-            if not disable_usage_updates:
             # ignore the index return for long-term memory
-                work_usage = usage[:, long_mem_size:long_mem_size+temp_work_mem_size]  # no usage for permanent memory
-                self.temporary_work_mem.update_usage(work_usage.flatten())
+            work_usage = usage[:, long_mem_size:long_mem_size+temp_work_mem_size]  # no usage for permanent memory
 
-                if self.enable_long_term_usage:
-                    # ignore the index return for working memory
-                    long_usage = usage[:, :long_mem_size]
-                    self.long_mem.update_usage(long_usage.flatten())
+            if self.enable_long_term_usage:
+                # ignore the index return for working memory
+                long_usage = usage[:, :long_mem_size]
         else:
-            memory_key = torch.cat([self.temporary_work_mem.key, self.permanent_work_mem.key], -1)
-            shrinkage = torch.cat([self.temporary_work_mem.shrinkage, self.permanent_work_mem.shrinkage], -1)
+            memory_terms, all_memory_value = self._get_readout_view()
             # No long-term memory
-            similarity = get_similarity(memory_key, shrinkage, query_key, selection)
+            similarity = get_similarity_from_terms(memory_terms, query_key, selection)
             temp_work_mem_similarity = similarity[:, :temp_work_mem_size]
             perm_work_mem_similarity = similarity[:, temp_work_mem_size:]
 
             if self.enable_long_term:
-                affinity, usage = do_softmax(similarity, inplace=(num_groups == 1),
-                                             top_k=self.top_k, return_usage=True)
-                if not disable_usage_updates:
-                    # Record memory usage for working memory
-                    self.temporary_work_mem.update_usage(usage[:, :temp_work_mem_size].flatten())
+                affinity, usage = self._softmax(similarity, inplace=(num_groups == 1), return_usage=True)
+                # memory usage for working memory
+                work_usage = usage[:, :temp_work_mem_size]
             else:
-                affinity = do_softmax(similarity, inplace=(num_groups == 1),
-                                      top_k=self.top_k, return_usage=False)
+                affinity = self._softmax(similarity, inplace=(num_groups == 1), return_usage=False)
 
             affinity = [affinity]
 
@@ -166,28 +386,157 @@ class MemoryManager:
                 temp_sim_size = temp_work_mem_similarity.shape[1] 
                 perm_sim_size = perm_work_mem_similarity.shape[1] 
 
-                affinity_one_group = do_softmax(
+                affinity_one_group = self._softmax(
                     torch.cat([
                         # concats empty tensor if the group is also empty for temporary memory
                         temp_work_mem_similarity[:, temp_sim_size-temp_group_v_size:], 
                         perm_work_mem_similarity[:, perm_sim_size-perm_group_v_size:], 
                     ], dim=1),
-                    top_k=self.top_k, inplace=(gi == num_groups-1)
+                    inplace=(gi == num_groups-1)
                 )
                 affinity.append(affinity_one_group)
 
-            all_memory_value = []
-            for gi in range(num_groups):
-                group_v_cat = torch.cat([self.temporary_work_mem.value[gi], self.permanent_work_mem.value[gi]], -1)
-                all_memory_value.append(group_v_cat)
-
         # Shared affinity within each group
         all_readout_mem = torch.cat([
-            self._readout(affinity[gi], gv)
+            self._readout(affinity[gi], *gv)
             for gi, gv in enumerate(all_memory_value)
         ], 0)
 
-        return all_readout_mem.view(all_readout_mem.shape[0], self.CV, h, w)
+        return all_readout_mem, work_usage, long_usage
+
+    def _search_topk(self, query_key, selection):
+        # approximate top-k similarities over the concatenated (long-term, temporary, permanent) memory
+        # long-term/permanent stores with enough elements are searched through their IVF index,
+        # the (small, frequently changing) temporary memory is searched exactly
+        # returns values and indices into the readout view, both 1 x top_k x [HW/P]
+        query_terms = get_similarity_query_terms(query_key, selection)
+
+        all_values = []
+        all_indices = []
+        offset = 0
+        for name, store in self._get_readout_stores():
+            if store.size == 0:
+                continue
+            if name != 'temporary' and store.size >= self.ann_num_lists * self.top_k:
+                if name not in self.ann_indexes:
+                    self.ann_indexes[name] = IVFMemoryIndex(self.ann_num_lists, self.ann_num_probes)
+                index = self.ann_indexes[name]
+                index.update(store)
+                values, indices = index.search(query_terms, self.top_k)
+            else:
+                similarity = store.similarity_terms.transpose(1, 2) @ query_terms
+                values, indices = torch.topk(similarity, k=min(self.top_k, store.size), dim=1)
+            all_values.append(values)
+            all_indices.append(indices + offset)
+            offset += store.size
+
+        values, best = torch.topk(torch.cat(all_values, 1), k=self.top_k, dim=1)
+        indices = torch.gather(torch.cat(all_indices, 1), 1, best)
+        return values, indices
+
+    def _get_frame_table(self):
+        # pooled descriptors of the memory frames in all stores, cached like the readout view
+        # returns frame_terms (D x F, only frames that still have elements),
+        # token_frames (N, the index into frame_terms of every element in the readout view)
+        # and permanent_times (the video frame indices of the permanent frames, which are the last ones in frame_terms)
+        stores = [store for _, store in self._get_readout_stores()]
+        version = tuple((store, store.version) for store in stores)
+
+        if self.frame_table is not None and self.frame_table_version == version:
+            return self.frame_table
+
+        all_frame_terms = []
+        token_frames = []
+        offset = 0
+        for store in stores:
+            alive, inverse = torch.unique(store.frame_ids[0, 0], return_inverse=True)
+            all_frame_terms.append(store.frame_terms[0][:, alive])
+            token_frames.append(inverse + offset)
+            offset += alive.shape[0]
+            if store is self.permanent_work_mem:
+                permanent_times = store.frame_times[0, 0, alive]
+
+        self.frame_table = (torch.cat(all_frame_terms, 1), torch.cat(token_frames, 0), permanent_times)
+        self.frame_table_version = version
+        return self.frame_table
+
+    def _select_memory_frames(self, query_key, selection, ti=None):
+        # coarse stage of the readout: scores every memory frame with its pooled key against the pooled query key
+        # returns (indices, similarity terms) of the elements of the permanent_top_frames nearest annotated frames
+        # and then of the top readout_top_frames frames, or None if there is nothing to prune
+        frame_terms, token_frames, permanent_times = self._get_frame_table()
+        num_frames = frame_terms.shape[1]
+
+        pooled_key = query_key.mean(-1, keepdim=True)
+        pooled_selection = selection.mean(-1, keepdim=True) if selection is not None else None
+        scores = frame_terms.t() @ get_similarity_query_terms(pooled_key, pooled_selection)[0, :, 0]
+
+        keep = torch.ones(num_frames, dtype=torch.bool, device=scores.device)
+        if self.permanent_top_frames is not None:
+            num_permanent = permanent_times.shape[0]
+            keep[num_frames-num_permanent:] = self._select_permanent_frames(scores[num_frames-num_permanent:], permanent_times, ti)
+        if self.readout_top_frames is not None and int(keep.sum()) > self.readout_top_frames:
+            top_frames = torch.topk(scores.masked_fill(~keep, -float('inf')), k=self.readout_top_frames).indices
+            keep = torch.zeros(num_frames, dtype=torch.bool, device=scores.device)
+            keep[top_frames] = True
+        if keep.all():
+            return None
+
+        indices = keep[token_frames].nonzero()[:, 0]
+        if indices.shape[0] < self.top_k:
+            return None
+
+        memory_terms, _ = self._get_readout_view()
+        return indices, memory_terms[:, :, indices]
+
+    def _select_permanent_frames(self, scores, times, ti=None):
+        # scores, times: pooled key similarity and video frame index of every permanent frame
+        # returns which ones to read out: all frames of the permanent_top_frames nearest annotated frames, where
+        # the frames with the same time (an annotated frame and its augmentations) count as one
+        # frames without a time count as separate annotated frames, and are never temporally near
+        # without the query time, the temporal selection falls back to the feature-wise one
+        annotations = torch.where(times >= 0, times, -1 - torch.arange(times.shape[0], device=times.device))
+        annotations, annotation_of_frame = torch.unique(annotations, return_inverse=True)
+        if annotations.shape[0] <= self.permanent_top_frames:
+            return torch.ones_like(times, dtype=torch.bool)
+
+        if self.permanent_frame_selection == 'temporal' and ti is not None:
+            annotation_scores = -(annotations - ti).abs().float()
+            annotation_scores[annotations < 0] = -float('inf')
+        else:
+            # the best of the annotated frame and its augmentations
+            annotation_scores = torch.full(annotations.shape, -float('inf'), device=scores.device, dtype=scores.dtype)
+            annotation_scores = annotation_scores.scatter_reduce(0, annotation_of_frame, scores, reduce='amax')
+
+        nearest = torch.zeros(annotations.shape[0], dtype=torch.bool, device=times.device)
+        nearest[torch.topk(annotation_scores, k=self.permanent_top_frames).indices] = True
+        return nearest[annotation_of_frame]
+
+    def _search_topk_in(self, query_key, selection, indices, memory_terms):
+        # exact top-k similarities over a subset of the memory
+        # indices: the subset's indices into the readout view, memory_terms: its similarity terms
+        # returns values and indices into the readout view, both 1 x top_k x [HW/P]
+        similarity = get_similarity_from_terms(memory_terms, query_key, selection)
+        values, subset_indices = torch.topk(similarity, k=self.top_k, dim=1)
+        return values, indices[subset_indices]
+
+    def _readout_topk(self, values, indices):
+        # readout for a single object group from (possibly approximate or pruned) top-k similarities
+        # values/indices: 1 x top_k x [HW/P], indices are into the readout view
+        memory_terms, all_memory_value = self._get_readout_view()
+        affinity, usage = softmax_topk_values(values, indices, memory_terms.shape[-1], return_usage=True)
+
+        work_usage = long_usage = None
+        temp_work_mem_size = self.temporary_work_mem.size
+        if self.enable_long_term and self.long_mem.engaged():
+            long_mem_size = self.long_mem.size
+            work_usage = usage[:, long_mem_size:long_mem_size+temp_work_mem_size]
+            if self.enable_long_term_usage:
+                long_usage = usage[:, :long_mem_size]
+        elif self.enable_long_term:
+            work_usage = usage[:, :temp_work_mem_size]
+
+        return self._readout(affinity, *all_memory_value[0]).contiguous(), work_usage, long_usage
 
     def update_permanent_memory(self, frame_idx, key, shrinkage, value, selection=None):
         saved_pos = self.frame_id_to_permanent_mem_idx[frame_idx]
@@ -209,10 +558,15 @@ class MemoryManager:
 
         del self.frame_id_to_permanent_mem_idx[frame_idx]
 
-    def add_memory(self, key, shrinkage, value, objects, selection=None, permanent=False, ignore=False, ti=None):
+    def add_memory(self, key, shrinkage, value, objects, selection=None, permanent=False, ignore=False, ti=None, num_frames=1, times=None):
         # key: 1*C*H*W
         # value: 1*num_objects*C*H*W
         # objects contain a list of object indices
+        # num_frames > 1 adds several frames in one write, as key: 1*C*T*H*W and value: 1*num_objects*C*T*H*W
+        # (ti is then ignored)
+        # times: the video frame index of each added frame, defaults to ti
+        if times is None and ti is not None and num_frames == 1:
+            times = [ti]
         if self.H is None or self.reset_config:
             self.reset_config = False
             self.H, self.W = key.shape[-2:]
@@ -240,11 +594,11 @@ class MemoryManager:
             pass # all permanent frames are pre-placed into permanent memory (when using our memory modification) 
                 # also ignores the first frame (#0) when using original memory mechanism, since it's already in the permanent memory
         elif permanent:
-            pos = self.permanent_work_mem.add(key, value, shrinkage, selection, objects)
-            if ti is not None:
+            pos = self.permanent_work_mem.add(key, value, shrinkage, selection, objects, num_frames=num_frames, times=times)
+            if ti is not None and num_frames == 1:
                 self.frame_id_to_permanent_mem_idx[ti] = pos
         else:
-            self.temporary_work_mem.add(key, value, shrinkage, selection, objects)
+            self.temporary_work_mem.add(key, value, shrinkage, selection, objects, num_frames=num_frames, times=times)
             
         
         num_temp_groups = self.temporary_work_mem.num_groups
@@ -280,6 +634,8 @@ class MemoryManager:
                 # We NEVER remove anything from the working memory
                 self.compress_features()
 
+        self._enforce_memory_budget()
+
     def create_hidden_state(self, n, sample_key):
         # n is the TOTAL number of objects
         h, w = sample_key.shape[-2:]
@@ -302,6 +658,46 @@ class MemoryManager:
     def frame_already_saved(self, ti):
         return ti in self.frame_id_to_permanent_mem_idx
 
+    def state_dict(self):
+        # everything needed to continue inference from this point, see load_state_dict
+        stores = {'temporary': self.temporary_work_mem.state_dict(), 'permanent': self.permanent_work_mem.state_dict()}
+        if self.enable_long_term:
+            stores['long'] = self.long_mem.state_dict()
+        return {
+            'stores': stores,
+            'hidden': self.hidden.clone() if self.hidden is not None else None,
+            'frame_id_to_permanent_mem_idx': dict(self.frame_id_to_permanent_mem_idx),
+            'CK': self.CK, 'CV': self.CV,
+            'H': self.H, 'W': self.W,
+            'reset_config': self.reset_config,
+        }
+
+    def load_state_dict(self, state, keep_permanent=False):
+        # keep_permanent: keeps the current permanent memory instead of the saved one (e.g., preloaded again after an annotation was edited)
+        assert self.enable_long_term == ('long' in state['stores']), 'enable_long_term must match the saved state'
+        self.temporary_work_mem.load_state_dict(state['stores']['temporary'])
+        if not keep_permanent:
+            self.permanent_work_mem.load_state_dict(state['stores']['permanent'])
+            self.frame_id_to_permanent_mem_idx = dict(state['frame_id_to_permanent_mem_idx'])
+        if self.enable_long_term:
+            self.long_mem.load_state_dict(state['stores']['long'])
+
+        self.hidden = state['hidden']
+        self.CK, self.CV = state['CK'], state['CV']
+        self.H, self.W = state['H'], state['W']
+        self.reset_config = state['reset_config']
+        if self.H is not None:
+            self.HW = self.H*self.W
+            if self.enable_long_term:
+                self.min_work_elements = self.min_mt_frames*self.HW
+                self.max_work_elements = self.max_mt_frames*self.HW
+
+        # derived from the stores
+        self.readout_view = None
+        self.frame_table = None
+        self.ann_indexes = {}
+        self._enforce_memory_budget()
+
     # def slices_excluding_permanent(self, group_value, start, end):
     #     HW = self.HW
     #     group_value[:,:,HW:-self.min_work_elements+HW]
@@ -353,7 +749,9 @@ class MemoryManager:
 
         # find the indices with max usage
         _, max_usage_indices = torch.topk(usage, k=self.num_prototypes, dim=-1, sorted=True)
-        prototype_indices = max_usage_indices.flatten()
+        # in temporal order, so that the valid prototypes of later object groups (see below) are the last ones,
+        # like their values are aligned with the last keys in the memory stores
+        prototype_indices, _ = torch.sort(max_usage_indices.flatten())
 
         # Prototypes are invalid for out-of-bound groups
         validity = [prototype_indices >= (N-gv.shape[2]) if gv is not None else None for gv in candidate_value]
@@ -399,22 +797,19 @@ class MemoryManager:
         new_mem.frame_id_to_permanent_mem_idx = self.frame_id_to_permanent_mem_idx
         
         key0 = self.permanent_work_mem.key[..., 0:0]
-        value0 = self.permanent_work_mem.value[0][..., 0:0]
+        # an empty value buffer for every object group, so that both memories have the same groups
+        values0 = [gv[..., 0:0] for gv in self.permanent_work_mem.value]
         shrinkage0 = self.permanent_work_mem.shrinkage[..., 0:0] if self.permanent_work_mem.shrinkage is not None else None
         selection0 = self.permanent_work_mem.selection[..., 0:0] if self.permanent_work_mem.selection is not None else None
 
-        new_mem.temporary_work_mem.add(key0, value0, shrinkage0, selection0, self.permanent_work_mem.all_objects)
-
-        new_mem.CK = self.permanent_work_mem.key.shape[1]
-        new_mem.CV = self.permanent_work_mem.value[0].shape[1]
+        new_mem.temporary_work_mem.add(key0, values0, shrinkage0, selection0, objects=None)
+        new_mem.temporary_work_mem.obj_groups = [list(group) for group in self.permanent_work_mem.obj_groups]
+        new_mem.temporary_work_mem.all_objects = list(self.permanent_work_mem.all_objects)
 
         key_shape = self.permanent_work_mem.key.shape
         sample_key = self.permanent_work_mem.key[..., 0:self.HW].view(*key_shape[:-1], self.H, self.W)
         new_mem.create_hidden_state(len(self.permanent_work_mem.all_objects), sample_key)
 
-        new_mem.temporary_work_mem.obj_groups = self.temporary_work_mem.obj_groups
-        new_mem.temporary_work_mem.all_objects = self.temporary_work_mem.all_objects
-
 
         new_mem.CK = self.CK
         new_mem.CV = self.CV
@@ -0,0 +1,126 @@
+"""
+Process-wide registry of the loaded XMem networks, so that repeated runs (run_on_video, iter_video_masks,
+select_k_next_best_annotation_candidates, the backend server...) do not rebuild XMem and re-read its checkpoint every time
+
+Networks are keyed by the checkpoint (its path, size and modification time) and the config entries that change
+the network or what runs it. Every processor gets its own InferenceCore (and MemoryManager), while the network,
+its backend, the feature cache checksum and the warmup are shared, see PreparedNetwork.
+With config['shared_weights_dir'], the weights are also shared between the processes of a node, see util/shared_weights.py.
+"""
+
+import os
+import threading
+from dataclasses import dataclass
+from warnings import warn
+
+import torch
+
+from inference.inference_core import InferenceCore, PreparedNetwork, prepare_network
+from inference.quantization import is_quantized_checkpoint, load_quantized_xmem
+from model.network import XMem
+from util.shared_weights import load_shared
+
+
+# the config entries that a loaded network depends on, besides config['model']
+NETWORK_CONFIG_KEYS = ('single_object', 'cpu_profile', 'network_backend', 'exported_model_dir')
+# only from the config if there are no weights to read them from
+HYPERPARAMETER_KEYS = ('key_dim', 'value_dim', 'hidden_dim')
+
+
+def load_network(config: dict):
+    # XMem with the weights of config['model'] (float or quantized, see quantize_model.py), in eval mode
+    # config is updated in place with the hyperparameters of the weights
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model_path = config['model']
+    model_weights = torch.load(model_path, map_location='cpu') if model_path is not None else None
+    if is_quantized_checkpoint(model_weights):
+        # int8 weights from quantize_model.py
+        return load_quantized_xmem(model_weights, config)
+
+    network = XMem(config, model_path, pretrained_key_encoder=False, pretrained_value_encoder=False).to(device).eval()
+    if model_path is not None:
+        network.load_weights(model_weights, init_as_zero_if_needed=True)
+    else:
+        warn('No model weights were loaded, as config["model"] was not specified.')
+    return network
+
+
+@dataclass
+class _Entry:
+    network: XMem
+    prepared: PreparedNetwork
+    config_updates: dict  # what loading the network changed in the config
+
+
+class ModelRegistry:
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(config: dict):
+        model_path = config['model']
+        if model_path is None:
+            checkpoint = (None, ) + tuple(config.get(k) for k in HYPERPARAMETER_KEYS)
+        else:
+            # a checkpoint that is overwritten on disk is loaded again
+            stat = os.stat(model_path)
+            checkpoint = (os.path.abspath(model_path), stat.st_size, stat.st_mtime_ns)
+        return checkpoint + tuple(config.get(k) for k in NETWORK_CONFIG_KEYS)
+
+    def get(self, config: dict):
+        """
+        The network for config (loaded on first use) and its PreparedNetwork
+        config is updated in place as when loading the network, e.g., with the hyperparameters of the weights
+        """
+        key = self._key(config)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                config_before = dict(config)
+                if config.get('shared_weights_dir', None) is not None:
+                    network, prepared = self._load_shared(config, key)
+                else:
+                    network = load_network(config)
+                    prepared = prepare_network(network, config)
+                config_updates = {k: v for k, v in config.items() if k not in config_before or config_before[k] != v}
+                entry = self._entries[key] = _Entry(network, prepared, config_updates)
+        config.update(entry.config_updates)
+        return entry.network, entry.prepared
+
+    @staticmethod
+    def _load_shared(config: dict, key):
+        # the network with its weights (after the cpu_profile conversion) in a file mapping shared by all processes
+        # that use config['shared_weights_dir'], see util/shared_weights.py; only the first one reads the checkpoint
+        prepared = []
+
+        def load():
+            config_before = dict(config)
+            network = load_network(config)
+            if getattr(network, 'quantization', None) is not None:
+                raise ValueError('shared_weights_dir does not support quantized networks')
+            prepared.append(prepare_network(network, config))
+            return network, {k: v for k, v in config.items() if k not in config_before or config_before[k] != v}
+
+        def build(state, config_updates):
+            # the same network without its weights, which are bound to the shared state right after
+            config.update(config_updates)
+            network = XMem(config, None, pretrained_key_encoder=False, pretrained_value_encoder=False).eval()
+            prepared.append(prepare_network(network, config))
+            return network
+
+        network, _ = load_shared(config['shared_weights_dir'], 'xmem', key, load, build)
+        return network, prepared[0]
+
+    def create_processor(self, config: dict):
+        # a fresh InferenceCore (with an empty memory) for the network of config
+        network, prepared = self.get(config)
+        return InferenceCore(network, config=config, prepared=prepared)
+
+    def clear(self):
+        # drops all networks, e.g., to free their memory; processors that are still in use keep theirs
+        with self._lock:
+            self._entries.clear()
+
+
+MODEL_REGISTRY = ModelRegistry()
@@ -0,0 +1,199 @@
+"""
+Post-training int8 quantization of XMem (key encoder, value encoder, decoder) and S2M, see quantize_model.py
+
+Two modes:
+- 'dynamic': the weights of the convolutions and linear layers are int8, the activations are quantized on the fly per call
+- 'static': the activation ranges are calibrated on a few frames beforehand (see calibrate_xmem/calibrate_s2m),
+  every convolution and linear layer runs as an int8 kernel between a quantize and a dequantize
+
+Batch norms are folded into their convolutions first. Everything else (activations, attention, the memory readout,
+the aggregation) stays in float32, so the quantized stages are drop-in replacements of the float ones.
+
+A quantized checkpoint keeps the quantization settings next to the int8 state dict, and the network is rebuilt from
+them when loading (load_quantized_xmem/load_quantized_s2m), e.g., through config['model'] as any other weights.
+"""
+
+import warnings
+from typing import Iterable, Optional
+
+import torch
+import torch.ao.quantization as tq
+from torch import nn
+
+try:
+    import torch.ao.nn.quantized.dynamic as nnqd
+except ImportError:  # torch < 1.13
+    import torch.nn.quantized.dynamic as nnqd
+
+from inference.cpu_profile import fuse_conv_bn
+from inference.inference_core import InferenceCore
+from inference.interact.s2m.s2m_network import deeplabv3plus_resnet50 as S2M
+from inference.interact.s2m_controller import S2MController
+from model.group_modules import GConv2D
+from model.network import XMem
+
+
+QUANTIZATION_MODES = ('dynamic', 'static')
+
+# stage: the submodules of XMem it consists of
+XMEM_STAGES = {
+    'key_encoder': ('key_encoder', 'key_proj'),
+    'value_encoder': ('value_encoder', ),
+    'decoder': ('decoder', ),
+}
+
+QUANTIZED_LAYERS = (nn.Conv2d, nn.Linear)
+
+
+class GroupedConv(nn.Module):
+    """
+    GConv2D (model/group_modules.py) as a plain convolution over the flattened groups,
+    as the quantization passes only swap modules of exactly the quantized types
+    """
+    def __init__(self, conv: GConv2D):
+        super().__init__()
+        self.conv = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                              dilation=conv.dilation, groups=conv.groups, bias=conv.bias is not None)
+        self.conv.load_state_dict(conv.state_dict())
+
+    def forward(self, g):
+        batch_size, num_objects = g.shape[:2]
+        g = self.conv(g.flatten(start_dim=0, end_dim=1))
+        return g.view(batch_size, num_objects, *g.shape[1:])
+
+
+def _replace_grouped_convs(module: nn.Module):
+    for name, child in module.named_children():
+        if isinstance(child, GConv2D):
+            setattr(module, name, GroupedConv(child))
+        else:
+            _replace_grouped_convs(child)
+
+
+def _wrap_quantized_layers(module: nn.Module, qconfig):
+    # static quantization: every quantized layer gets its own quantize/dequantize stubs
+    for name, child in module.named_children():
+        if type(child) in QUANTIZED_LAYERS:
+            wrapper = tq.QuantWrapper(child)
+            wrapper.qconfig = qconfig
+            setattr(module, name, wrapper)
+        else:
+            _wrap_quantized_layers(child, qconfig)
+
+
+def prepare_quantization(model: nn.Module, mode: str, submodules: Optional[Iterable[str]] = None):
+    """
+    Converts the `submodules` of `model` (all of it if None) in place, in eval mode
+    'dynamic' is done after this, 'static' needs a calibration pass (running `model` on a few inputs) and convert_quantization
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f'Unknown quantization mode: {mode}, expected one of {QUANTIZATION_MODES}')
+    model.eval()
+    modules = [model] if submodules is None else [getattr(model, name) for name in submodules]
+    for module in modules:
+        fuse_conv_bn(module)
+        _replace_grouped_convs(module)
+        if mode == 'dynamic':
+            mapping = {**tq.get_default_dynamic_quant_module_mappings(), nn.Conv2d: nnqd.Conv2d}
+            tq.quantize_dynamic(module, {layer: tq.default_dynamic_qconfig for layer in QUANTIZED_LAYERS},
+                                mapping=mapping, inplace=True)
+        else:
+            _wrap_quantized_layers(module, tq.get_default_qconfig(torch.backends.quantized.engine))
+            tq.prepare(module, inplace=True)
+    return model
+
+
+def convert_quantization(model: nn.Module, mode: str, submodules: Optional[Iterable[str]] = None):
+    # after the calibration of 'static', swaps in the int8 layers with the observed activation ranges
+    if mode == 'static':
+        modules = [model] if submodules is None else [getattr(model, name) for name in submodules]
+        for module in modules:
+            tq.convert(module, inplace=True)
+    return model
+
+
+def calibrate_xmem(network: XMem, frames, config: dict):
+    """
+    Runs the (prepared) network over `frames`, an iterable of (image, mask, labels) as for InferenceCore.step
+    (mask and labels None for the frames to propagate to), to observe the activation ranges of all stages
+    """
+    processor = InferenceCore(network, config=config)
+    all_labels = set()
+    with torch.no_grad():
+        for ti, (image, mask, labels) in enumerate(frames):
+            if labels is not None:
+                all_labels.update(labels)
+                processor.set_all_labels(sorted(all_labels))
+            processor.step(image, mask, labels, ti=ti)
+
+
+def calibrate_s2m(s2m_model: nn.Module, interactions, num_objects: int):
+    """
+    Runs the (prepared) S2M model over `interactions`, an iterable of (image, previous index mask, scribble index mask)
+    as for S2MController.interact
+    """
+    controller = S2MController(s2m_model, num_objects, ignore_class=255, device='cpu')
+    with torch.no_grad():
+        for image, prev_mask, scribbles in interactions:
+            controller.interact(image, prev_mask, scribbles)
+
+
+def quantization_info(mode: str, stages):
+    return {'mode': mode, 'stages': list(stages), 'engine': torch.backends.quantized.engine}
+
+
+def xmem_quantization_checkpoint(network: XMem, info: dict):
+    # everything load_quantized_xmem needs to rebuild `network`
+    hyperparameters = {
+        'key_dim': network.key_dim,
+        'value_dim': network.value_dim,
+        'hidden_dim': network.hidden_dim,
+        'single_object': network.single_object,
+    }
+    return {'quantization': info, 'hyperparameters': hyperparameters, 'state_dict': network.state_dict()}
+
+
+def s2m_quantization_checkpoint(s2m_model: nn.Module, info: dict):
+    return {'quantization': info, 'state_dict': s2m_model.state_dict()}
+
+
+def is_quantized_checkpoint(weights):
+    return isinstance(weights, dict) and 'quantization' in weights
+
+
+def _set_engine(info: dict):
+    engine = info.get('engine')
+    if engine is not None and engine != torch.backends.quantized.engine:
+        if engine not in torch.backends.quantized.supported_engines:
+            raise RuntimeError(f'The model was quantized for the {engine} engine, which is not supported here')
+        torch.backends.quantized.engine = engine
+
+
+def _rebuild(model: nn.Module, checkpoint: dict, submodules):
+    info = checkpoint['quantization']
+    _set_engine(info)
+    with warnings.catch_warnings():
+        # the observers of 'static' are not run, their ranges are loaded from the state dict right after
+        warnings.simplefilter('ignore')
+        prepare_quantization(model, info['mode'], submodules)
+        convert_quantization(model, info['mode'], submodules)
+    model.load_state_dict(checkpoint['state_dict'])
+    model.quantization = info
+    return model.eval()
+
+
+def load_quantized_xmem(checkpoint: dict, config: dict):
+    """
+    XMem from a checkpoint of xmem_quantization_checkpoint
+    config is updated in place with the hyperparameters of the checkpoint, as XMem does for float weights
+    """
+    config.update(checkpoint['hyperparameters'])
+    network = XMem(config, None, pretrained_key_encoder=False, pretrained_value_encoder=False)
+    submodules = [name for stage in checkpoint['quantization']['stages'] for name in XMEM_STAGES[stage]]
+    print(f'Quantized network ({checkpoint["quantization"]["mode"]}): {checkpoint["quantization"]["stages"]}')
+    return _rebuild(network, checkpoint, submodules)
+
+
+def load_quantized_s2m(checkpoint: dict):
+    # S2M from a checkpoint of s2m_quantization_checkpoint
+    return _rebuild(S2M(), checkpoint, None)
@@ -1,11 +1,18 @@
-from dataclasses import replace
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass, replace
 from functools import partial
-from multiprocessing import Process, Queue
+import math
+from multiprocessing import Process, Queue, get_context
+import os
 from os import PathLike, path
+import queue
 from tempfile import TemporaryDirectory
+import threading
 from time import perf_counter
 import time
-from typing import Iterable, Optional, Union, List
+from typing import Iterable, Iterator, Optional, Union, List
 from pathlib import Path
 from warnings import warn
 
@@ -14,16 +21,16 @@ import pandas as pd
 import torch
 import torch.nn.functional as F
 from torchvision.transforms import functional as FT, ToTensor
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm
 from PIL import Image
 
 from inference.frame_selection.frame_selection import select_next_candidates
-from model.network import XMem
 from util.configuration import VIDEO_INFERENCE_CONFIG
 from util.image_saver import ParallelImageSaver, create_overlay, save_image
 from util.tensor_util import compute_array_iou
 from inference.inference_core import InferenceCore
+from inference.model_registry import MODEL_REGISTRY
 from inference.data.video_reader import Sample, VideoReader
 from inference.data.mask_mapper import MaskMapper
 from inference.frame_selection.frame_selection_utils import extract_keys, get_determenistic_augmentations
@@ -38,125 +45,469 @@ def _inference_on_video(frames_with_masks, imgs_in_path, masks_in_path, masks_ou
                         save_overlay=True,
                         object_color_if_single_object=(255, 255, 255), 
                         print_fps=False,
-                        image_saving_max_queue_size=200):
+                        image_saving_max_queue_size=200,
+                        checkpoint_path=None,
+                        checkpoint_every=None,
+                        resume_from=None,
+                        num_segment_workers=None,
+                        direction='forward',
+                        edited_frame=None,
+                        stop_after_unchanged_frames=None,
+                        unchanged_tolerance=0.0):
     device = 'cpu'
     
     torch.autograd.set_grad_enabled(False)
     frames_with_masks = set(frames_with_masks)
+    _check_modes(original_memory_mechanism, checkpoint_path, resume_from, num_segment_workers, direction)
+    if edited_frame is not None and (checkpoint_path is None or resume_from is not None or direction != 'forward' or
+                                     (num_segment_workers is not None and num_segment_workers > 1)):
+        raise ValueError('Re-propagating after an edit needs the per-frame checkpoints of the previous run in `checkpoint_path`, '
+                         'and only works in the forward direction without `resume_from` or parallel segments')
+    config = _get_config(masks_out_path, overwrite_config)
+
+    mapper, processor, vid_reader, loader, start_ti, total_preloading_time = _prepare_inference(
+        frames_with_masks, imgs_in_path, masks_in_path, config, original_memory_mechanism=original_memory_mechanism,
+        augment_images_with_masks=augment_images_with_masks, resume_from=resume_from,
+        edited_frame=edited_frame, checkpoint_path=checkpoint_path)
+    vid_name = vid_reader.vid_name
+    vid_length = len(vid_reader)
+
+    if num_segment_workers is not None and num_segment_workers > 1:
+        stats, total_processing_time = _propagate_segments_in_parallel(
+            num_segment_workers, processor, mapper, imgs_in_path, masks_in_path, config, frames_with_masks, vid_length,
+            compute_iou=compute_iou, manually_curated_masks=manually_curated_masks, save_overlay=save_overlay,
+            object_color_if_single_object=object_color_if_single_object, image_saving_max_queue_size=image_saving_max_queue_size)
+    else:
+        frames = _iter_frame_outputs(processor, mapper, vid_reader, loader, imgs_in_path, masks_in_path, config, frames_with_masks,
+                                     start_ti=start_ti, direction=direction, print_progress=print_progress,
+                                     original_memory_mechanism=original_memory_mechanism, manually_curated_masks=manually_curated_masks,
+                                     checkpoint_path=checkpoint_path, checkpoint_every=checkpoint_every)
+        if stop_after_unchanged_frames is not None:
+            frames = _iter_until_unchanged(frames, config, mapper, vid_reader, stop_after_unchanged_frames, unchanged_tolerance,
+                                           after_ti=edited_frame if edited_frame is not None else -1)
+        with ParallelImageSaver(config['masks_out_path'], vid_name=vid_name, overlay_color_if_b_and_w=object_color_if_single_object, max_queue_size=image_saving_max_queue_size) as im_saver:
+            stats, total_processing_time = _save_outputs(frames, config, mapper, vid_reader, im_saver,
+                                                         compute_iou=compute_iou, save_overlay=save_overlay)
+            im_saver.wait_for_jobs_to_finish(verbose=True)
+
+    num_processed = len(stats)
+    if print_fps:
+        print(f"TOTAL PRELOADING TIME: {total_preloading_time:.4f}s")
+        print(f"TOTAL PROCESSING TIME: {total_processing_time:.4f}s")
+        print(f"TOTAL TIME (excluding image saving): {total_preloading_time + total_processing_time:.4f}s")
+        print(f"TOTAL PROCESSING FPS: {num_processed / total_processing_time:.4f}")
+        print(f"TOTAL FPS (excluding image saving): {num_processed / (total_preloading_time + total_processing_time):.4f}")
+
+    return pd.DataFrame(stats)
+
+
+def _check_modes(original_memory_mechanism, checkpoint_path, resume_from, num_segment_workers, direction):
+    if num_segment_workers is not None and num_segment_workers > 1:
+        if original_memory_mechanism:
+            raise ValueError('Parallel segment propagation needs all annotated frames in the permanent memory, i.e., original_memory_mechanism=False')
+        if resume_from is not None or checkpoint_path is not None:
+            raise ValueError('Checkpointing is not supported with parallel segment propagation')
+    if direction not in ('forward', 'both'):
+        raise ValueError(f"Unknown direction '{direction}', expected 'forward' or 'both'")
+    if direction == 'both':
+        if original_memory_mechanism:
+            raise ValueError('Bidirectional propagation needs all annotated frames in the permanent memory, i.e., original_memory_mechanism=False')
+        if resume_from is not None or checkpoint_path is not None or (num_segment_workers is not None and num_segment_workers > 1):
+            raise ValueError('Checkpointing and parallel segment propagation are not supported with bidirectional propagation')
 
+
+def _get_config(masks_out_path, overwrite_config: dict = None):
     config = VIDEO_INFERENCE_CONFIG.copy()
     overwrite_config = {} if overwrite_config is None else overwrite_config
     overwrite_config['masks_out_path'] = masks_out_path
     config.update(overwrite_config)
+    return config
+
 
+def _prepare_inference(frames_with_masks, imgs_in_path, masks_in_path, config: dict, original_memory_mechanism=False,
+                       augment_images_with_masks=False, resume_from=None, edited_frame=None, checkpoint_path=None):
+    # loads everything and fills the permanent memory (or restores the checkpoint to resume from)
+    # with `edited_frame`, continues from the last of the per-frame checkpoints in `checkpoint_path` before it, if any
+    # returns the main objects, the first frame to process and the preloading time
     mapper, processor, vid_reader, loader = _load_main_objects(imgs_in_path, masks_in_path, config)
-    vid_name = vid_reader.vid_name
-    vid_length = len(loader)
 
     at_least_one_mask_loaded = False
     total_preloading_time = 0.0
 
-    if original_memory_mechanism:
-        # only the first frame goes into permanent memory originally
-        frames_to_put_in_permanent_memory = [0]
-        # the rest are going to be processed later
+    start_ti = 0
+    if resume_from is not None:
+        # the permanent memory is part of the checkpoint, no preloading needed
+        checkpoint = processor.load_checkpoint(resume_from)
+        vars(mapper).update(checkpoint['mapper'])
+        start_ti = processor.curr_ti + 1
+        loader = _create_loader(vid_reader, range(start_ti, len(vid_reader)))
     else:
-        # in our modification, all frames with provided masks go into permanent memory
-        frames_to_put_in_permanent_memory = frames_with_masks
-    at_least_one_mask_loaded, total_preloading_time = _preload_permanent_memory(frames_to_put_in_permanent_memory, vid_reader, mapper, processor, augment_images_with_masks=augment_images_with_masks)
+        checkpoint = None
+        before_edit = _find_checkpoint_before(checkpoint_path, edited_frame) if edited_frame is not None else None
+        if before_edit is not None:
+            # the permanent memory is preloaded with a fresh mapper like in the checkpointed run,
+            # so that its labels and object groups come out in the same order (see _matches_checkpoint)
+            checkpoint = torch.load(before_edit, map_location='cpu')
+
+        if original_memory_mechanism:
+            # only the first frame goes into permanent memory originally
+            frames_to_put_in_permanent_memory = [0]
+            # the rest are going to be processed later
+        else:
+            # in our modification, all frames with provided masks go into permanent memory
+            frames_to_put_in_permanent_memory = frames_with_masks
+        at_least_one_mask_loaded, total_preloading_time = _preload_permanent_memory(frames_to_put_in_permanent_memory, vid_reader, mapper, processor, augment_images_with_masks=augment_images_with_masks,
+                                                                                     batch_size=config.get('preload_batch_size'))
 
-    if not at_least_one_mask_loaded:
-        raise ValueError("No valid masks provided!")
+        if not at_least_one_mask_loaded:
+            raise ValueError("No valid masks provided!")
+
+        if checkpoint is not None and not _matches_checkpoint(checkpoint, mapper, processor):
+            warn(f'The labels or object groups of the annotations changed since {before_edit} was saved, '
+                 'propagating over the whole video instead')
+            checkpoint = None
+        if checkpoint is not None:
+            # the memory and hidden state from just before the edit, with the permanent memory of the current annotations
+            processor.load_state_dict(checkpoint['inference'], keep_permanent_memory=True)
+            start_ti = processor.curr_ti + 1
+            loader = _create_loader(vid_reader, range(start_ti, len(vid_reader)))
+
+    return mapper, processor, vid_reader, loader, start_ti, total_preloading_time
+
+
+def _matches_checkpoint(checkpoint: dict, mapper: MaskMapper, processor: InferenceCore):
+    # whether the memory of `checkpoint` can go on with the permanent memory preloaded in `processor`:
+    # every label of the checkpointed run is mapped to the same object, and its object groups are the first ones of
+    # the permanent memory (the edit may add objects, which get new groups, but not remove or reorder them)
+    remappings = checkpoint['mapper']['remappings']
+    if any(mapper.remappings.get(label) != mapped for label, mapped in remappings.items()):
+        return False
+    groups = checkpoint['inference']['memory']['stores']['temporary']['obj_groups']
+    return groups == processor.memory.permanent_work_mem.obj_groups[:len(groups)]
+
+
+def _find_checkpoint_before(checkpoint_path, ti: int):
+    # the latest checkpoint saved before frame `ti`, for per-frame checkpoints (a `checkpoint_path` with '{ti}')
+    for checkpoint_ti in range(ti-1, -1, -1):
+        candidate = str(checkpoint_path).format(ti=checkpoint_ti)
+        if path.exists(candidate):
+            return candidate
+    return None
+
+
+def _iter_frame_outputs(processor: InferenceCore, mapper: MaskMapper, vid_reader: VideoReader, loader, imgs_in_path, masks_in_path,
+                        config: dict, frames_with_masks, start_ti=0, direction='forward', print_progress=True,
+                        original_memory_mechanism=False, manually_curated_masks=False, checkpoint_path=None, checkpoint_every=None):
+    # yields (ti, sample, msk, prob, out_mask, processing time) for every frame from start_ti on, in order
+    if direction == 'both':
+        yield from _iter_both_directions(processor, mapper, vid_reader, imgs_in_path, masks_in_path, config, frames_with_masks,
+                                         manually_curated_masks=manually_curated_masks, print_progress=print_progress)
+        return
+
+    frames = _iter_propagation(processor, mapper, vid_reader, tqdm(loader, disable=not print_progress), config, frames_with_masks,
+                               range(start_ti, len(vid_reader)), original_memory_mechanism=original_memory_mechanism,
+                               manually_curated_masks=manually_curated_masks, checkpoint_path=checkpoint_path, checkpoint_every=checkpoint_every)
+    yield from _iter_post_processed(frames)
+
+
+def _iter_propagation(processor: InferenceCore, mapper: MaskMapper, vid_reader: VideoReader, loader, config: dict, frames_with_masks,
+                      frame_indices, original_memory_mechanism=False, manually_curated_masks=False, checkpoint_path=None, checkpoint_every=None):
+    # the propagation loop over `frame_indices` (the frames of `loader`, in this order, e.g., backwards)
+    # yields (ti, sample, msk, prob, processing time of the step) for every frame
+    device = 'cpu'
+    last_ti = frame_indices[-1] if len(frame_indices) > 0 else None
+
+    lookahead = _get_key_lookahead(vid_reader, config)
+    frames = _iter_with_key_lookahead(loader, processor, lookahead, device,
+                                      pipelined=config.get('pipeline_key_encoding', False))
+    for ti, (data, key_features) in zip(frame_indices, frames):
+        with torch.cuda.amp.autocast(enabled=True):
+            data: Sample = data  # Just for Intellisense
+            # No batch dimension here, just single samples
+            sample = replace(data, rgb=data.rgb.to(device))
+            
+            if ti in frames_with_masks:
+                msk = sample.mask
+            else:
+                msk = None
+                
+            # Map possibly non-continuous labels to continuous ones
+            if msk is not None:
+                # https://github.com/hkchengrex/XMem/issues/21 just make exhaustive = True
+                msk, labels = mapper.convert_mask(
+                    msk.numpy(), exhaustive=True)
+                msk = torch.Tensor(msk).to(device)
+                if sample.need_resize:
+                    msk = vid_reader.resize_mask(msk.unsqueeze(0))[0]
+                processor.set_all_labels(list(mapper.remappings.values()))
+            else:
+                labels = None
+
+            if original_memory_mechanism:
+                # we only ignore the first mask, since it's already in the permanent memory
+                do_not_add_mask_to_memory = (ti == 0)
+            else:
+                # we ignore all frames with masks, since they are already preloaded in the permanent memory
+                do_not_add_mask_to_memory = msk is not None
+            # Run the model on this frame
+            # 2+ channels, classes+ and background
+            a = perf_counter()
+            prob = processor.step(sample.rgb, msk, labels, end=(ti == last_ti),
+                                manually_curated_masks=manually_curated_masks, do_not_add_mask_to_memory=do_not_add_mask_to_memory,
+                                key_features=key_features, ti=ti)
+            b = perf_counter()
+
+        yield ti, sample, msk, prob, b - a
+
+        if checkpoint_path is not None and checkpoint_every is not None and (ti + 1) % checkpoint_every == 0:
+            # '{ti}' in the path keeps a checkpoint per frame instead of overwriting the last one
+            processor.save_checkpoint(str(checkpoint_path).format(ti=ti), mapper=dict(vars(mapper)))
+
+
+def _iter_post_processed(frames):
+    # adds the index mask to the outputs of _iter_propagation
+    for ti, sample, msk, prob, step_time in frames:
+        # Upsample to original size if needed
+        a = perf_counter()
+        out_mask = _post_process(sample, prob)
+        b = perf_counter()
+        yield ti, sample, msk, prob, out_mask, step_time + (b - a)
 
-    stats = []
 
+def _save_outputs(frames, config: dict, mapper: MaskMapper, vid_reader: VideoReader, im_saver: ParallelImageSaver,
+                  compute_iou=False, save_overlay=True):
+    # consumes the outputs of _iter_frame_outputs, returns the per-frame stats and the processing time
+    stats = []
     total_processing_time = 0.0
-    with ParallelImageSaver(config['masks_out_path'], vid_name=vid_name, overlay_color_if_b_and_w=object_color_if_single_object, max_queue_size=image_saving_max_queue_size) as im_saver:
-        for ti, data in enumerate(tqdm(loader, disable=not print_progress)):
-            with torch.cuda.amp.autocast(enabled=True):
-                data: Sample = data  # Just for Intellisense
-                # No batch dimension here, just single samples
-                sample = replace(data, rgb=data.rgb.to(device))
-                
-                if ti in frames_with_masks:
-                    msk = sample.mask
-                else:
-                    msk = None
-                    
-                # Map possibly non-continuous labels to continuous ones
-                if msk is not None:
-                    # https://github.com/hkchengrex/XMem/issues/21 just make exhaustive = True
-                    msk, labels = mapper.convert_mask(
-                        msk.numpy(), exhaustive=True)
-                    msk = torch.Tensor(msk).to(device)
-                    if sample.need_resize:
-                        msk = vid_reader.resize_mask(msk.unsqueeze(0))[0]
-                    processor.set_all_labels(list(mapper.remappings.values()))
-                else:
-                    labels = None
-
-                if original_memory_mechanism:
-                    # we only ignore the first mask, since it's already in the permanent memory
-                    do_not_add_mask_to_memory = (ti == 0)
-                else:
-                    # we ignore all frames with masks, since they are already preloaded in the permanent memory
-                    do_not_add_mask_to_memory = msk is not None
-                # Run the model on this frame
-                # 2+ channels, classes+ and background
-                a = perf_counter()
-                prob = processor.step(sample.rgb, msk, labels, end=(ti == vid_length-1),
-                                    manually_curated_masks=manually_curated_masks, do_not_add_mask_to_memory=do_not_add_mask_to_memory)
-
-                # Upsample to original size if needed
-                out_mask = _post_process(sample, prob)
-                b = perf_counter()
-                total_processing_time += (b - a)
-
-                curr_stat = {'frame': sample.frame, 'mask_provided': msk is not None}
-                if compute_iou:
-                    gt = sample.mask  # for IoU computations, original mask or None, NOT msk
-                    if gt is not None and msk is None:  # There exists a ground truth, but the model didn't see it
-                        iou = float(compute_array_iou(out_mask, gt))
-                    else:
-                        iou = -1  # skipping frames where the model saw the GT
-                    curr_stat['iou'] = iou
-                stats.append(curr_stat)
-
-                # Save the mask and the overlay (potentially)
-
-                if config['save_masks']:
-                    out_mask = mapper.remap_index_mask(out_mask)
-                    out_img = Image.fromarray(out_mask)
-                    out_img = vid_reader.map_the_colors_back(out_img)
-
-                    im_saver.save_mask(mask=out_img, frame_name=sample.frame)
-
-                    if save_overlay:
-                        original_img = sample.raw_image_pil
-                        im_saver.save_overlay(orig_img=original_img, mask=out_img, frame_name=sample.frame)
-        im_saver.wait_for_jobs_to_finish(verbose=True)
+    for ti, sample, msk, prob, out_mask, processing_time in frames:
+        total_processing_time += processing_time
+        stats.append(_get_frame_stats(sample, msk, out_mask, compute_iou))
+        _save_frame(config, mapper, vid_reader, im_saver, sample, out_mask, save_overlay)
+
+    return stats, total_processing_time
+
+
+def _get_frame_stats(sample: Sample, msk, out_mask, compute_iou=False):
+    curr_stat = {'frame': sample.frame, 'mask_provided': msk is not None}
+    if compute_iou:
+        gt = sample.mask  # for IoU computations, original mask or None, NOT msk
+        if gt is not None and msk is None:  # There exists a ground truth, but the model didn't see it
+            iou = float(compute_array_iou(out_mask, gt))
+        else:
+            iou = -1  # skipping frames where the model saw the GT
+        curr_stat['iou'] = iou
+    return curr_stat
+
+
+def _to_output_image(mapper: MaskMapper, vid_reader: VideoReader, out_mask):
+    # the mask as it is saved, with the labels and colors of the input masks
+    out_mask = mapper.remap_index_mask(out_mask)
+    out_img = Image.fromarray(out_mask)
+    return vid_reader.map_the_colors_back(out_img)
+
+
+def _save_frame(config: dict, mapper: MaskMapper, vid_reader: VideoReader, im_saver: ParallelImageSaver, sample: Sample, out_mask, save_overlay=True):
+    # Save the mask and the overlay (potentially)
+    if config['save_masks']:
+        out_img = _to_output_image(mapper, vid_reader, out_mask)
+
+        im_saver.save_mask(mask=out_img, frame_name=sample.frame)
+
+        if save_overlay:
+            original_img = sample.raw_image_pil
+            im_saver.save_overlay(orig_img=original_img, mask=out_img, frame_name=sample.frame)
+
+
+def _iter_until_unchanged(frames, config: dict, mapper: MaskMapper, vid_reader: VideoReader, num_unchanged_frames: int, tolerance=0.0,
+                          after_ti=-1):
+    # passes the outputs of _iter_frame_outputs through until the masks of `num_unchanged_frames` consecutive frames
+    # after frame `after_ti` (e.g., the edited one) agree with the ones already saved in config['masks_out_path']
+    # (up to a fraction `tolerance` of differing pixels); the frames up to `after_ti` are always passed through
+    num_unchanged = 0
+    for frame in frames:
+        ti, sample, msk, prob, out_mask, processing_time = frame
+        if ti <= after_ti:
+            yield frame
+            continue
+        # read before _save_frame overwrites it
+        previous_path = path.join(config['masks_out_path'], vid_reader.vid_name, 'masks', sample.frame[:-4] + '.png')
+        unchanged = False
+        if path.exists(previous_path):
+            previous = np.array(Image.open(previous_path).convert('RGB'))
+            current = np.array(_to_output_image(mapper, vid_reader, out_mask).convert('RGB'))
+            unchanged = previous.shape == current.shape and (previous != current).any(axis=2).mean() <= tolerance
+        num_unchanged = num_unchanged + 1 if unchanged else 0
+
+        yield frame
+        if num_unchanged >= num_unchanged_frames:
+            return
+
+
+def _get_segments(frames_with_masks, vid_length: int):
+    # [start, end) stretches of the video, split at the annotated frames
+    boundaries = sorted({0, vid_length} | {ti for ti in frames_with_masks if 0 < ti < vid_length})
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _make_job(imgs_in_path, masks_in_path, config: dict, frames_with_masks, mapper: MaskMapper, inference_state: dict, frame_indices, num_threads: int, **kwargs):
+    # everything a worker process needs to continue the propagation over `frame_indices` from `inference_state` (see InferenceCore.state_dict)
+    return {
+        'imgs_in_path': imgs_in_path, 'masks_in_path': masks_in_path, 'config': config, 'frames_with_masks': frames_with_masks,
+        'mapper': dict(vars(mapper)), 'inference': inference_state, 'frame_indices': frame_indices, 'num_threads': num_threads,
+        'kwargs': kwargs,
+    }
+
+
+def _load_job(job: dict):
+    # the worker process side of _make_job
+    torch.set_num_threads(job['num_threads'])
+    torch.autograd.set_grad_enabled(False)
 
-    if print_fps:
-        print(f"TOTAL PRELOADING TIME: {total_preloading_time:.4f}s")
-        print(f"TOTAL PROCESSING TIME: {total_processing_time:.4f}s")
-        print(f"TOTAL TIME (excluding image saving): {total_preloading_time + total_processing_time:.4f}s")
-        print(f"TOTAL PROCESSING FPS: {len(loader) / total_processing_time:.4f}")
-        print(f"TOTAL FPS (excluding image saving): {len(loader) / (total_preloading_time + total_processing_time):.4f}")
+    mapper, processor, vid_reader, _ = _load_main_objects(job['imgs_in_path'], job['masks_in_path'], job['config'])
+    vars(mapper).update(job['mapper'])
+    processor.load_state_dict(job['inference'])
+    loader = _create_loader(vid_reader, job['frame_indices'])
+    return mapper, processor, vid_reader, loader
+
+
+def _propagate_segments_in_parallel(num_workers: int, processor: InferenceCore, mapper: MaskMapper, imgs_in_path, masks_in_path,
+                                    config: dict, frames_with_masks, vid_length: int, **kwargs):
+    # all annotated frames are already in the permanent memory, which makes the stretches between them largely independent:
+    # each one is propagated in a worker process from a copy of the permanent memory (with empty temporary memory and hidden state)
+    # kwargs are passed on to _iter_propagation and _save_outputs, returns the stats of all frames in order and the wall time
+    memory_state = processor.memory.copy_perm_mem_only().state_dict()
+    segments = _get_segments(frames_with_masks, vid_length)
+    num_workers = min(num_workers, len(segments))
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+
+    jobs = []
+    for start, end in segments:
+        # the counters are set as if the video started at this segment
+        inference_state = {'memory': memory_state, 'curr_ti': start-1, 'last_mem_ti': start,
+                           'all_labels': list(processor.all_labels), 'last_deep_update_ti': start-processor.deep_update_every}
+        jobs.append(_make_job(imgs_in_path, masks_in_path, config, frames_with_masks, mapper, inference_state,
+                              range(start, end), num_threads, **kwargs))
+    # longest segments first, for a better balance between the workers
+    jobs.sort(key=lambda job: len(job['frame_indices']), reverse=True)
+
+    a = perf_counter()
+    # spawn, as forking a process with initialized torch thread pools can deadlock
+    with ProcessPoolExecutor(num_workers, mp_context=get_context('spawn')) as executor:
+        results = list(executor.map(_propagate_segment, jobs))
+    b = perf_counter()
 
-    return pd.DataFrame(stats)
+    stats = []
+    for _, segment_stats in sorted(zip([job['frame_indices'][0] for job in jobs], results), key=lambda r: r[0]):
+        stats.extend(segment_stats)
+    return stats, b - a
+
+
+def _propagate_segment(job: dict):
+    # runs in a worker process of _propagate_segments_in_parallel
+    mapper, processor, vid_reader, loader = _load_job(job)
+    config = job['config']
+    kwargs = dict(job['kwargs'])
+    compute_iou = kwargs.pop('compute_iou', False)
+    save_overlay = kwargs.pop('save_overlay', True)
+
+    with ParallelImageSaver(config['masks_out_path'], vid_name=vid_reader.vid_name,
+                            overlay_color_if_b_and_w=kwargs.pop('object_color_if_single_object'),
+                            max_queue_size=kwargs.pop('image_saving_max_queue_size')) as im_saver:
+        frames = _iter_propagation(processor, mapper, vid_reader, loader, config, job['frames_with_masks'], job['frame_indices'], **kwargs)
+        stats, _ = _save_outputs(_iter_post_processed(frames), config, mapper, vid_reader, im_saver,
+                                 compute_iou=compute_iou, save_overlay=save_overlay)
+        im_saver.wait_for_jobs_to_finish()
+    return stats
+
+
+def _get_direction_weights(frames_with_masks, vid_length: int):
+    # weight of the forward pass for every frame in bidirectional propagation (the backward pass gets the rest),
+    # from the temporal distances to the closest annotated frame before (forward) and after (backward) it:
+    # the pass that has propagated over fewer frames since its annotation is the more confident one
+    annotated = sorted(ti for ti in frames_with_masks if 0 <= ti < vid_length)
+    weights = []
+    for ti in range(vid_length):
+        before = bisect_right(annotated, ti)
+        after = bisect_left(annotated, ti)
+        if after == len(annotated):
+            weights.append(1.0)  # no annotation after this frame
+        elif before == 0:
+            weights.append(0.0)  # no annotation before this frame
+        else:
+            forward_distance = ti - annotated[before-1]
+            backward_distance = annotated[after] - ti
+            total_distance = forward_distance + backward_distance
+            weights.append(backward_distance / total_distance if total_distance > 0 else 1.0)
+    return weights
+
+
+def _open_probabilities(probabilities_path, shape):
+    # float16 probabilities of all frames, in a file shared between the processes of _iter_both_directions
+    return torch.from_file(probabilities_path, shared=True, size=math.prod(shape), dtype=torch.float16).view(shape)
+
+
+def _iter_both_directions(processor: InferenceCore, mapper: MaskMapper, vid_reader: VideoReader, imgs_in_path, masks_in_path,
+                          config: dict, frames_with_masks, manually_curated_masks=False, print_progress=True):
+    # the forward pass runs here and the backward pass in a worker process at the same time, both from the preloaded permanent memory
+    # their probabilities are fused per frame with _get_direction_weights, yields the same as _iter_frame_outputs
+    vid_length = len(vid_reader)
+    h, w = vid_reader[0].rgb.shape[-2:]
+    shape = (vid_length, len(processor.all_labels)+1, h, w)
+    num_threads = torch.get_num_threads()
+    pass_threads = max(1, (os.cpu_count() or 1) // 2)
+
+    with TemporaryDirectory() as probabilities_dir:
+        forward_path = path.join(probabilities_dir, 'forward.bin')
+        backward_path = path.join(probabilities_dir, 'backward.bin')
+        forward_probs = _open_probabilities(forward_path, shape)
+        backward_probs = _open_probabilities(backward_path, shape)
+
+        job = _make_job(imgs_in_path, masks_in_path, config, frames_with_masks, mapper, processor.state_dict(),
+                        range(vid_length-1, -1, -1), pass_threads, manually_curated_masks=manually_curated_masks)
+        job['probabilities_path'] = backward_path
+        job['probabilities_shape'] = shape
 
-def _load_main_objects(imgs_in_path, masks_in_path, config):
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    model_path = config['model']
-    network = XMem(config, model_path, pretrained_key_encoder=False, pretrained_value_encoder=False).to(device).eval()
-    if model_path is not None:
-        model_weights = torch.load(model_path, map_location='cpu')
-        network.load_weights(model_weights, init_as_zero_if_needed=True)
-    else:
-        warn('No model weights were loaded, as config["model"] was not specified.')
+        a = perf_counter()
+        torch.set_num_threads(pass_threads)
+        try:
+            # spawn, as forking a process with initialized torch thread pools can deadlock
+            with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+                backward = executor.submit(_propagate_probabilities, job)
+                loader = tqdm(_create_loader(vid_reader), disable=not print_progress)
+                for ti, _, _, prob, _ in _iter_propagation(processor, mapper, vid_reader, loader, config, frames_with_masks,
+                                                           range(vid_length), manually_curated_masks=manually_curated_masks):
+                    forward_probs[ti] = prob
+                backward.result()
+        finally:
+            torch.set_num_threads(num_threads)
+        b = perf_counter()
+        passes_time = b - a
+
+        weights = _get_direction_weights(frames_with_masks, vid_length)
+        for ti, sample in enumerate(_create_loader(vid_reader)):
+            a = perf_counter()
+            prob = weights[ti] * forward_probs[ti].float() + (1 - weights[ti]) * backward_probs[ti].float()
+            out_mask = _post_process(sample, prob)
+            b = perf_counter()
+            msk = sample.mask if ti in frames_with_masks else None
+            # the time of both passes is accounted to the first frame
+            yield ti, sample, msk, prob, out_mask, (b - a) + (passes_time if ti == 0 else 0.0)
+        del forward_probs, backward_probs
 
+
+def _propagate_probabilities(job: dict):
+    # runs in the worker process of _iter_both_directions, writes the probabilities of the frames of the job
+    mapper, processor, vid_reader, loader = _load_job(job)
+    probabilities = _open_probabilities(job['probabilities_path'], job['probabilities_shape'])
+    for ti, _, _, prob, _ in _iter_propagation(processor, mapper, vid_reader, loader, job['config'], job['frames_with_masks'],
+                                               job['frame_indices'], **job['kwargs']):
+        probabilities[ti] = prob
+
+
+def _load_main_objects(imgs_in_path, masks_in_path, config):
+    # the network is only loaded (and warmed up) once per process, see ModelRegistry
     mapper = MaskMapper()
-    processor = InferenceCore(network, config=config)
+    processor = MODEL_REGISTRY.create_processor(config)
 
     vid_reader, loader = _create_dataloaders(imgs_in_path, masks_in_path, config)
     return mapper,processor,vid_reader,loader
@@ -173,6 +524,70 @@ def _post_process(sample, prob):
     return out_mask
 
 
+def _get_key_lookahead(vid_reader: VideoReader, config: dict):
+    # number of frames to encode keys for in one batch, bounded by config['key_lookahead_bytes']
+    lookahead = config.get('key_lookahead', 1)
+    budget = config.get('key_lookahead_bytes', None)
+    if lookahead <= 1 or budget is None:
+        return max(lookahead, 1)
+
+    h, w = vid_reader[0].rgb.shape[-2:]
+    # f4/f8/f16 + key/shrinkage/selection (float32) kept per frame until step(),
+    # doubled for the key encoder's intermediate activations, which are of the same order
+    key_dim = config['key_dim']
+    per_frame = 4 * (256*(h/4)*(w/4) + 512*(h/8)*(w/8) + (1024+2*key_dim+1)*(h/16)*(w/16))
+    return int(max(1, min(lookahead, budget // (2 * per_frame))))
+
+
+def _iter_batches(loader, batch_size: int):
+    batch = []
+    for data in loader:
+        batch.append(data)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def _iter_with_key_lookahead(loader, processor: InferenceCore, lookahead: int, device, pipelined=False):
+    # yields (sample, key_features), key_features are encoded `lookahead` frames at a time
+    # (see InferenceCore.encode_frame_keys), or None without lookahead
+    # pipelined: the keys of the next batch are encoded on a worker thread while the current batch goes through step()
+    # only the memory-independent key path runs ahead, so memory updates keep their order
+    if lookahead <= 1 and not pipelined:
+        for data in loader:
+            yield data, None
+        return
+
+    def encode(batch):
+        # grad mode is thread-local, so it has to be disabled on the worker thread as well
+        with torch.no_grad():
+            return processor.encode_frame_keys([d.rgb.to(device) for d in batch])
+
+    if not pipelined:
+        for batch in _iter_batches(loader, lookahead):
+            yield from zip(batch, encode(batch))
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        for batch in _iter_batches(loader, lookahead):
+            future = executor.submit(encode, batch)
+            if pending is not None:
+                yield from zip(pending[0], pending[1].result())
+            pending = (batch, future)
+        if pending is not None:
+            yield from zip(pending[0], pending[1].result())
+
+
+def _create_loader(vid_reader: VideoReader, frame_indices=None):
+    # Just return the samples as they are; only using DataLoader for preloading frames from the disk
+    # only `frame_indices` are loaded, in this order, when resuming from a checkpoint, propagating a segment or going backwards
+    dataset = vid_reader if frame_indices is None else Subset(vid_reader, frame_indices)
+    return DataLoader(dataset, batch_size=None, shuffle=False, num_workers=1, collate_fn=VideoReader.collate_fn_identity)
+
+
 def _create_dataloaders(imgs_in_path: Union[str, PathLike], masks_in_path: Union[str, PathLike], config: dict):
     vid_reader = VideoReader(
         "",
@@ -182,8 +597,7 @@ def _create_dataloaders(imgs_in_path: Union[str, PathLike], masks_in_path: Union
         use_all_masks=True
     )
     
-    # Just return the samples as they are; only using DataLoader for preloading frames from the disk
-    loader = DataLoader(vid_reader, batch_size=None, shuffle=False, num_workers=1, collate_fn=VideoReader.collate_fn_identity)
+    loader = _create_loader(vid_reader)
 
     vid_length = len(loader)
     # no need to count usage for LT if the video is not that long anyway
@@ -198,10 +612,14 @@ def _create_dataloaders(imgs_in_path: Union[str, PathLike], masks_in_path: Union
     return vid_reader,loader
 
 
-def _preload_permanent_memory(frames_to_put_in_permanent_memory: List[int], vid_reader: VideoReader, mapper: MaskMapper, processor: InferenceCore, augment_images_with_masks=False):
+def _preload_permanent_memory(frames_to_put_in_permanent_memory: List[int], vid_reader: VideoReader, mapper: MaskMapper, processor: InferenceCore, augment_images_with_masks=False, batch_size=None):
+    # all frames (and their augmentations) are encoded in batches of `batch_size` and added in one write
+    # except that frames adding new objects start a new write, as every write is for the labels so far
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     total_preloading_time = 0
     at_least_one_mask_loaded = False
+    # [(labels, images, masks, video frame indices)]
+    writes = []
     for j in frames_to_put_in_permanent_memory:
         sample: Sample = vid_reader[j]
         sample = replace(sample, rgb=sample.rgb.to(device))
@@ -219,11 +637,12 @@ def _preload_permanent_memory(frames_to_put_in_permanent_memory: List[int], vid_
             msk = vid_reader.resize_mask(msk.unsqueeze(0))[0]
         # sample = replace(sample, mask=msk)
 
-        processor.set_all_labels(list(mapper.remappings.values()))
-        a = perf_counter()
-        processor.put_to_permanent_memory(sample.rgb, msk)
-        b = perf_counter()
-        total_preloading_time += (b - a)
+        all_labels = list(mapper.remappings.values())
+        if len(writes) == 0 or writes[-1][0] != all_labels:
+            writes.append((all_labels, [], [], []))
+        writes[-1][1].append(sample.rgb)
+        writes[-1][2].append(msk)
+        writes[-1][3].append(j)
 
         if not at_least_one_mask_loaded:
             at_least_one_mask_loaded = True
@@ -239,7 +658,16 @@ def _preload_permanent_memory(frames_to_put_in_permanent_memory: List[int], vid_
 
                 msk_aug = mask_aug(msk)
 
-                processor.put_to_permanent_memory(rgb_aug, msk_aug)
+                writes[-1][1].append(rgb_aug)
+                writes[-1][2].append(msk_aug)
+                writes[-1][3].append(j)
+
+    for all_labels, images, masks, times in writes:
+        processor.set_all_labels(all_labels)
+        a = perf_counter()
+        processor.put_to_permanent_memory_batch(images, masks, batch_size=batch_size, times=times)
+        b = perf_counter()
+        total_preloading_time += (b - a)
     
     return at_least_one_mask_loaded, total_preloading_time
 
@@ -267,6 +695,24 @@ def run_on_video(
 
     print_progress (bool): A flag to indicate whether to print a progress bar (default: True).
 
+    To be able to resume after a crash, pass `checkpoint_path` and `checkpoint_every` (in frames) to save the inference state periodically,
+    and `resume_from=checkpoint_path` to continue from the frame after the last checkpoint (the returned stats then only cover the remaining frames).
+
+    With `num_segment_workers=N`, the video is split at the frames with masks and the segments are propagated in N processes,
+    each starting from the permanent memory only (instead of carrying the temporary memory over from the previous segment).
+
+    With `direction='both'`, a backward pass (in a separate process) runs alongside the forward one and their probabilities are fused per frame,
+    weighted by the temporal distance to the closest annotated frame in either direction.
+
+    To consume the masks as they are predicted instead, see `iter_video_masks`.
+
+    After the mask of one frame was edited (or added) in `masks_in_path`, pass `edited_frame` to re-propagate only from there:
+    the previous run has to keep a checkpoint per frame, i.e., `checkpoint_path` with a '{ti}' placeholder (e.g. 'ckpt/{ti}.pth'), and `checkpoint_every`.
+    The propagation continues from the last checkpoint before the edited frame, with the permanent memory of the current annotations,
+    and with `stop_after_unchanged_frames=K` it stops once K consecutive masks after the edited frame agree with the previously saved ones
+    (up to a fraction `unchanged_tolerance` of differing pixels). Frames before the checkpoint are not updated.
+    If the edit removed objects (or changed the order in which they appear), the checkpoint cannot be continued and the whole video is propagated.
+
     Returns:
     stats (pd.Dataframe): a table containing every frame and the following information: IoU score with corresponding mask (if `compute_iou` is True)
     """
@@ -282,6 +728,121 @@ def run_on_video(
     )
 
 
+@dataclass
+class FrameMask:
+    """A processed frame, as yielded by `iter_video_masks`"""
+    ti: int  # 0-based frame index
+    frame: str  # frame file name
+    mask: np.ndarray  # H*W index mask (original size), with the labels of the input masks (see VideoReader.map_the_colors_back for the colors)
+    prob: Optional[torch.Tensor] = None  # (num_objects+1)*h*w probabilities, background first, at the processing size (config['size'])
+
+
+def iter_video_masks(
+    imgs_in_path: Union[str, PathLike],
+    masks_in_path: Union[str, PathLike],
+    frames_with_masks: Iterable[int] = (0, ),
+    masks_out_path: Optional[Union[str, PathLike]] = None,
+    return_probabilities=False,
+    max_buffered_frames=0,
+    original_memory_mechanism=False,
+    manually_curated_masks=False,
+    print_progress=True,
+    augment_images_with_masks=False,
+    overwrite_config: dict = None,
+    save_overlay=True,
+    object_color_if_single_object=(255, 255, 255),
+    image_saving_max_queue_size=200,
+    checkpoint_path=None,
+    checkpoint_every=None,
+    resume_from=None,
+    direction='forward',
+) -> Iterator[FrameMask]:
+    """
+    Like `run_on_video`, but yields a `FrameMask` per frame as soon as it is predicted, in frame order.
+
+    Args:
+    masks_out_path (Optional[Union[str, PathLike]]): If given, the masks (and overlays, if `save_overlay`) are also saved there, like in `run_on_video` (default: None, nothing is saved).
+
+    return_probabilities (bool): Whether to include the per-object probabilities in the yielded frames (default: False).
+
+    max_buffered_frames (int): If > 0, frames are predicted on a background thread, up to this many ahead of the consumer (default: 0, every frame is predicted when it is requested).
+
+    The other arguments are the same as in `run_on_video`; `num_segment_workers` is not supported, as its segments are only finished in arbitrary order.
+    """
+    torch.autograd.set_grad_enabled(False)
+    frames_with_masks = set(frames_with_masks)
+    _check_modes(original_memory_mechanism, checkpoint_path, resume_from, None, direction)
+    config = _get_config(masks_out_path, overwrite_config)
+
+    mapper, processor, vid_reader, loader, start_ti, _ = _prepare_inference(
+        frames_with_masks, imgs_in_path, masks_in_path, config, original_memory_mechanism=original_memory_mechanism,
+        augment_images_with_masks=augment_images_with_masks, resume_from=resume_from)
+
+    frames = _iter_frame_outputs(processor, mapper, vid_reader, loader, imgs_in_path, masks_in_path, config, frames_with_masks,
+                                 start_ti=start_ti, direction=direction, print_progress=print_progress,
+                                 original_memory_mechanism=original_memory_mechanism, manually_curated_masks=manually_curated_masks,
+                                 checkpoint_path=checkpoint_path, checkpoint_every=checkpoint_every)
+    if max_buffered_frames > 0:
+        frames = _iter_buffered(frames, max_buffered_frames)
+
+    # saving the images is optional here
+    if masks_out_path is not None:
+        im_saver = ParallelImageSaver(config['masks_out_path'], vid_name=vid_reader.vid_name, overlay_color_if_b_and_w=object_color_if_single_object, max_queue_size=image_saving_max_queue_size)
+    else:
+        im_saver = nullcontext()
+
+    with im_saver:
+        for ti, sample, msk, prob, out_mask, _ in frames:
+            if masks_out_path is not None:
+                _save_frame(config, mapper, vid_reader, im_saver, sample, out_mask, save_overlay)
+            yield FrameMask(ti=ti, frame=sample.frame, mask=mapper.remap_index_mask(out_mask),
+                            prob=prob if return_probabilities else None)
+        if masks_out_path is not None:
+            im_saver.wait_for_jobs_to_finish()
+
+
+def _iter_buffered(items, max_buffered: int):
+    # produces `items` on a background thread, at most `max_buffered` of them ahead of the consumer
+    buffer = queue.Queue(maxsize=max_buffered)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        # gives up once the consumer is gone
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            # grad mode is thread-local, so it has to be disabled on the producer thread as well
+            with torch.no_grad():
+                for item in items:
+                    if not put(item):
+                        return
+            put(end)
+        except Exception as e:
+            put(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
 def select_k_next_best_annotation_candidates(
     imgs_in_path: Union[str, PathLike],
     masks_in_path: Union[str, PathLike],  # at least the 1st frame
@@ -317,7 +878,9 @@ def select_k_next_best_annotation_candidates(
     Returns:
         list: A list of indices representing the selected next best annotation candidate frames.
     """
-    mapper, processor, vid_reader, loader = _load_main_objects(imgs_in_path, masks_in_path, VIDEO_INFERENCE_CONFIG)
+    # e.g., with a `feature_cache_dir`, the keys extracted here are reused by run_on_video below and in the next rounds
+    config = _get_config(masks_out_path, dict(kwargs.get('overwrite_config') or {}))
+    mapper, processor, vid_reader, loader = _load_main_objects(imgs_in_path, masks_in_path, config)
 
     # Extracting "key" feature maps
     # Could be combined with inference (like in GUI), but the code would be a mess
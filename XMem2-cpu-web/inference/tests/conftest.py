@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+# every object gets its own color, as in the masks of the GUI
+PALETTE = [0, 0, 0, 255, 0, 0, 0, 255, 0] + [0] * (256 * 3 - 9)
+
+
+def make_clip(root, num_frames=14, h=64, w=96, second_object_from=6):
+    # a synthetic clip with a mask for every frame: object 1 moves right from frame 0,
+    # object 2 moves left from `second_object_from` on, so that the objects enter on different annotated frames
+    imgs_dir = os.path.join(root, 'imgs')
+    masks_dir = os.path.join(root, 'masks')
+    os.makedirs(imgs_dir, exist_ok=True)
+    os.makedirs(masks_dir, exist_ok=True)
+    rng = np.random.default_rng(0)
+    for ti in range(num_frames):
+        image = (rng.random((h, w, 3)) * 60).astype(np.uint8)
+        mask = np.zeros((h, w), dtype=np.uint8)
+        mask[10:30, 8+2*ti:28+2*ti] = 1
+        if ti >= second_object_from:
+            mask[36:56, 60-ti:80-ti] = 2
+        image[mask == 1] = (200, 40, 40)
+        image[mask == 2] = (40, 200, 40)
+        name = f'frame_{ti:06d}.png'
+        Image.fromarray(image).save(os.path.join(imgs_dir, name))
+        mask_image = Image.fromarray(mask, mode='P')
+        mask_image.putpalette(PALETTE)
+        mask_image.save(os.path.join(masks_dir, name))
+    return imgs_dir, masks_dir
+
+
+@pytest.fixture
+def two_object_clip(tmp_path):
+    # (frames directory, masks directory), the second object first appears on frame 6
+    return make_clip(str(tmp_path / 'clip'))
+
+
+@pytest.fixture
+def video_config():
+    # a small randomly initialized network (no weights needed) at a small processing size
+    return {'model': None, 'size': 64}
+
+
+@pytest.fixture(autouse=True)
+def no_grad():
+    with torch.no_grad():
+        torch.manual_seed(0)
+        yield
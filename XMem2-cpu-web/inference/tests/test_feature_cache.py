@@ -0,0 +1,66 @@
+import os
+
+import torch
+
+from inference.feature_cache import FeatureCache, frame_hash
+
+
+def random_features():
+    # (key, shrinkage, selection, f16, f8, f4) of one frame
+    return tuple(torch.randn(1, c, 4, 4) for c in (8, 1, 8, 16, 8, 4))
+
+
+def age(cache: FeatureCache, frame: str, mtime: float):
+    # pretends that frame was last used at mtime
+    for name in cache.names:
+        os.utime(cache._path(frame, name), (mtime, mtime))
+
+
+def test_get_or_encode_only_encodes_missing_frames(tmp_path):
+    network = torch.nn.Linear(2, 2)
+    images = torch.randn(3, 3, 16, 16)
+    encoded = []
+
+    def encode(batch):
+        encoded.append(len(batch))
+        return tuple(f.repeat(len(batch), 1, 1, 1) for f in random_features())
+
+    cache = FeatureCache(str(tmp_path), network)
+    first = cache.get_or_encode(images[:2], encode)
+    second = cache.get_or_encode(images, encode)
+    # only the third frame was encoded the second time
+    assert encoded == [2, 1]
+    assert (cache.hits, cache.misses) == (2, 3)
+    for f1, f2 in zip(first, second):
+        assert torch.equal(f1, f2[:2])
+
+    # the cache is keyed by the weights
+    with torch.no_grad():
+        network.weight.add_(1)
+    assert FeatureCache(str(tmp_path), network).load(frame_hash(images[0])) is None
+
+
+def test_least_recently_used_frames_are_evicted(tmp_path):
+    network = torch.nn.Linear(2, 2)
+    # a frame of older weights, never used again
+    old_cache = FeatureCache(str(tmp_path), network, checksum='old')
+    old_cache.save('old', random_features())
+    frame_nbytes = old_cache._total_bytes(old_cache._scan())
+    age(old_cache, 'old', 1000)
+
+    cache = FeatureCache(str(tmp_path), network, checksum='new', max_bytes=int(3.5 * frame_nbytes))
+    for t, frame in enumerate(('a0', 'b0')):
+        cache.save(frame, random_features())
+        age(cache, frame, 2000 + t)
+    assert cache.load('a0') is not None  # a0 is now the most recently used
+
+    cache.save('c0', random_features())
+    # 4 frames > 3.5: the old weights' frame goes first, with its directory
+    assert not os.path.exists(old_cache.directory)
+    assert cache.nbytes == 3 * frame_nbytes
+
+    cache.save('d0', random_features())
+    assert cache.load('b0') is None
+    for frame in ('a0', 'c0', 'd0'):
+        assert cache.load(frame) is not None
+    assert cache.nbytes == cache._total_bytes(cache._scan()) == 3 * frame_nbytes
@@ -0,0 +1,66 @@
+import torch
+
+from inference.kv_memory_store import GrowingBuffer, MappedAllocator, QuantizedBuffer, load_buffer
+
+
+def test_growing_buffer_matches_torch_cat(tmp_path):
+    for allocator in (None, MappedAllocator(str(tmp_path))):
+        chunks = [torch.randn(2, 3, n) for n in (1, 5, 16, 3, 40)]
+        buffer = GrowingBuffer(chunks[0], min_capacity=4, allocator=allocator)
+        expected = chunks[0]
+        for chunk in chunks[1:]:
+            buffer.append(chunk)
+            expected = torch.cat([expected, chunk], -1)
+            assert torch.equal(buffer.data, expected)
+
+        buffer.keep_outside(10, 20)
+        expected = torch.cat([expected[..., :10], expected[..., 20:]], -1)
+        assert torch.equal(buffer.data, expected)
+
+        mask = torch.arange(expected.shape[-1]) % 3 != 0
+        buffer.keep_mask(mask)
+        expected = expected[..., mask]
+        assert torch.equal(buffer.data, expected)
+
+        buffer.truncate(7)
+        assert torch.equal(buffer.data, expected[..., :7])
+        assert torch.equal(load_buffer(buffer.state_dict()).data, expected[..., :7])
+
+
+def test_growing_buffer_grows_geometrically():
+    buffer = GrowingBuffer(torch.zeros(1, 2, 1), min_capacity=1)
+    capacities = {buffer.capacity}
+    for i in range(1, 1000):
+        buffer.append(torch.full((1, 2, 1), float(i)))
+        capacities.add(buffer.capacity)
+    # re-allocated log2(1000) times, not on every append
+    assert sorted(capacities) == [2**i for i in range(11)]
+    assert torch.equal(buffer.data[0, 0], torch.arange(1000, dtype=torch.float32))
+
+
+def test_move_to_keeps_the_data(tmp_path):
+    init = torch.randn(1, 4, 10)
+    buffer = GrowingBuffer(init)
+    buffer.move_to(MappedAllocator(str(tmp_path)))
+    assert torch.equal(buffer.data, init)
+    # and further growth comes from the new allocator
+    buffer.append(torch.ones(1, 4, 30))
+    assert torch.equal(buffer.data[..., :10], init)
+    assert buffer.allocator is not None
+
+
+def test_quantized_buffer():
+    chunks = [torch.randn(2, 8, n) for n in (3, 20, 7)]
+    expected = torch.cat(chunks, -1)
+    for dtype, atol in ((torch.float16, 1e-2), (torch.bfloat16, 5e-2), (torch.int8, 5e-2)):
+        buffer = QuantizedBuffer(chunks[0], dtype)
+        for chunk in chunks[1:]:
+            buffer.append(chunk)
+        assert buffer.stored.dtype == dtype
+        assert buffer.data.dtype == torch.float32
+        torch.testing.assert_close(buffer.data, expected, atol=atol, rtol=0.02)
+
+        # the quantized elements are saved as they are
+        restored = load_buffer(buffer.state_dict())
+        assert torch.equal(restored.stored, buffer.stored)
+        assert torch.equal(restored.data, buffer.data)
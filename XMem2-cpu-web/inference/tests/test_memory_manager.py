@@ -0,0 +1,175 @@
+import pytest
+import torch
+
+from inference.memory_manager import MemoryManager
+from model.memory_util import do_softmax, get_similarity
+from util.configuration import VIDEO_INFERENCE_CONFIG
+
+KEY_DIM = 16
+VALUE_DIM = 32
+H, W = 4, 6
+
+
+def make_config(**overrides):
+    config = VIDEO_INFERENCE_CONFIG.copy()
+    # the readout of the original XMem (dense, all query positions at once) unless overridden
+    config.update(key_dim=KEY_DIM, value_dim=VALUE_DIM, hidden_dim=8, top_k=8, sparse_readout=False, readout_chunk_bytes=None)
+    config.update(overrides)
+    return config
+
+
+def random_frame(num_objects):
+    key = torch.randn(1, KEY_DIM, H, W)
+    shrinkage = torch.rand(1, 1, H, W) + 1
+    selection = torch.rand(1, KEY_DIM, H, W)
+    value = torch.randn(1, num_objects, VALUE_DIM, H, W)
+    return key, shrinkage, selection, value
+
+
+def add_frame(memory: MemoryManager, objects, permanent=False, ti=None):
+    key, shrinkage, selection, value = random_frame(len(objects))
+    memory.add_memory(key, shrinkage, value, objects, selection=selection, permanent=permanent, ti=ti)
+
+
+def fill_memory(memory: MemoryManager, frames, permanent_frames=(0, 5)):
+    # frames: random_frame(1) per video frame, the ones in permanent_frames go to the permanent memory
+    for ti, (key, shrinkage, selection, value) in enumerate(frames):
+        memory.add_memory(key, shrinkage, value, [1], selection=selection, permanent=ti in permanent_frames, ti=ti)
+    return memory
+
+
+def reference_readout(memory: MemoryManager, query_key, query_selection):
+    # the readout of the original XMem: dense top-k softmax over the concatenated temporary and permanent memory
+    stores = [memory.temporary_work_mem, memory.permanent_work_mem]
+    key = torch.cat([store.key for store in stores], -1)
+    shrinkage = torch.cat([store.shrinkage for store in stores], -1)
+    value = torch.cat([store.value[0] for store in stores], -1)
+    affinity = do_softmax(get_similarity(key, shrinkage, query_key, query_selection), top_k=memory.top_k)
+    return (value @ affinity).view(-1, VALUE_DIM, H, W)
+
+
+@pytest.mark.parametrize('overrides', [
+    {},
+    {'sparse_readout': True},
+    {'readout_chunk_bytes': 1},
+    {'sparse_readout': True, 'readout_chunk_bytes': 1},
+    # all frames are selected, so the coarse stage does not drop anything
+    {'readout_top_frames': 6},
+    {'permanent_top_frames': 2},
+    # every list is probed, so the search is exact
+    {'ann_readout': True, 'ann_num_lists': 2, 'ann_num_probes': 2},
+    # everything is spilled to memory-mapped files
+    {'memory_budget_bytes': 0},
+], ids=str)
+def test_readout_matches_the_original_readout(overrides):
+    frames = [random_frame(1) for _ in range(6)]
+    query_key, _, query_selection, _ = random_frame(1)
+    memory = fill_memory(MemoryManager(config=make_config(**overrides)), frames)
+
+    readout = memory.match_memory(query_key, query_selection, ti=6)
+    torch.testing.assert_close(readout, reference_readout(memory, query_key, query_selection))
+
+
+@pytest.mark.parametrize('dtype', ['float16', 'bfloat16', 'int8'])
+def test_reduced_precision_readout_is_close_to_float32(dtype):
+    frames = [random_frame(1) for _ in range(6)]
+    query_key, _, query_selection, _ = random_frame(1)
+    expected = fill_memory(MemoryManager(config=make_config()), frames).match_memory(query_key, query_selection)
+
+    for sparse_readout in (False, True):
+        memory = fill_memory(MemoryManager(config=make_config(memory_value_dtype=dtype, sparse_readout=sparse_readout)), frames)
+        torch.testing.assert_close(memory.match_memory(query_key, query_selection), expected, atol=0.05, rtol=0.05)
+
+
+def test_state_dict_round_trip():
+    frames = [random_frame(1) for _ in range(8)]
+    query_key, _, query_selection, _ = random_frame(1)
+    # small enough for the long-term memory to be used
+    config = make_config(max_mid_term_frames=3, min_mid_term_frames=1, num_prototypes=8)
+    memory = fill_memory(MemoryManager(config=config), frames[:6])
+    memory.create_hidden_state(1, query_key)
+    assert memory.long_mem.engaged()
+
+    restored = MemoryManager(config=config)
+    restored.load_state_dict(memory.state_dict())
+    assert restored.frame_id_to_permanent_mem_idx == memory.frame_id_to_permanent_mem_idx
+    torch.testing.assert_close(restored.get_hidden(), memory.get_hidden())
+
+    # both go on the same way
+    for ti, (key, shrinkage, selection, value) in enumerate(frames[6:], start=6):
+        torch.testing.assert_close(restored.match_memory(query_key, query_selection),
+                                   memory.match_memory(query_key, query_selection))
+        for m in (memory, restored):
+            m.add_memory(key, shrinkage, value, [1], selection=selection, ti=ti)
+    torch.testing.assert_close(restored.match_memory(query_key, query_selection),
+                               memory.match_memory(query_key, query_selection))
+
+
+def test_long_term_eviction_with_several_object_groups():
+    # object 2 enters on frame 3, so its values only cover the last keys of every store
+    memory = MemoryManager(config=make_config(max_mid_term_frames=3, min_mid_term_frames=1, num_prototypes=8,
+                                              max_long_term_elements=24))
+    add_frame(memory, [1], permanent=True, ti=0)
+    query_key, _, query_selection, _ = random_frame(2)
+    for ti in range(1, 20):
+        if ti == 3:
+            add_frame(memory, [1, 2], permanent=True, ti=ti)
+        else:
+            add_frame(memory, [1] if ti < 3 else [1, 2], ti=ti)
+        num_objects = 1 if ti < 3 else 2
+        readout = memory.match_memory(query_key, query_selection)
+        assert readout.shape == (num_objects, VALUE_DIM, H, W)
+        assert torch.isfinite(readout).all()
+
+        long_mem = memory.long_mem
+        if long_mem.engaged():
+            assert long_mem.size <= 24
+            for gi in range(long_mem.num_groups):
+                assert long_mem.get_v_size(gi) <= long_mem.size
+    # obsolete features were removed from both groups
+    assert memory.long_mem.num_groups == 2
+
+
+def test_copy_perm_mem_only_keeps_the_object_groups():
+    # object 2 enters on a later annotated frame, so the permanent memory has two object groups
+    memory = MemoryManager(config=make_config())
+    add_frame(memory, [1], permanent=True, ti=0)
+    add_frame(memory, [1, 2], permanent=True, ti=6)
+    add_frame(memory, [1, 2], ti=7)
+    memory.create_hidden_state(2, torch.zeros(1, KEY_DIM, H, W))
+
+    copy = MemoryManager(config=make_config())
+    copy.load_state_dict(memory.copy_perm_mem_only().state_dict())
+    assert copy.permanent_work_mem.obj_groups == [[0], [1]]
+    assert copy.temporary_work_mem.obj_groups == copy.permanent_work_mem.obj_groups
+    assert copy.temporary_work_mem.num_groups == copy.permanent_work_mem.num_groups
+    assert copy.temporary_work_mem.size == 0
+
+    # and propagation goes on from it with both objects
+    query_key, _, query_selection, _ = random_frame(2)
+    assert copy.match_memory(query_key, query_selection).shape == (2, VALUE_DIM, H, W)
+    add_frame(copy, [1, 2], ti=8)
+    assert copy.match_memory(query_key, query_selection).shape == (2, VALUE_DIM, H, W)
+
+
+def test_readout_view_is_memory_mapped_before_the_stores_are_spilled():
+    frames = [random_frame(2) for _ in range(4)]
+    query_key, _, query_selection, _ = random_frame(2)
+
+    def run(**overrides):
+        memory = MemoryManager(config=make_config(**overrides))
+        for ti, (key, shrinkage, selection, value) in enumerate(frames):
+            memory.add_memory(key, shrinkage, value, [1, 2], selection=selection, permanent=ti == 0, ti=ti)
+        return memory, memory.match_memory(query_key, query_selection)
+
+    memory, expected = run()
+    stores_nbytes = memory.memory_nbytes()
+    # without a budget, the view is a second copy of the stores in regular memory
+    assert not memory.readout_view_mapped
+    assert memory.memory_ram_nbytes() > stores_nbytes
+
+    memory, readout = run(memory_budget_bytes=stores_nbytes)
+    assert memory.readout_view_mapped
+    assert not any(store.spilled for store in memory._get_all_stores())
+    assert memory.memory_ram_nbytes() == stores_nbytes
+    torch.testing.assert_close(readout, expected)
@@ -0,0 +1,173 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from inference.run_on_video import iter_video_masks, run_on_video
+from inference.tests.conftest import PALETTE
+
+FRAMES_WITH_MASKS = [0, 6, 10]
+
+
+def saved_masks(masks_out_path):
+    return sorted(os.listdir(os.path.join(masks_out_path, 'masks')))
+
+
+def read_masks(masks_out_path):
+    # frame name -> saved index mask
+    masks_dir = os.path.join(masks_out_path, 'masks')
+    return {name: np.array(Image.open(os.path.join(masks_dir, name))) for name in sorted(os.listdir(masks_dir))}
+
+
+def run(imgs, masks, out, video_config, config=None, **kwargs):
+    return run_on_video(imgs, masks, out, frames_with_masks=FRAMES_WITH_MASKS, print_progress=False,
+                        overwrite_config=dict(video_config, **(config or {})), **kwargs)
+
+
+@pytest.fixture
+def reference_masks(two_object_clip, video_config, tmp_path):
+    # the masks of a run with the default settings
+    out = str(tmp_path / 'reference')
+    stats = run(*two_object_clip, out, video_config)
+    assert list(stats['frame']) == sorted(os.listdir(two_object_clip[0]))
+    return read_masks(out)
+
+
+@pytest.mark.parametrize('config', [
+    {'key_lookahead': 4},
+    {'key_lookahead': 4, 'pipeline_key_encoding': True},
+], ids=str)
+def test_batched_key_encoding_gives_the_same_masks(two_object_clip, video_config, tmp_path, reference_masks, config):
+    out = str(tmp_path / 'out')
+    run(*two_object_clip, out, video_config, config)
+    assert_same_masks(read_masks(out), reference_masks)
+
+
+def test_feature_cache_gives_the_same_masks(two_object_clip, video_config, tmp_path, reference_masks):
+    config = {'feature_cache_dir': str(tmp_path / 'features')}
+    # the second run only reads the cached features
+    for out in ('out1', 'out2'):
+        run(*two_object_clip, str(tmp_path / out), video_config, config)
+        assert_same_masks(read_masks(str(tmp_path / out)), reference_masks)
+    assert len(os.listdir(tmp_path / 'features')) == 1  # a single model checksum
+
+
+def test_resume_from_a_checkpoint(two_object_clip, video_config, tmp_path, reference_masks):
+    out = str(tmp_path / 'out')
+    checkpoint = str(tmp_path / 'checkpoint.pth')
+    run(*two_object_clip, out, video_config, checkpoint_path=checkpoint, checkpoint_every=4)
+    for name in saved_masks(out)[9:]:
+        os.remove(os.path.join(out, 'masks', name))
+
+    # the last checkpoint is after frame 11
+    stats = run(*two_object_clip, out, video_config, resume_from=checkpoint)
+    assert list(stats['frame']) == ['frame_000012.png', 'frame_000013.png']
+    # frames 9-11 were not saved again
+    assert saved_masks(out) == sorted(reference_masks)[:9] + sorted(reference_masks)[12:]
+    assert_same_masks({name: mask for name, mask in read_masks(out).items() if name >= 'frame_000012.png'},
+                      {name: mask for name, mask in reference_masks.items() if name >= 'frame_000012.png'})
+
+
+@pytest.mark.parametrize('kwargs, config', [
+    # only the first frame is in memory at first, 4*4 elements at this size
+    ({'original_memory_mechanism': True}, {'top_k': 16}),
+    ({'direction': 'both'}, None),
+], ids=str)
+def test_propagation_modes(two_object_clip, video_config, tmp_path, kwargs, config):
+    imgs, _ = two_object_clip
+    out = str(tmp_path / 'out')
+    stats = run(*two_object_clip, out, video_config, config, **kwargs)
+    assert list(stats['frame']) == sorted(os.listdir(imgs))
+    assert saved_masks(out) == sorted(os.listdir(imgs))
+
+
+def test_iter_video_masks(two_object_clip, video_config, reference_masks):
+    imgs, masks = two_object_clip
+    frames = list(iter_video_masks(imgs, masks, frames_with_masks=FRAMES_WITH_MASKS, print_progress=False,
+                                   overwrite_config=dict(video_config), max_buffered_frames=2))
+    assert [frame.ti for frame in frames] == list(range(len(reference_masks)))
+    assert [frame.frame for frame in frames] == sorted(reference_masks)
+    # the saved masks are in the colors of the input masks
+    colors = np.array(PALETTE, dtype=np.uint8).reshape(-1, 3)
+    for frame in frames:
+        assert np.array_equal(colors[frame.mask], reference_masks[frame.frame])
+
+
+def assert_same_masks(masks, expected):
+    assert sorted(masks) == sorted(expected)
+    for name in expected:
+        assert np.array_equal(masks[name], expected[name]), name
+
+
+def test_parallel_segments_with_objects_entering_later(two_object_clip, video_config, tmp_path):
+    # the second object only appears on the annotated frame 6, so the segments start with different object groups
+    imgs, masks = two_object_clip
+    out = str(tmp_path / 'out')
+    stats = run_on_video(imgs, masks, out, frames_with_masks=[0, 6, 10], print_progress=False,
+                         num_segment_workers=2, overwrite_config=video_config)
+    assert list(stats['frame']) == sorted(os.listdir(imgs))
+    assert saved_masks(out) == sorted(os.listdir(imgs))
+
+
+def edit_mask(masks_dir, ti, edit):
+    # applies `edit` to the index mask of frame `ti` in place, keeping its palette
+    mask_path = os.path.join(masks_dir, f'frame_{ti:06d}.png')
+    mask = Image.open(mask_path)
+    index_mask = np.array(mask)
+    edit(index_mask)
+    edited = Image.fromarray(index_mask, mode='P')
+    edited.putpalette(mask.getpalette())
+    edited.save(mask_path)
+
+
+def run_with_checkpoints(imgs, masks, out, checkpoint_dir, checkpoint_every, video_config, **kwargs):
+    return run_on_video(imgs, masks, out, frames_with_masks=[0, 6, 10], print_progress=False,
+                        checkpoint_path=os.path.join(checkpoint_dir, '{ti}.pth'), checkpoint_every=checkpoint_every,
+                        overwrite_config=dict(video_config), **kwargs)
+
+
+def test_edit_repropagation_with_several_object_groups(two_object_clip, video_config, tmp_path):
+    imgs, masks = two_object_clip
+    out = str(tmp_path / 'out')
+    checkpoints = str(tmp_path / 'checkpoints')
+    os.makedirs(checkpoints)
+    run_with_checkpoints(imgs, masks, out, checkpoints, 1, video_config)
+
+    # more pixels of object 1 on frame 10, no new object
+    edit_mask(masks, 10, lambda m: m.__setitem__((slice(30, 34), slice(28, 48)), 1))
+    stats = run_with_checkpoints(imgs, masks, out, checkpoints, 1, video_config,
+                                 edited_frame=10, stop_after_unchanged_frames=2)
+    # continued from the checkpoint of frame 9
+    assert stats['frame'].iloc[0] == 'frame_000010.png'
+
+
+def test_edit_repropagation_counts_unchanged_frames_after_the_edit(two_object_clip, video_config, tmp_path):
+    imgs, masks = two_object_clip
+    out = str(tmp_path / 'out')
+    checkpoints = str(tmp_path / 'checkpoints')
+    os.makedirs(checkpoints)
+    # checkpoints after frames 3, 7 and 11
+    run_with_checkpoints(imgs, masks, out, checkpoints, 4, video_config)
+
+    edit_mask(masks, 10, lambda m: m.__setitem__((slice(30, 34), slice(28, 48)), 1))
+    stats = run_with_checkpoints(imgs, masks, out, checkpoints, 4, video_config,
+                                 edited_frame=10, stop_after_unchanged_frames=2)
+    # frames 8 and 9 are unchanged, but come before the edit
+    frames = list(stats['frame'])
+    assert frames[:5] == [f'frame_{ti:06d}.png' for ti in range(8, 13)]
+
+
+def test_edit_repropagation_falls_back_to_a_full_run(two_object_clip, video_config, tmp_path):
+    imgs, masks = two_object_clip
+    out = str(tmp_path / 'out')
+    checkpoints = str(tmp_path / 'checkpoints')
+    os.makedirs(checkpoints)
+    run_with_checkpoints(imgs, masks, out, checkpoints, 1, video_config)
+
+    # object 2 is removed from all annotations, the checkpointed memory has a group for it
+    for ti in (6, 10):
+        edit_mask(masks, ti, lambda m: m.__setitem__(m == 2, 0))
+    with pytest.warns(UserWarning, match='propagating over the whole video'):
+        stats = run_with_checkpoints(imgs, masks, out, checkpoints, 1, video_config, edited_frame=6)
+    assert list(stats['frame']) == sorted(os.listdir(imgs))
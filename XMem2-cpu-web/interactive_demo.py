@@ -12,7 +12,8 @@ from argparse import ArgumentParser
 
 import torch
 
-from model.network import XMem
+from inference.model_registry import MODEL_REGISTRY
+from inference.quantization import is_quantized_checkpoint, load_quantized_s2m
 from inference.interact.s2m_controller import S2MController
 from inference.interact.fbrs_controller import FBRSController
 from inference.interact.s2m.s2m_network import deeplabv3plus_resnet50 as S2M
@@ -60,6 +61,13 @@ if __name__ == '__main__':
     parser.add_argument('--mem_every', type=int, default=10)
     parser.add_argument('--deep_update_every', help='Leave -1 normally to synchronize with mem_every', type=int, default=-1)
     parser.add_argument('--no_amp', help='Turn off AMP', action='store_true')
+    parser.add_argument('--feature_cache_dir', help='Persistent cache of the key encoder features, reused across sessions (disabled by default). '
+                        'Takes ~47MB of disk per frame at 480p', default=None)
+    parser.add_argument('--feature_cache_max_bytes', help='Disk budget of the feature cache, the least recently used frames are removed past it',
+                        type=int, default=20 * 1024**3)
+    parser.add_argument('--cpu_profile', help='CPU execution profile of XMem: channels_last or bf16 (default: float32 as is)', choices=['channels_last', 'bf16'], default=None)
+    parser.add_argument('--shared_weights_dir', help='Keeps the XMem and f-BRS weights in files mapped by all processes on the node, '
+                        'e.g., several demo instances (disabled by default)', default=None)
     parser.add_argument('--size', default=480, type=int, 
             help='Resize the shorter side to this size. -1 to use original resolution. ')
     args = parser.parse_args()
@@ -70,14 +78,17 @@ if __name__ == '__main__':
 
     device = 'cpu'
 
-    # Load our checkpoint
-    network = XMem(config, args.model, pretrained_key_encoder=False, pretrained_value_encoder=False).to(device).eval()
+    # Load our checkpoint (float or int8 from quantize_model.py)
+    network, prepared = MODEL_REGISTRY.get(config)
 
     # Loads the S2M model
     if args.s2m_model is not None:
         s2m_saved = torch.load(args.s2m_model, map_location='cpu')
-        s2m_model = S2M().to(device).eval()
-        s2m_model.load_state_dict(s2m_saved)
+        if is_quantized_checkpoint(s2m_saved):
+            s2m_model = load_quantized_s2m(s2m_saved)
+        else:
+            s2m_model = S2M().to(device).eval()
+            s2m_model.load_state_dict(s2m_saved)
     else:
         s2m_model = None
 
@@ -89,10 +100,10 @@ if __name__ == '__main__':
 
     s2m_controller = S2MController(s2m_model, num_objects, ignore_class=255)
     if args.fbrs_model is not None:
-        fbrs_controller = FBRSController(args.fbrs_model)
+        fbrs_controller = FBRSController(args.fbrs_model, shared_weights_dir=args.shared_weights_dir)
     else:
         fbrs_controller = None
 
     app = QApplication(sys.argv)
-    ex = App(network, resource_manager, s2m_controller, fbrs_controller, config)
+    ex = App(network, resource_manager, s2m_controller, fbrs_controller, config, prepared=prepared)
     sys.exit(app.exec_())
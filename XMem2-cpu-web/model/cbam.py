@@ -32,11 +32,12 @@ class ChannelGate(nn.Module):
     def forward(self, x):
         channel_att_sum = None
         for pool_type in self.pool_types:
+            # global pooling, adaptive so that it is exported with dynamic spatial sizes (see model/export.py)
             if pool_type=='avg':
-                avg_pool = F.avg_pool2d( x, (x.size(2), x.size(3)), stride=(x.size(2), x.size(3)))
+                avg_pool = F.adaptive_avg_pool2d( x, 1 )
                 channel_att_raw = self.mlp( avg_pool )
             elif pool_type=='max':
-                max_pool = F.max_pool2d( x, (x.size(2), x.size(3)), stride=(x.size(2), x.size(3)))
+                max_pool = F.adaptive_max_pool2d( x, 1 )
                 channel_att_raw = self.mlp( max_pool )
 
             if channel_att_sum is None:
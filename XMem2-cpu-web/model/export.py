@@ -0,0 +1,130 @@
+"""
+Export of the XMem stages as standalone graphs (TorchScript or ONNX), see export_model.py
+
+Three graphs are exported, all with dynamic batch, object and spatial axes:
+- key_encoder: KeyEncoder + KeyProjection, frame -> key, shrinkage, selection, f16, f8, f4
+- value_encoder: ValueEncoder, (frame, f16, hidden, masks, others) -> value, hidden
+- decoder: Decoder, (f16, f8, f4, hidden, memory_readout) -> hidden, logits
+
+The parts that depend on the memory (readout) or on the number of objects (the masks of the other objects,
+the aggregation of the logits) stay in Python, see inference/exported_network.py.
+The graphs always compute the deep-updated (value_encoder) and the updated (decoder) hidden state,
+callers that do not need them discard them.
+"""
+
+import inspect
+import os
+
+import torch
+import torch.nn as nn
+
+from model.network import XMem
+
+
+class KeyEncoderGraph(nn.Module):
+    def __init__(self, network: XMem):
+        super().__init__()
+        self.key_encoder = network.key_encoder
+        self.key_proj = network.key_proj
+
+    def forward(self, frame):
+        f16, f8, f4 = self.key_encoder(frame)
+        key, shrinkage, selection = self.key_proj(f16, True, True)
+        return key, shrinkage, selection, f16, f8, f4
+
+
+class ValueEncoderGraph(nn.Module):
+    def __init__(self, network: XMem):
+        super().__init__()
+        self.value_encoder = network.value_encoder
+
+    def forward(self, frame, f16, hidden, masks, others):
+        return self.value_encoder(frame, f16, hidden, masks, others, is_deep_update=True)
+
+
+class DecoderGraph(nn.Module):
+    def __init__(self, network: XMem):
+        super().__init__()
+        self.decoder = network.decoder
+
+    def forward(self, f16, f8, f4, hidden, memory_readout):
+        return self.decoder(f16, f8, f4, hidden, memory_readout, h_out=True)
+
+
+# name: (graph, input names, output names)
+GRAPHS = {
+    'key_encoder': (KeyEncoderGraph, ['frame'], ['key', 'shrinkage', 'selection', 'f16', 'f8', 'f4']),
+    'value_encoder': (ValueEncoderGraph, ['frame', 'f16', 'hidden', 'masks', 'others'], ['value', 'hidden_out']),
+    'decoder': (DecoderGraph, ['f16', 'f8', 'f4', 'hidden', 'memory_readout'], ['hidden_out', 'logits']),
+}
+
+# dynamic axes of every input/output, by their (shared) names
+DYNAMIC_AXES = {
+    'frame': {0: 'batch', 2: 'height', 3: 'width'},
+    'key': {0: 'batch', 2: 'height16', 3: 'width16'},
+    'shrinkage': {0: 'batch', 2: 'height16', 3: 'width16'},
+    'selection': {0: 'batch', 2: 'height16', 3: 'width16'},
+    'f16': {0: 'batch', 2: 'height16', 3: 'width16'},
+    'f8': {0: 'batch', 2: 'height8', 3: 'width8'},
+    'f4': {0: 'batch', 2: 'height4', 3: 'width4'},
+    'hidden': {0: 'batch', 1: 'objects', 3: 'height16', 4: 'width16'},
+    'hidden_out': {0: 'batch', 1: 'objects', 3: 'height16', 4: 'width16'},
+    'masks': {0: 'batch', 1: 'objects', 2: 'height', 3: 'width'},
+    'others': {0: 'batch', 1: 'objects', 2: 'height', 3: 'width'},
+    'value': {0: 'batch', 1: 'objects', 3: 'height16', 4: 'width16'},
+    'memory_readout': {0: 'batch', 1: 'objects', 3: 'height16', 4: 'width16'},
+    'logits': {0: 'batch', 1: 'objects', 2: 'height', 3: 'width'},
+}
+
+FILE_EXTENSIONS = {'torchscript': '.pt', 'onnx': '.onnx'}
+
+
+def example_inputs(network: XMem, name: str, h=480, w=864, num_objects=2):
+    # inputs of graph `name` for a (padded) h*w frame, for tracing and benchmarks
+    frame = torch.randn(1, 3, h, w)
+    f16 = torch.randn(1, 1024, h//16, w//16)
+    hidden = torch.randn(1, num_objects, network.hidden_dim, h//16, w//16)
+    if name == 'key_encoder':
+        return (frame, )
+    if name == 'value_encoder':
+        masks = torch.rand(1, num_objects, h, w)
+        return (frame, f16, hidden, masks, XMem.get_other_masks(masks))
+    if name == 'decoder':
+        f8 = torch.randn(1, 512, h//8, w//8)
+        f4 = torch.randn(1, 256, h//4, w//4)
+        memory_readout = torch.randn(1, num_objects, network.value_dim, h//16, w//16)
+        return (f16, f8, f4, hidden, memory_readout)
+    raise ValueError(f'Unknown graph: {name}')
+
+
+def graph_path(directory, name: str, format: str):
+    return os.path.join(directory, name + FILE_EXTENSIONS[format])
+
+
+def export_network(network: XMem, directory, format='onnx', opset_version=14):
+    # exports all graphs of `network` (in eval mode) to `directory`, returns their paths by name
+    if format not in FILE_EXTENSIONS:
+        raise ValueError(f'Unknown export format: {format}, expected one of {tuple(FILE_EXTENSIONS)}')
+    if network.hidden_dim == 0:
+        raise NotImplementedError('Exporting networks without a hidden state is not supported')
+    network = network.eval()
+    os.makedirs(directory, exist_ok=True)
+
+    paths = {}
+    for name, (graph, input_names, output_names) in GRAPHS.items():
+        module = graph(network).eval()
+        inputs = example_inputs(network, name)
+        path = graph_path(directory, name, format)
+        with torch.no_grad():
+            if format == 'torchscript':
+                torch.jit.trace(module, inputs).save(path)
+            else:
+                export_kwargs = {}
+                if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+                    # the dynamo exporter takes dynamic_shapes instead of dynamic_axes
+                    export_kwargs['dynamo'] = False
+                torch.onnx.export(module, inputs, path, input_names=input_names, output_names=output_names,
+                                  dynamic_axes={n: DYNAMIC_AXES[n] for n in input_names + output_names},
+                                  opset_version=opset_version, **export_kwargs)
+        paths[name] = path
+    return paths
@@ -23,6 +23,12 @@ def upsample_groups(g, ratio=2, mode='bilinear', align_corners=False):
     return interpolate_groups(g, ratio, mode, align_corners)
 
 def downsample_groups(g, ratio=1/2, mode='area', align_corners=None):
+    if mode == 'area' and (1/ratio).is_integer():
+        # the same as area interpolation for sizes that are multiples of 1/ratio (always the case for padded frames),
+        # but with a fixed kernel, so that it is exported with dynamic spatial sizes (see model/export.py)
+        batch_size, num_objects = g.shape[:2]
+        g = F.avg_pool2d(g.flatten(start_dim=0, end_dim=1), kernel_size=int(1/ratio))
+        return g.view(batch_size, num_objects, *g.shape[1:])
     return interpolate_groups(g, ratio, mode, align_corners)
 
 
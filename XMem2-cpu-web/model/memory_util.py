@@ -38,6 +38,39 @@ def get_similarity(mk, ms, qk, qe):
 
     return similarity
 
+def get_similarity_terms(mk, ms):
+    # memory-side terms of get_similarity, they only depend on the memory and can be kept with it
+    # mk: B x CK x [N]    - Memory keys
+    # ms: B x  1 x [N]    - Memory shrinkage
+    # returns B x (2*CK+1) x [N], i.e., [mk^2; mk; 1] scaled by the shrinkage
+    mk = mk.flatten(start_dim=2)
+    ms = ms.flatten(start_dim=2) if ms is not None else torch.ones_like(mk[:, :1])
+    return torch.cat([mk.pow(2), mk, torch.ones_like(ms)], 1) * ms
+
+def get_similarity_query_terms(qk, qe):
+    # query-side terms matching get_similarity_terms, such that
+    # get_similarity(mk, ms, qk, qe) == get_similarity_terms(mk, ms)^T @ get_similarity_query_terms(qk, qe)
+    # qk: B x CK x [HW/P] - Query keys
+    # qe: B x CK x [HW/P] - Query selection
+    # returns B x (2*CK+1) x [HW/P]
+    CK = qk.shape[1]
+    qk = qk.flatten(start_dim=2)
+    qe = qe.flatten(start_dim=2) if qe is not None else None
+
+    if qe is not None:
+        b_sq = (qe * qk.pow(2)).sum(1, keepdim=True)
+        q_terms = torch.cat([-qe, 2 * qk * qe, -b_sq], 1)
+    else:
+        q_terms = torch.cat([-torch.ones_like(qk), 2 * qk, torch.zeros_like(qk[:, :1])], 1)
+
+    return q_terms / math.sqrt(CK)
+
+def get_similarity_from_terms(m_terms, qk, qe):
+    # same as get_similarity(mk, ms, qk, qe) with m_terms = get_similarity_terms(mk, ms)
+    # the query terms are stacked to match, so the whole similarity is a single matmul
+    # without any B x N x [HW/P] intermediates
+    return m_terms.transpose(1, 2) @ get_similarity_query_terms(qk, qe)   # B*N*HW
+
 def do_softmax(similarity, top_k: Optional[int]=None, inplace=False, return_usage=False):
     # normalize similarity with top-k softmax
     # similarity: B x N x [HW/P]
@@ -64,6 +97,63 @@ def do_softmax(similarity, top_k: Optional[int]=None, inplace=False, return_usag
 
     return affinity
 
+def do_softmax_topk(similarity, top_k: int, return_usage=False):
+    # sparse version of do_softmax with top-k
+    # instead of scattering into a dense B x N x [HW/P] affinity, only the top-k weights and their indices are kept
+    # similarity: B x N x [HW/P]
+    # returns (weights, indices), both B x top_k x [HW/P]; see readout_topk
+    values, indices = torch.topk(similarity, k=top_k, dim=1)
+
+    return softmax_topk_values(values, indices, similarity.shape[1], return_usage=return_usage)
+
+def softmax_topk_values(values, indices, num_memory: int, return_usage=False):
+    # normalizes already selected top-k similarities (e.g., from an approximate search) like do_softmax_topk
+    # values/indices: B x top_k x [HW/P], num_memory: N
+    # -inf values (padding) get zero weight
+    x_exp = values.exp_()
+    x_exp /= torch.sum(x_exp, dim=1, keepdim=True)
+
+    if return_usage:
+        # same as affinity.sum(dim=2) of the dense affinity
+        usage = torch.zeros((values.shape[0], num_memory), device=values.device, dtype=x_exp.dtype)
+        usage.scatter_add_(1, indices.flatten(start_dim=1), x_exp.flatten(start_dim=1))
+        return (x_exp, indices), usage
+
+    return x_exp, indices
+
+def readout_topk(weights, indices, mv, scale=None):
+    # readout with the sparse affinity from do_softmax_topk
+    # equivalent to mv @ affinity, but only gathers top_k memory elements per query position
+    # weights/indices: 1 x top_k x [HW/P] (a single query, as in inference)
+    # mv: B x CV x N; should be a transposed view of a contiguous B x N x CV tensor
+    #     so that the gathered memory elements are contiguous in memory
+    #     may be stored in reduced precision, only the gathered elements are converted
+    # scale: optional B x 1 x N per-element scales of int8 values, folded into the weights
+    assert weights.shape[0] == 1, 'sparse readout only supports a single query'
+    mv = mv.transpose(1, 2)
+    if not mv.is_contiguous():
+        mv = mv.contiguous()
+    B, N, CV = mv.shape
+
+    mem = torch.zeros((B, indices.shape[-1], CV), device=mv.device, dtype=weights.dtype)
+    for ki in range(indices.shape[1]):
+        w = weights[0, ki]
+        if scale is not None:
+            w = w * scale[:, 0].index_select(1, indices[0, ki])  # B x [HW/P]
+        mem.addcmul_(mv.index_select(1, indices[0, ki]).to(mem.dtype), w.unsqueeze(-1))
+
+    return mem.transpose(1, 2)  # B x CV x [HW/P]
+
+def readout_dense(affinity, mv, scale=None):
+    # mv @ affinity for values that may be stored in reduced precision
+    # affinity: 1 x N x [HW/P], mv: B x CV x N
+    # scale: optional B x 1 x N per-element scales of int8 values, folded into the affinity
+    if scale is not None:
+        affinity = affinity * scale.transpose(1, 2)
+    if mv.dtype != affinity.dtype:
+        mv = mv.to(affinity.dtype)
+    return mv @ affinity
+
 def get_affinity(mk, ms, qk, qe):
     # shorthand used in training with no top-k
     similarity = get_similarity(mk, ms, qk, qe)
@@ -71,6 +71,15 @@ class XMem(nn.Module):
         return key, shrinkage, selection, f16, f8, f4
 
     def encode_value(self, frame, image_feat_f16, h16, masks, is_deep_update=True): 
+        others = self.get_other_masks(masks)
+
+        g16, h16 = self.value_encoder(frame, image_feat_f16, h16, masks, others, is_deep_update)
+
+        return g16, h16
+
+    @staticmethod
+    def get_other_masks(masks):
+        # for every object, the sum of the masks of all other objects
         num_objects = masks.shape[1]
         if num_objects != 1:
             others = torch.cat([
@@ -80,10 +89,7 @@ class XMem(nn.Module):
             for i in range(num_objects)], 1)
         else:
             others = torch.zeros_like(masks)
-
-        g16, h16 = self.value_encoder(frame, image_feat_f16, h16, masks, others, is_deep_update)
-
-        return g16, h16
+        return others
 
     # Used in training only. 
     # This step is replaced by MemoryManager in test time
@@ -109,6 +115,13 @@ class XMem(nn.Module):
                     hidden_state, selector=None, h_out=True, strip_bg=True): 
 
         hidden_state, logits = self.decoder(*multi_scale_features, hidden_state, memory_readout, h_out=h_out)
+        logits, prob = self.get_probabilities(logits, selector, strip_bg)
+
+        return hidden_state, logits, prob
+
+    @staticmethod
+    def get_probabilities(logits, selector=None, strip_bg=True):
+        # per-object decoder logits -> (logits, probabilities) with the background
         prob = torch.sigmoid(logits)
         if selector is not None:
             prob = prob * selector
@@ -118,7 +131,7 @@ class XMem(nn.Module):
             # Strip away the background
             prob = prob[:, 1:]
 
-        return hidden_state, logits, prob
+        return logits, prob
 
     def forward(self, mode, *args, **kwargs):
         if mode == 'encode_key':
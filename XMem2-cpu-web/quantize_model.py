@@ -0,0 +1,140 @@
+"""
+Post-training int8 quantization of the XMem stages (key encoder, value encoder, decoder) and of S2M, see inference/quantization.py
+
+The quantized XMem checkpoint is loaded through config['model'] (or --model of interactive_demo.py) like the float weights,
+the quantized S2M one through --s2m_model of interactive_demo.py.
+'static' calibrates the activation ranges on --calibration_frames frames of a clip, propagating from its first mask
+(and S2M on scribbles generated from all masks among these frames), e.g.:
+
+python quantize_model.py --mode static --calibration_imgs imgs_dir --calibration_masks masks_dir --output saves/XMem_int8.pth \\
+    --s2m_model saves/s2m.pth --s2m_output saves/s2m_int8.pth
+
+For the J&F and speed deltas w.r.t. the float32 networks, see benchmark_quantization.py
+"""
+
+import argparse
+import os
+
+import cv2
+import numpy as np
+import torch
+
+from inference.data.mask_mapper import MaskMapper
+from inference.data.video_reader import VideoReader
+from inference.interact.s2m.s2m_network import deeplabv3plus_resnet50 as S2M
+from inference.quantization import (QUANTIZATION_MODES, XMEM_STAGES, calibrate_s2m, calibrate_xmem, convert_quantization,
+                                    prepare_quantization, quantization_info, s2m_quantization_checkpoint,
+                                    xmem_quantization_checkpoint)
+from model.network import XMem
+from util.configuration import VIDEO_INFERENCE_CONFIG
+
+
+def load_frame(vid_reader: VideoReader, mapper: MaskMapper, ti: int):
+    # (image, one-hot masks or None, labels or None) of frame ti, as in the propagation
+    sample = vid_reader[ti]
+    mask = labels = None
+    if sample.mask is not None:
+        mask, labels = mapper.convert_mask(sample.mask, exhaustive=True)
+        if sample.need_resize:
+            mask = vid_reader.resize_mask(mask.unsqueeze(0))[0]
+    return sample.rgb, mask, labels
+
+
+def load_calibration_frames(imgs_in_path, masks_in_path, size: int, num_frames: int):
+    # `num_frames` frames from the first frame with a mask on
+    vid_reader = VideoReader('', imgs_in_path, masks_in_path, size=size, use_all_masks=True)
+    mapper = MaskMapper()
+    frames = []
+    for ti in range(len(vid_reader)):
+        if len(frames) == 0 and not os.path.exists(os.path.join(masks_in_path, vid_reader.frames[ti][:-4] + '.png')):
+            continue
+        frames.append(load_frame(vid_reader, mapper, ti))
+        if len(frames) == num_frames:
+            break
+    if len(frames) == 0:
+        raise ValueError(f'No masks found in {masks_in_path}')
+    return frames
+
+
+def stroke(label_mask: np.ndarray, rng: np.random.Generator, thickness=3):
+    # a scribble as in the GUI (see ScribbleInteraction): a line between two random pixels of the region, within the region
+    ys, xs = np.nonzero(label_mask)
+    i, j = rng.integers(len(ys), size=2)
+    line = cv2.line(np.zeros(label_mask.shape, dtype=np.uint8), (int(xs[i]), int(ys[i])), (int(xs[j]), int(ys[j])), 1,
+                    thickness=thickness)
+    return (line > 0) & label_mask
+
+
+def iter_scribble_interactions(frames, seed=0):
+    # (image, previous index mask, scribbles) for S2MController.interact, from the frames with masks:
+    # a first interaction on an empty mask, and a correction of the mask itself
+    rng = np.random.default_rng(seed)
+    for image, mask, _ in frames:
+        if mask is None:
+            continue
+        index_mask = ((mask.argmax(0) + 1) * (mask.sum(0) > 0)).numpy().astype(np.uint8)
+        scribbles = np.full(index_mask.shape, 255, dtype=np.uint8)
+        for label in np.unique(index_mask):
+            scribbles[stroke(index_mask == label, rng)] = label
+        image = image.unsqueeze(0)
+        yield image, torch.zeros(index_mask.shape, dtype=torch.uint8), scribbles
+        yield image, torch.from_numpy(index_mask), scribbles
+
+
+def quantize_xmem(args, frames):
+    config = VIDEO_INFERENCE_CONFIG.copy()
+    config['size'] = args.size
+    network = XMem(config, args.model, pretrained_key_encoder=False, pretrained_value_encoder=False).eval()
+    submodules = [name for stage in args.stages for name in XMEM_STAGES[stage]]
+    prepare_quantization(network, args.mode, submodules)
+    if args.mode == 'static':
+        # propagated from the first mask only, as the decoder does not run on the frames with masks
+        calibrate_xmem(network, [frames[0]] + [(image, None, None) for image, _, _ in frames[1:]], config)
+    convert_quantization(network, args.mode, submodules)
+    torch.save(xmem_quantization_checkpoint(network, quantization_info(args.mode, args.stages)), args.output)
+    print(f'XMem ({args.mode}, {args.stages}): {args.output}')
+
+
+def quantize_s2m(args, frames):
+    s2m_model = S2M().eval()
+    s2m_model.load_state_dict(torch.load(args.s2m_model, map_location='cpu'))
+    prepare_quantization(s2m_model, args.mode)
+    if args.mode == 'static':
+        num_objects = max(mask.shape[0] for _, mask, _ in frames if mask is not None)
+        calibrate_s2m(s2m_model, iter_scribble_interactions(frames), num_objects)
+    convert_quantization(s2m_model, args.mode)
+    torch.save(s2m_quantization_checkpoint(s2m_model, quantization_info(args.mode, ['s2m'])), args.s2m_output)
+    print(f'S2M ({args.mode}): {args.s2m_output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default=VIDEO_INFERENCE_CONFIG['model'], help='XMem weights to quantize')
+    parser.add_argument('--output', default=None, help='Path of the quantized XMem checkpoint, XMem is skipped if not given')
+    parser.add_argument('--stages', nargs='+', choices=list(XMEM_STAGES), default=list(XMEM_STAGES),
+                        help='XMem stages to quantize, the others stay float32')
+    parser.add_argument('--s2m_model', default=None, help='S2M weights to quantize')
+    parser.add_argument('--s2m_output', default=None, help='Path of the quantized S2M checkpoint')
+    parser.add_argument('--mode', choices=QUANTIZATION_MODES, default='static')
+    parser.add_argument('--calibration_imgs', default=None, help='Directory of the calibration clip frames (static)')
+    parser.add_argument('--calibration_masks', default=None, help='Directory of its masks, at least one (static)')
+    parser.add_argument('--calibration_frames', type=int, default=8)
+    parser.add_argument('--size', type=int, default=480)
+    args = parser.parse_args()
+
+    if args.output is None and (args.s2m_model is None or args.s2m_output is None):
+        parser.error('Nothing to quantize: give --output for XMem and/or --s2m_model with --s2m_output for S2M')
+    frames = None
+    if args.mode == 'static':
+        if args.calibration_imgs is None or args.calibration_masks is None:
+            parser.error('static quantization needs --calibration_imgs and --calibration_masks')
+        frames = load_calibration_frames(args.calibration_imgs, args.calibration_masks, args.size, args.calibration_frames)
+
+    torch.set_grad_enabled(False)
+    for path in (args.output, args.s2m_output):
+        if path is not None and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+    if args.output is not None:
+        quantize_xmem(args, frames)
+    if args.s2m_model is not None and args.s2m_output is not None:
+        quantize_s2m(args, frames)
@@ -155,6 +155,27 @@ VIDEO_INFERENCE_CONFIG = {
         's2m_model': 'saves/s2m.pth',
         'size': 480,
         'top_k': 30,
+        'sparse_readout': True,
+        'readout_chunk_bytes': 256 * 1024**2,
+        'ann_readout': False,
+        'ann_num_lists': 128,
+        'ann_num_probes': 8,
+        'readout_top_frames': None,
+        'memory_value_dtype': None,
+        'memory_budget_bytes': None,
+        'memory_spill_dir': None,
+        'key_lookahead': 1,
+        'key_lookahead_bytes': 1024**3,
+        'pipeline_key_encoding': False,
+        'feature_cache_dir': None,
+        'feature_cache_max_bytes': 20 * 1024**3,
+        'preload_batch_size': 8,
+        'permanent_top_frames': None,
+        'permanent_frame_selection': 'temporal',
+        'cpu_profile': None,
+        'network_backend': 'torch',
+        'exported_model_dir': None,
+        'shared_weights_dir': None,
         'value_dim': 512,
         'masks_out_path': None,
         'workspace': None,
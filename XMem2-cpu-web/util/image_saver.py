@@ -308,8 +308,8 @@ class ParallelImageSaver:
             # Yeah, the child processed should be immediately killed if the main one exits, but just in case
             if self._mask_saver_worker is not None:
                 self._mask_saver_worker.kill()
-            if self._mask_saver_worker is not None:
-                self._mask_saver_worker.kill()
+            if self._overlay_saver_worker is not None:
+                self._overlay_saver_worker.kill()
 
             raise exc_value
         else:   
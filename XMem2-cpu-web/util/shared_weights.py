@@ -0,0 +1,113 @@
+"""
+Model weights in a file mapping that is shared by all processes on a node
+
+The weights of a loaded model are written once to a flat file (the raw memory of every parameter and buffer,
+with a .json index of names, dtypes, shapes and strides). Every process then maps that file copy-on-write
+(torch.from_file) and points the parameters of its own module at the mapping, so forked or spawned workers
+share the same page cache pages instead of each holding its own copy of the weights.
+"""
+
+import hashlib
+import json
+import math
+import os
+import tempfile
+
+import torch
+
+ALIGNMENT = 64
+
+
+def shared_state_path(directory, prefix: str, key):
+    # one file per model, `key` identifies the weights and everything that changes their layout
+    return os.path.join(directory, f'{prefix}-{hashlib.sha1(repr(key).encode()).hexdigest()[:16]}.bin')
+
+
+def _atomic_write(path, write):
+    # written to a temporary file first, so that concurrent readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def save_shared_state(module: torch.nn.Module, path, metadata: dict = None):
+    # writes the state of `module` (with the memory layout of every tensor, e.g. channels_last) and the json index
+    tensors = {}
+    chunks = []
+    offset = 0
+    for name, tensor in module.state_dict().items():
+        if not isinstance(tensor, torch.Tensor) or tensor.is_quantized:
+            raise TypeError(f'{name}: only plain tensors can be shared')
+        tensor = tensor.detach().cpu()
+        if not (tensor.is_contiguous() or tensor.is_contiguous(memory_format=torch.channels_last)):
+            tensor = tensor.contiguous()
+        # the memory of the (dense) tensor, in its own order
+        memory = tensor.as_strided((tensor.numel(), ), (1, ), tensor.storage_offset())
+        nbytes = memory.numel() * memory.element_size()
+        tensors[name] = {'dtype': str(tensor.dtype).replace('torch.', ''), 'shape': list(tensor.shape),
+                         'stride': list(tensor.stride()), 'offset': offset}
+        chunks.append((offset, memory))
+        offset += math.ceil(nbytes / ALIGNMENT) * ALIGNMENT
+
+    def write_data(f):
+        for chunk_offset, memory in chunks:
+            f.seek(chunk_offset)
+            f.write(memory.view(torch.uint8).numpy().tobytes())
+        f.truncate(max(offset, 1))
+
+    # the index is written last, its existence marks a complete file
+    _atomic_write(path, write_data)
+    index = {'size': max(offset, 1), 'tensors': tensors, 'metadata': metadata or {}}
+    _atomic_write(path + '.json', lambda f: f.write(json.dumps(index).encode()))
+
+
+def has_shared_state(path):
+    return os.path.exists(path + '.json')
+
+
+def load_shared_state(path):
+    # (name -> tensor viewing the copy-on-write mapping of the file, metadata)
+    with open(path + '.json') as f:
+        index = json.load(f)
+    buffer = torch.from_file(path, shared=False, size=index['size'], dtype=torch.uint8)
+    state = {}
+    for name, info in index['tensors'].items():
+        dtype = getattr(torch, info['dtype'])
+        numel = math.prod(info['shape'])
+        nbytes = numel * torch.empty(0, dtype=dtype).element_size()
+        memory = buffer[info['offset']:info['offset'] + nbytes].view(dtype)
+        state[name] = memory.as_strided(info['shape'], info['stride'])
+    return state, index['metadata']
+
+
+def bind_shared_state(module: torch.nn.Module, state: dict):
+    # points the parameters and buffers of `module` at the tensors of `state` (from load_shared_state), without copying
+    own = dict(module.named_parameters())
+    own.update(module.named_buffers())
+    for name, tensor in state.items():
+        if name not in own:
+            continue
+        if own[name].shape != tensor.shape or own[name].dtype != tensor.dtype:
+            raise ValueError(f'{name}: the shared state does not match the module, {tuple(tensor.shape)} vs {tuple(own[name].shape)}')
+        own[name].data = tensor
+    return module
+
+
+def load_shared(directory, prefix: str, key, load, build):
+    """
+    The module identified by `key`, with its weights shared through a file in `directory`
+    load() -> (module, metadata): loads the module as usual, only done by the first process (the weights are then saved)
+    build(state, metadata) -> module: a module of the same structure for the shared state, e.g., without reading the checkpoint
+    Returns (module, metadata)
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = shared_state_path(directory, prefix, key)
+    module = None
+    if not has_shared_state(path):
+        module, metadata = load()
+        save_shared_state(module, path, metadata)
+    state, metadata = load_shared_state(path)
+    if module is None:
+        module = build(state, metadata)
+    return bind_shared_state(module, state), metadata